@@ -1,11 +1,11 @@
+import argparse
+
 import pandas as pd
 
-# Read the Excel file
-df = pd.read_excel('subset_data/all_asrq180.xlsx')
+from pipeline import EXPORT_FORMATS, minutes_to_text, normalise_time_columns, write_table
 
-# Filter rows containing "@adj.np.edu.sg" in Email (case insensitive)
-email_filtered = df[df['Email'].str.contains(
-    '@adj.np.edu.sg', case=False, na=False)].copy()
+# Class Sections kept despite the 2-letter rule
+EXCLUDED_SECTIONS = ['TSP1', 'WSP1']  # User-specified list
 
 
 # Define function to check if Class Section has ≤2 letters
@@ -48,41 +48,71 @@ def expand_day_column(df):
     return multidays_count, expanded_df
 
 
-# New function to format time columns
+# New function to format time columns (returns a new frame; df is not modified)
 def format_time_columns(df, columns):
-    for col in columns:
-        # Convert to datetime, then format as HH:MM:SS string
-        df.loc[:, col] = pd.to_datetime(
-            df[col], format='%H:%M:%S', errors='coerce').dt.strftime('%H:%M:%S')
+    """
+    Formats time columns as 'HH:MM:SS' text, reading them like the app does
+    (pipeline.normalise_time_columns: 'HH:MM', 'HH:MM:SS' or Excel time cells).
+    Returns:
+        tuple: (formatted_df, unparsable) - unparsable maps each column to the
+            distinct values that could not be read (left empty)
+    """
+    normalised_df, unparsable = normalise_time_columns(df, columns)
+    return normalised_df.assign(**{col: minutes_to_text(normalised_df[col]) for col in columns}), \
+        unparsable
+
+
+def filter_asrq(df, excluded_sections=None):
+    """Filters by adjunct email and the 2-letter Class Section rule (excluded_sections are kept)"""
+    if excluded_sections is None:
+        excluded_sections = []
+
+    # Filter rows containing "@adj.np.edu.sg" in Email (case insensitive)
+    email_filtered = df[df['Email'].str.contains(
+        '@adj.np.edu.sg', case=False, na=False)]
+
+    # assign returns a new frame, so neither df nor the selection above is modified
+    email_filtered = email_filtered.assign(
+        ExcludeFromFilter=email_filtered['Class Section'].isin(excluded_sections))
 
-    return df
+    filtered_df = email_filtered[(email_filtered['Class Section'].apply(has_max_two_letters)) |
+                                 (email_filtered['ExcludeFromFilter'])
+                                 ]
 
+    # Apply the Class Section filter
+    # filtered_df = email_filtered[email_filtered['Class Section'].apply(
+    #    has_max_two_letters)]
+    return filtered_df
 
-excluded_sections = ['TSP1', 'WSP1']  # User-specified list
 
-email_filtered.loc[:, 'ExcludeFromFilter'] = email_filtered['Class Section'].isin(
-    excluded_sections)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Step 1: filter the ASRQ180 export.")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='xlsx',
+                        help="Format of processed_data/filtered_results")
+    args = parser.parse_args(argv)
 
+    # Read the Excel file
+    df = pd.read_excel('subset_data/all_asrq180.xlsx')
 
-filtered_df = email_filtered[(email_filtered['Class Section'].apply(has_max_two_letters)) |
-                             (email_filtered['ExcludeFromFilter'])
-                             ]
+    filtered_df = filter_asrq(df, EXCLUDED_SECTIONS)
 
+    # Format 'Start Time' and 'End Time' columns
+    formatted_time_df, unparsable_times = format_time_columns(
+        filtered_df, ['Start Time', 'End Time'])
+    for col, values in unparsable_times.items():
+        if values:
+            print(f"{col}: could not read {', '.join(map(str, values))} (left empty)")
 
-# Apply the Class Section filter
-# filtered_df = email_filtered[email_filtered['Class Section'].apply(
-#    has_max_two_letters)]
+    # Apply the expansion function to the filtered DataFrame
+    multidays_count, expanded_df = expand_day_column(formatted_time_df)
 
-# Format 'Start Time' and 'End Time' columns
-formatted_time_df = format_time_columns(
-    filtered_df, ['Start Time', 'End Time'])
+    print(multidays_count)
+    # Display the result
+    print(expanded_df)
 
-# Apply the expansion function to the filtered DataFrame
-multidays_count, expanded_df = expand_day_column(formatted_time_df)
+    # Save in the chosen format
+    write_table(expanded_df, f'processed_data/filtered_results.{args.format}')
 
-print(multidays_count)
-# Display the result
-print(expanded_df)
 
-# Save to new Excel file
-expanded_df.to_excel('processed_data/filtered_results.xlsx', index=False)
+if __name__ == '__main__':
+    main()
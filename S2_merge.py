@@ -1,5 +1,8 @@
+import argparse
+
 import pandas as pd
-import numpy as np
+
+from pipeline import EXPORT_FORMATS, read_table, write_table
 
 
 def merge_with_partial_match(filtered_df, lookup_df):
@@ -11,12 +14,10 @@ def merge_with_partial_match(filtered_df, lookup_df):
     Returns:
         pd.DataFrame: Merged DataFrame with required columns
     """
-    # Create a copy to avoid modifying original DataFrames
-    filtered = filtered_df.copy()
-    lookup = lookup_df.copy()
     # Preprocess names for comparison - convert to uppercase and split into words
-    filtered['name_words'] = filtered['Name'].str.upper().str.split()
-    lookup['lookup_words'] = lookup['Full Legal Name'].str.upper().str.split()
+    # (kept beside the frames, so neither input is copied or modified)
+    name_words = filtered_df['Name'].str.upper().str.split()
+    lookup_words = lookup_df['Full Legal Name'].str.upper().str.split()
     # Function to check if names are a partial match
 
     def is_partial_match(name1, name2, min_common_tokens=2):
@@ -76,13 +77,11 @@ def merge_with_partial_match(filtered_df, lookup_df):
     # Track unmatched rows
     unmatched_count = 0
     # Iterate through each row in filtered DataFrame
-    for _, filt_row in filtered.iterrows():
-        filt_name = filt_row['name_words']
+    for (_, filt_row), filt_name in zip(filtered_df.iterrows(), name_words):
         catalog_nbr = filt_row['Catalog Nbr'] if 'Catalog Nbr' in filt_row else None
         match_found = False
         # Iterate through each row in lookup DataFrame
-        for _, lookup_row in lookup.iterrows():
-            lookup_name = lookup_row['lookup_words']
+        for (_, lookup_row), lookup_name in zip(lookup_df.iterrows(), lookup_words):
             requester_remarks = lookup_row['Requester Remarks'] if 'Requester Remarks' in lookup_row else None
             # Check for partial name match
             name_match = is_partial_match(filt_name, lookup_name)
@@ -112,22 +111,35 @@ def merge_with_partial_match(filtered_df, lookup_df):
                 break  # Stop after first match
         if not match_found:
             unmatched_count += 1
-    print(f"Processed {len(filtered)} rows from filtered DataFrame")
+    print(f"Processed {len(filtered_df)} rows from filtered DataFrame")
     print(f"Found matches for {len(result_df)} rows")
     print(f"Unmatched rows: {unmatched_count}")
     return result_df
 
 
-# Read the Excel files
-filtered_df = pd.read_excel('processed_data/filtered_results.xlsx')
-# test file: position_program_id_lookup.xlsx
-lookup_df = pd.read_excel('subset_data/all_hiring_form.xlsx')
-# Print column names for debugging
-print("Columns in filtered DataFrame:", filtered_df.columns.tolist())
-print("Columns in lookup DataFrame:", lookup_df.columns.tolist())
-# Perform the merge with partial matching
-result_df = merge_with_partial_match(filtered_df, lookup_df)
-# Save the result
-result_df.to_excel('processed_data/merged_output.xlsx', index=False)
-# Display the first few rows
-print(result_df.head())
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Step 2: merge the filtered rows with the hiring form.")
+    parser.add_argument('--input', default='processed_data/filtered_results.xlsx',
+                        help="Step 1 output (xlsx, csv or parquet)")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='xlsx',
+                        help="Format of processed_data/merged_output")
+    args = parser.parse_args(argv)
+
+    # Read the Excel files
+    filtered_df = read_table(args.input)
+    # test file: position_program_id_lookup.xlsx
+    lookup_df = pd.read_excel('subset_data/all_hiring_form.xlsx')
+    # Print column names for debugging
+    print("Columns in filtered DataFrame:", filtered_df.columns.tolist())
+    print("Columns in lookup DataFrame:", lookup_df.columns.tolist())
+    # Perform the merge with partial matching
+    result_df = merge_with_partial_match(filtered_df, lookup_df)
+    # Save the result
+    write_table(result_df, f'processed_data/merged_output.{args.format}')
+    # Display the first few rows
+    print(result_df.head())
+
+
+if __name__ == '__main__':
+    main()
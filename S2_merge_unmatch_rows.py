@@ -1,5 +1,8 @@
+import argparse
+
 import pandas as pd
-import numpy as np
+
+from pipeline import EXPORT_FORMATS, read_table, suggest_matches, write_table
 
 
 def merge_with_partial_match(filtered_df, lookup_df):
@@ -14,13 +17,10 @@ def merge_with_partial_match(filtered_df, lookup_df):
             - unmatched_df (pd.DataFrame): DataFrame containing unmatched rows
             - unmatched_count (int): Count of unmatched rows
     """
-    # Create a copy to avoid modifying original DataFrames
-    filtered = filtered_df.copy()
-    lookup = lookup_df.copy()
-
     # Preprocess names for comparison - convert to uppercase and split into words
-    filtered['name_words'] = filtered['Name'].str.upper().str.split()
-    lookup['lookup_words'] = lookup['Full Legal Name'].str.upper().str.split()
+    # (kept beside the frames, so neither input is copied or modified)
+    name_words = filtered_df['Name'].str.upper().str.split()
+    lookup_words = lookup_df['Full Legal Name'].str.upper().str.split()
 
     # Function to check if names are a partial match
     def is_partial_match(name1, name2, min_common_tokens=2):
@@ -80,14 +80,12 @@ def merge_with_partial_match(filtered_df, lookup_df):
     unmatched_rows = []  # Store unmatched rows here
 
     # Iterate through each row in filtered DataFrame
-    for _, filt_row in filtered.iterrows():
-        filt_name = filt_row['name_words']
+    for (_, filt_row), filt_name in zip(filtered_df.iterrows(), name_words):
         catalog_nbr = filt_row['Catalog Nbr'] if 'Catalog Nbr' in filt_row else None
         match_found = False
 
         # Iterate through each row in lookup DataFrame
-        for _, lookup_row in lookup.iterrows():
-            lookup_name = lookup_row['lookup_words']
+        for (_, lookup_row), lookup_name in zip(lookup_df.iterrows(), lookup_words):
             requester_remarks = lookup_row['Requester Remarks'] if 'Requester Remarks' in lookup_row else None
 
             # Check for partial name match
@@ -122,9 +120,8 @@ def merge_with_partial_match(filtered_df, lookup_df):
 
         if not match_found:
             unmatched_count += 1
-            # Store the original row without the added 'name_words' column
-            # Class Section will be preserved if it exists
-            unmatched_rows.append(filt_row.drop('name_words'))
+            # Store the original row; Class Section will be preserved if it exists
+            unmatched_rows.append(filt_row)
 
     # Create DataFrame from unmatched rows
     unmatched_df = pd.DataFrame(unmatched_rows)
@@ -133,35 +130,54 @@ def merge_with_partial_match(filtered_df, lookup_df):
     return result_df, unmatched_df, unmatched_count
 
 
-# Read the Excel files
-filtered_df = pd.read_excel('processed_data/filtered_results.xlsx')
-# test file: position_program_id_lookup.xlsx
-lookup_df = pd.read_excel('subset_data/all_hiring_form.xlsx')
-
-# Print column names for debugging
-print("Columns in filtered DataFrame:", filtered_df.columns.tolist())
-print("Columns in lookup DataFrame:", lookup_df.columns.tolist())
-
-# Perform the merge with partial matching
-result_df, unmatched_df, unmatched_count = merge_with_partial_match(
-    filtered_df, lookup_df)
-
-# Save the result
-result_df.to_excel('processed_data/merged_output.xlsx', index=False)
-
-# Display the first few rows
-print("\nMerged result sample:")
-print(result_df.head())
-
-# Print statistics and sample of unmatched rows
-print(f"\nProcessed {len(filtered_df)} rows from filtered DataFrame")
-print(f"Found matches for {len(result_df)} rows")
-print(f"Unmatched rows: {unmatched_count}")
-
-if unmatched_count > 0:
-    print("\nSample of unmatched rows:")
-    print(unmatched_df.head())
-    # Save unmatched rows to Excel
-    unmatched_df.to_excel(
-        'processed_data/unmatched_rows.xlsx', index=False)
-    print("\nUnmatched rows saved to 'processed_data/unmatched_rows.xlsx'")
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Step 2: merge the filtered rows with the hiring form.")
+    parser.add_argument('--input', default='processed_data/filtered_results.xlsx',
+                        help="Step 1 output (xlsx, csv or parquet)")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='xlsx',
+                        help="Format of processed_data/merged_output and unmatched_rows")
+    args = parser.parse_args(argv)
+
+    # Read the Excel files
+    filtered_df = read_table(args.input)
+    # test file: position_program_id_lookup.xlsx
+    lookup_df = pd.read_excel('subset_data/all_hiring_form.xlsx')
+
+    # Print column names for debugging
+    print("Columns in filtered DataFrame:", filtered_df.columns.tolist())
+    print("Columns in lookup DataFrame:", lookup_df.columns.tolist())
+
+    # Perform the merge with partial matching
+    result_df, unmatched_df, unmatched_count = merge_with_partial_match(
+        filtered_df, lookup_df)
+
+    # Save the result
+    write_table(result_df, f'processed_data/merged_output.{args.format}')
+
+    # Display the first few rows
+    print("\nMerged result sample:")
+    print(result_df.head())
+
+    # Print statistics and sample of unmatched rows
+    print(f"\nProcessed {len(filtered_df)} rows from filtered DataFrame")
+    print(f"Found matches for {len(result_df)} rows")
+    print(f"Unmatched rows: {unmatched_count}")
+
+    if unmatched_count > 0:
+        print("\nSample of unmatched rows:")
+        print(unmatched_df.head())
+        # Save unmatched rows
+        # Top-3 hiring form candidates per unmatched row: second sheet, or their own file
+        suggestions_df = suggest_matches(unmatched_df, lookup_df)
+        if args.format == 'xlsx':
+            write_table(unmatched_df, 'processed_data/unmatched_rows.xlsx',
+                        extra_sheets={'Suggestions': suggestions_df})
+        else:
+            write_table(unmatched_df, f'processed_data/unmatched_rows.{args.format}')
+            write_table(suggestions_df, f'processed_data/unmatched_suggestions.{args.format}')
+        print(f"\nUnmatched rows and suggested matches saved to 'processed_data/' ({args.format})")
+
+
+if __name__ == '__main__':
+    main()
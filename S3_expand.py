@@ -1,6 +1,10 @@
-import pandas as pd
+import argparse
 import datetime
 
+import pandas as pd
+
+from pipeline import EXPORT_FORMATS, clean_program_ids, read_table, write_table
+
 
 def map_dates_to_weeks(schedule_dict):
     week_mapping = {}
@@ -57,15 +61,14 @@ def expand_df_with_dates(merged_df, start_date_str, end_date_str):
     Skips rows with invalid day entries.
     Places 'Date' and 'Week Number' columns immediately after 'Day' column.
     Args:
-        merged_df (pd.DataFrame): Input DataFrame with 'Day' column
+        merged_df (pd.DataFrame): Input DataFrame with 'Day' column (not modified)
         start_date_str (str): Start date in format "DD Month YYYY"
         end_date_str (str): End date in format "DD Month YYYY"
     Returns:
         pd.DataFrame: Expanded DataFrame with 'Date' and 'Week Number' columns after 'Day' column
     """
-    # Clean 'Program ID' column
-    merged_df['Program ID'] = merged_df['Program ID'].astype(
-        str).str.split().str[0].str.strip()
+    # Clean 'Program ID' column (assign returns a new frame; the caller's is not modified)
+    merged_df = merged_df.assign(**{'Program ID': clean_program_ids(merged_df['Program ID'])})
 
     # Get weekday-date mapping
     weekday_date_dict = create_weekday_date_dict(start_date_str, end_date_str)
@@ -185,13 +188,25 @@ def expand_df_with_dates(merged_df, start_date_str, end_date_str):
     return expanded_df
 
 
-# Example usage:
-start_date = "21 April 2025"
-end_date = "23 August 2025"
-# Apply the function to expand the DataFrame
-merged_df = pd.read_excel('processed_data/merged_output.xlsx')
-expanded_df = expand_df_with_dates(merged_df, start_date, end_date)
-# Display the result
-print(expanded_df.head())
-# Save to new Excel file
-expanded_df.to_excel('processed_data/expanded_with_dates.xlsx', index=False)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Step 3: expand the merged rows with dates.")
+    parser.add_argument('--input', default='processed_data/merged_output.xlsx',
+                        help="Step 2 output (xlsx, csv or parquet)")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='xlsx',
+                        help="Format of processed_data/expanded_with_dates")
+    args = parser.parse_args(argv)
+
+    # Example usage:
+    start_date = "21 April 2025"
+    end_date = "23 August 2025"
+    # Apply the function to expand the DataFrame
+    merged_df = read_table(args.input)
+    expanded_df = expand_df_with_dates(merged_df, start_date, end_date)
+    # Display the result
+    print(expanded_df.head())
+    # Save in the chosen format (columns in final_column_order)
+    write_table(expanded_df, f'processed_data/expanded_with_dates.{args.format}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Processing backend benchmark.
+
+Times the stages that have a Polars implementation (the Step 1 filter, the Day
+split and the Step 3 date expansion) on the pandas and polars backends, and checks
+that both backends give the same result. The Step 2 merge is run once, outside the
+timings, to build the expansion's input. The best of several runs is reported.
+
+Usage:
+    python backend_benchmark.py asrq180.xlsx hiring_form.xlsx
+    python backend_benchmark.py asrq180.xlsx hiring_form.xlsx --repeats 10 --merge-engine sparse
+"""
+import argparse
+import importlib.util
+import time
+
+import pandas as pd
+
+from pipeline import (BACKENDS, MERGE_ENGINES, expand_day_column, expand_df_with_dates,
+                      filter_data_with_hits, merge_data, normalise_time_columns)
+
+
+def best_time(function, repeats):
+    """
+    Fastest of several calls.
+    Returns:
+        tuple: (seconds, result of the last call)
+    """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_backend(backend, asrq_df, merged_df, start_date_str, end_date_str, repeats):
+    """
+    Times each stage on one backend.
+    Returns:
+        dict: Stage name -> (seconds, result)
+    """
+    stages = {
+        'filter': lambda: filter_data_with_hits(asrq_df, backend=backend),
+        'day split': lambda: expand_day_column(asrq_df, backend),
+        'date expansion': lambda: expand_df_with_dates(merged_df, start_date_str, end_date_str,
+                                                       memory_limit=None, backend=backend),
+    }
+    return {stage: best_time(function, repeats) for stage, function in stages.items()}
+
+
+def same_result(first, second):
+    """True when two stage results (frames, or tuples holding frames) are equal"""
+    if isinstance(first, tuple):
+        return all(same_result(a, b) for a, b in zip(first, second))
+    if isinstance(first, pd.DataFrame):
+        try:
+            pd.testing.assert_frame_equal(first, second)
+        except AssertionError:
+            return False
+        return True
+    return first == second
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the pandas and polars backends.")
+    parser.add_argument('asrq', help="ASRQ180 file (.xlsx)")
+    parser.add_argument('hiring', help="Hiring form file (.xlsx)")
+    parser.add_argument('--start', default='1 April 2024', help="Start date, e.g. '1 April 2024'")
+    parser.add_argument('--end', default='30 June 2024', help="End date, e.g. '30 June 2024'")
+    parser.add_argument('--repeats', type=int, default=5,
+                        help="Runs per stage; the fastest is reported")
+    parser.add_argument('--merge-engine', choices=list(MERGE_ENGINES), default='sparse',
+                        help="Step 2 engine used to build the expansion's input (not timed)")
+    args = parser.parse_args()
+
+    asrq_df = pd.read_excel(args.asrq)
+    lookup_df = pd.read_excel(args.hiring)
+    filtered_df, _ = filter_data_with_hits(asrq_df)
+    filtered_df, _ = normalise_time_columns(filtered_df, ['Start Time', 'End Time'])
+    _, filtered_df = expand_day_column(filtered_df)
+    merged_df = merge_data(filtered_df, lookup_df, engine=args.merge_engine)[0]
+    print(f"{len(asrq_df)} ASRQ rows, {len(merged_df)} merged rows")
+
+    backends = [backend for backend in BACKENDS
+                if backend == 'pandas' or importlib.util.find_spec(backend)]
+    skipped = sorted(set(BACKENDS) - set(backends))
+    if skipped:
+        print(f"Skipping {', '.join(skipped)} (not installed)")
+    timings = {backend: run_backend(backend, asrq_df, merged_df, args.start, args.end,
+                                    args.repeats)
+               for backend in backends}
+
+    print(f"{'stage':<16}" + ''.join(f"{backend + ' (ms)':>14}" for backend in backends)
+          + "  same result")
+    for stage, (_, baseline) in timings['pandas'].items():
+        row = ''.join(f"{timings[backend][stage][0] * 1000:>14.1f}" for backend in backends)
+        same = all(same_result(baseline, timings[backend][stage][1]) for backend in backends)
+        print(f"{stage:<16}{row}  {'yes' if same else 'NO'}")
@@ -0,0 +1,284 @@
+"""
+Batch mode: run the full pipeline for every school in a directory.
+
+Input pairs are matched by prefix, e.g. 'eng_asrq180.xlsx' + 'eng_hiring_form.xlsx'.
+Each school is processed in its own worker process; per-school outputs are written
+to <output_dir>/<school>/ and all schools are combined into one workbook.
+Known emails are matched through the shared email map (see email_map.py), which
+learns the emails of this batch's unambiguous matches once all schools are done.
+With --stream-rows, each school is read and processed in batches of that many rows
+(pipeline.PipelineStream) and only the expanded rows, unmatched rows and hours
+summary are written; the combined workbook and the clash check need all rows at
+once and are skipped.
+
+Usage:
+    python batch_process.py subset_data processed_data --start "21 April 2025" --end "23 August 2025"
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from email_map import EmailMap
+from pipeline import (BACKENDS, EXPORT_FORMATS, HOURS_SUMMARY_KEYS, MERGE_ENGINES,
+                      PipelineStream, detect_clashes, hours_summary, iter_table_chunks,
+                      run_pipeline, write_table)
+
+ASRQ_SUFFIX = '_asrq180.xlsx'
+HIRING_SUFFIX = '_hiring_form.xlsx'
+
+
+def find_input_pairs(input_dir):
+    """
+    Finds ASRQ180 / hiring form pairs in a directory.
+    Args:
+        input_dir (str): Directory holding '<school>_asrq180.xlsx' and '<school>_hiring_form.xlsx'
+    Returns:
+        list: (school, asrq_path, hiring_path) tuples, largest ASRQ180 first
+    """
+    pairs = []
+    for file_name in os.listdir(input_dir):
+        if not file_name.endswith(ASRQ_SUFFIX):
+            continue
+        school = file_name[:-len(ASRQ_SUFFIX)]
+        asrq_path = os.path.join(input_dir, file_name)
+        hiring_path = os.path.join(input_dir, school + HIRING_SUFFIX)
+        if not os.path.exists(hiring_path):
+            print(f"Skipping {school}: no {school + HIRING_SUFFIX} found")
+            continue
+        pairs.append((school, asrq_path, hiring_path))
+
+    # Submit the largest schools first so they do not end up as the tail of the batch
+    pairs.sort(key=lambda pair: os.path.getsize(pair[1]), reverse=True)
+    return pairs
+
+
+def process_school(school, asrq_path, hiring_path, output_dir, start_date_str, end_date_str,
+                   merge_engine='first-match', email_map=None, excluded_sections=None,
+                   native_dates=False, file_format='xlsx', stream_rows=None, backend='pandas'):
+    """Worker: runs Steps 1-3 for one school and writes its outputs."""
+    if stream_rows:
+        return stream_school(school, asrq_path, hiring_path, output_dir, start_date_str,
+                             end_date_str, merge_engine, email_map, excluded_sections,
+                             native_dates, file_format, stream_rows, backend)
+    asrq_df = pd.read_excel(asrq_path)
+    lookup_df = pd.read_excel(hiring_path)
+
+    result = run_pipeline(asrq_df, lookup_df, start_date_str, end_date_str, excluded_sections,
+                          merge_engine=merge_engine, email_map=email_map, backend=backend)
+
+    school_dir = os.path.join(output_dir, school)
+    os.makedirs(school_dir, exist_ok=True)
+    write_table(result['filtered'], os.path.join(
+        school_dir, f'filtered_results.{file_format}'))
+    write_table(result['merged'], os.path.join(
+        school_dir, f'merged_output.{file_format}'))
+    if result['unmatched_count'] > 0:
+        write_table(result['unmatched'], os.path.join(
+            school_dir, f'unmatched_rows.{file_format}'))
+    # The expanded workbook gets sheets with the hours per lecturer and week and the clashes
+    expanded_sheets = {}
+    if len(result['expanded']):
+        expanded_sheets['Hours Summary'] = hours_summary(result['expanded'])
+    if len(result['clashes']):
+        expanded_sheets['Clashes'] = result['clashes']
+    write_table(result['expanded'], os.path.join(
+        school_dir, f'expanded_with_dates.{file_format}'),
+        extra_sheets=expanded_sheets, native_dates=native_dates)
+
+    summary = {
+        'School': school,
+        'Original rows': len(asrq_df),
+        'Filtered rows': len(result['filtered']),
+        'Merged rows': len(result['merged']),
+        # Only the sparse engine counts the candidates of each match
+        'Matched by email': (int((result['merged']['Matched By'] == 'email').sum())
+                             if 'Matched By' in result['merged'].columns else None),
+        'Ambiguous matches': (int((result['merged']['Candidates'] > 1).sum())
+                              if 'Candidates' in result['merged'].columns else None),
+        'Unmatched rows': result['unmatched_count'],
+        'Skipped rows': result['skipped_rows'],
+        'Expanded rows': len(result['expanded']),
+        'Clashes': len(result['clashes']),
+        'Exclusion hits': ', '.join(
+            f"{hit['Rule']}: {hit['Rows kept by rule']}"
+            for hit in result['exclusion_hits'].to_dict('records')),
+        'Unparsable times': ', '.join(
+            str(value) for values in result['unparsable_times'].values() for value in values),
+    }
+    return summary, result['expanded'], result['learned_emails']
+
+
+def stream_school(school, asrq_path, hiring_path, output_dir, start_date_str, end_date_str,
+                  merge_engine, email_map, excluded_sections, native_dates, file_format,
+                  stream_rows, backend='pandas'):
+    """Worker for --stream-rows: Steps 1-3 in batches, expanded rows written as they are built."""
+    stream = PipelineStream(iter_table_chunks(asrq_path, stream_rows), pd.read_excel(hiring_path),
+                            start_date_str, end_date_str, excluded_sections, merge_engine,
+                            email_map, chunk_rows=stream_rows, backend=backend)
+
+    school_dir = os.path.join(output_dir, school)
+    os.makedirs(school_dir, exist_ok=True)
+    write_table(stream, os.path.join(school_dir, f'expanded_with_dates.{file_format}'),
+                native_dates=native_dates)
+    result = stream.results()
+    if result['unmatched_count'] > 0:
+        write_table(result['unmatched'], os.path.join(
+            school_dir, f'unmatched_rows.{file_format}'))
+    write_table(result['hours'], os.path.join(school_dir, f'hours_summary.{file_format}'))
+
+    summary = {
+        'School': school,
+        'Original rows': result['asrq_rows'],
+        'Filtered rows': result['filtered_rows'],
+        'Merged rows': result['merged_rows'],
+        'Matched by email': result['matched_by_email'],
+        'Ambiguous matches': result['ambiguous_matches'],
+        'Unmatched rows': result['unmatched_count'],
+        'Skipped rows': result['skipped_rows'],
+        'Expanded rows': result['expanded_rows'],
+        'Clashes': None,
+        'Exclusion hits': ', '.join(
+            f"{hit['Rule']}: {hit['Rows kept by rule']}"
+            for hit in result['exclusion_hits'].to_dict('records')),
+        'Unparsable times': ', '.join(
+            str(value) for values in result['unparsable_times'].values() for value in values),
+    }
+    return summary, None, result['learned_emails']
+
+
+def run_batch(input_dir, output_dir, start_date_str, end_date_str, max_workers=None,
+              merge_engine='first-match', use_email_map=True, excluded_sections=None,
+              native_dates=False, file_format='xlsx', stream_rows=None, backend='pandas'):
+    """
+    Processes every school in input_dir concurrently.
+    Args:
+        input_dir (str): Directory with input pairs
+        output_dir (str): Directory for per-school and combined outputs
+        start_date_str (str): Start date in format "DD Month YYYY"
+        end_date_str (str): End date in format "DD Month YYYY"
+        max_workers (int): Worker processes (defaults to the CPU count)
+        merge_engine (str): Step 2 engine, a key of pipeline.MERGE_ENGINES
+        use_email_map (bool): Match known emails first and learn new ones
+        excluded_sections (list): Class Section rules that bypass the 2-letter rule
+        native_dates (bool): Write dates and times of the expanded outputs as Excel values
+        file_format (str): Output format, a key of pipeline.EXPORT_FORMATS
+        stream_rows (int): Process each school in batches of this many rows (bounded
+            memory, no combined workbook); None processes each school at once
+        backend (str): Implementation of the filter and expansions, a key of pipeline.BACKENDS
+    Returns:
+        pd.DataFrame: One summary row per school
+    """
+    pairs = find_input_pairs(input_dir)
+    if not pairs:
+        raise FileNotFoundError(
+            f"No '*{ASRQ_SUFFIX}' / '*{HIRING_SUFFIX}' pairs found in {input_dir}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    summaries = []
+    expanded_by_school = {}
+    # Workers get a snapshot of the map; only this process writes to it
+    email_store = EmailMap() if use_email_map else None
+    known_emails = email_store.load() if use_email_map else None
+    learned_emails = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(process_school, school, asrq_path, hiring_path,
+                            output_dir, start_date_str, end_date_str, merge_engine,
+                            known_emails, excluded_sections, native_dates,
+                            file_format, stream_rows, backend): school
+            for school, asrq_path, hiring_path in pairs
+        }
+        for future in as_completed(futures):
+            school = futures[future]
+            try:
+                summary, expanded_df, learned = future.result()
+            except Exception as e:
+                print(f"{school}: failed ({e})")
+                continue
+            print(f"{school}: {summary['Expanded rows']} expanded rows")
+            summaries.append(summary)
+            expanded_by_school[school] = expanded_df
+            # An email matched to different Empl IDs by two schools is not learned
+            for email, empl_id in learned.items():
+                if learned_emails.setdefault(email, empl_id) != empl_id:
+                    learned_emails[email] = None
+
+    if not summaries:
+        raise RuntimeError("All schools failed to process")
+
+    if use_email_map:
+        added, conflicts = email_store.update(
+            {email: empl_id for email, empl_id in learned_emails.items() if empl_id is not None})
+        print(f"Email map: learned {added} new emails"
+              + (f", {conflicts} disagreed with the stored Empl ID (kept)" if conflicts else ""))
+
+    if stream_rows:
+        print("Streaming mode: no combined workbook")
+    else:
+        write_combined(expanded_by_school, output_dir, file_format, native_dates)
+
+    summary_df = pd.DataFrame(summaries).sort_values('School', ignore_index=True)
+    summary_df.to_excel(os.path.join(
+        output_dir, 'batch_summary.xlsx'), index=False)
+    return summary_df
+
+
+def write_combined(expanded_by_school, output_dir, file_format, native_dates):
+    """Writes all schools' expanded rows, hours and clashes to one file"""
+    # Combine schools in a stable (alphabetical) order, tagging each row with its school;
+    # expansions kept factorised for their size are built here
+    combined_df = pd.concat(
+        [(df if isinstance(df, pd.DataFrame) else df.to_frame()).assign(School=school)
+         for school, df in sorted(expanded_by_school.items())],
+        ignore_index=True)
+    combined_sheets = {}
+    if len(combined_df):
+        combined_sheets['Hours Summary'] = hours_summary(
+            combined_df, ['School'] + HOURS_SUMMARY_KEYS)
+        # Checked again across schools: a lecturer may teach for more than one
+        clashes_df = detect_clashes(combined_df)
+        if len(clashes_df):
+            combined_sheets['Clashes'] = clashes_df
+    write_table(combined_df, os.path.join(
+        output_dir, f'all_schools_expanded_with_dates.{file_format}'),
+        extra_sheets=combined_sheets, native_dates=native_dates)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run the teaching claim pipeline for many schools at once.")
+    parser.add_argument('input_dir', help="Directory with *_asrq180.xlsx / *_hiring_form.xlsx pairs")
+    parser.add_argument('output_dir', help="Directory for the outputs")
+    parser.add_argument('--start', default="21 April 2025",
+                        help='Start date, e.g. "21 April 2025"')
+    parser.add_argument('--end', default="23 August 2025",
+                        help='End date, e.g. "23 August 2025"')
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--merge-engine', choices=list(MERGE_ENGINES), default='first-match',
+                        help="Step 2 engine: first-match (original), sparse (scored, needs "
+                             "scipy) or duckdb (first-match as SQL, needs duckdb)")
+    parser.add_argument('--no-email-map', action='store_true',
+                        help="Do not use or update the learned Email -> Empl ID map")
+    parser.add_argument('--exclude', nargs='*', default=[], metavar='RULE',
+                        help="Class Sections kept despite the 2-letter rule: "
+                             "exact codes, prefixes or patterns, e.g. TSP* WSP*")
+    parser.add_argument('--native-dates', action='store_true',
+                        help="Write dates and times of the expanded outputs as Excel values")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='xlsx',
+                        help="Format of the step outputs (CSV / Parquet hold the main table only)")
+    parser.add_argument('--stream-rows', type=int, default=None, metavar='N',
+                        help="Process each school in batches of N rows with bounded memory "
+                             "(writes expanded rows, unmatched rows and hours only)")
+    parser.add_argument('--backend', choices=BACKENDS, default='pandas',
+                        help="Filter / expansion implementation: pandas or polars (needs polars)")
+    args = parser.parse_args()
+
+    summary_df = run_batch(args.input_dir, args.output_dir, args.start, args.end,
+                           args.workers, args.merge_engine, not args.no_email_map,
+                           args.exclude, args.native_dates, args.format, args.stream_rows,
+                           args.backend)
+    print(summary_df.to_string(index=False))
@@ -0,0 +1,120 @@
+"""
+Allocation benchmark and input-mutation check for the pipeline steps.
+
+Each step runs on the previous step's output under tracemalloc, which sees the
+memory allocated through Python and NumPy; the peak of each step is reported next
+to the size of its input, so a full-frame copy shows up as a peak of about the
+input size. Every input frame is hashed before and after its step; the script
+exits with status 1 if any step modified its input.
+
+Usage:
+    python copy_benchmark.py asrq180.xlsx hiring_form.xlsx
+    python copy_benchmark.py asrq180.xlsx hiring_form.xlsx --merge-engine sparse --legacy
+"""
+import argparse
+import sys
+import tracemalloc
+
+import pandas as pd
+
+from pipeline import (MERGE_ENGINES, expand_day_column, expand_df_with_dates,
+                      filter_data_with_hits, format_for_export, merge_data,
+                      normalise_time_columns)
+
+MB = 1024 * 1024
+
+
+def frame_fingerprint(df):
+    """Columns, dtypes and a hash of the values and index of a DataFrame"""
+    return (list(df.columns), [str(dtype) for dtype in df.dtypes],
+            int(pd.util.hash_pandas_object(df.astype(object), index=True).sum()))
+
+
+def measure_step(function, *inputs):
+    """
+    Runs one step under tracemalloc.
+    Args:
+        function (callable): Step, called with the inputs
+        inputs (pd.DataFrame): Frames the step must not modify
+    Returns:
+        tuple: (result, peak bytes allocated, whether every input is unchanged)
+    """
+    before = [frame_fingerprint(df) for df in inputs]
+    tracemalloc.start()
+    result = function(*inputs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    unchanged = before == [frame_fingerprint(df) for df in inputs]
+    return result, peak, unchanged
+
+
+def pipeline_steps(merge_engine, start_date_str, end_date_str):
+    """(name, function) of Steps 1-3 and the export, each taking the previous output"""
+    return [
+        ('filter', lambda df: filter_data_with_hits(df)[0]),
+        ('time columns', lambda df: normalise_time_columns(df, ['Start Time', 'End Time'])[0]),
+        ('day split', lambda df: expand_day_column(df)[1]),
+        ('merge', lambda df, lookup_df: merge_data(df, lookup_df, merge_engine)[0]),
+        ('date expansion', lambda df: expand_df_with_dates(
+            df, start_date_str, end_date_str, memory_limit=None)[0]),
+        ('export format', format_for_export),
+    ]
+
+
+def legacy_steps(start_date_str, end_date_str):
+    """(name, function) of the standalone S-scripts' steps, each taking the previous output"""
+    import S1_filter
+    import S2_merge_unmatch_rows
+    import S3_expand
+
+    return [
+        ('S1 filter', S1_filter.filter_asrq),
+        ('S1 time columns', lambda df: S1_filter.format_time_columns(
+            df, ['Start Time', 'End Time'])[0]),
+        ('S1 day split', lambda df: S1_filter.expand_day_column(df)[1]),
+        ('S2 merge', lambda df, lookup_df: S2_merge_unmatch_rows.merge_with_partial_match(
+            df, lookup_df)[0]),
+        ('S3 date expansion', lambda df: S3_expand.expand_df_with_dates(
+            df, start_date_str, end_date_str)),
+    ]
+
+
+def run_steps(steps, asrq_df, lookup_df):
+    """
+    Runs the steps in order and prints one line per step.
+    Returns:
+        bool: True if no step modified its input
+    """
+    all_unchanged = True
+    data = asrq_df
+    for name, function in steps:
+        inputs = (data, lookup_df) if name.endswith('merge') else (data,)
+        input_size = data.memory_usage(deep=True).sum()
+        data, peak, unchanged = measure_step(function, *inputs)
+        all_unchanged = all_unchanged and unchanged
+        print(f"{name:<20}{len(inputs[0]):>9}{input_size / MB:>12.2f}{peak / MB:>12.2f}"
+              f"  {'yes' if unchanged else 'MODIFIED'}")
+    return all_unchanged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measure allocations per step and check that no step modifies its input.")
+    parser.add_argument('asrq', help="ASRQ180 file (.xlsx)")
+    parser.add_argument('hiring', help="Hiring form file (.xlsx)")
+    parser.add_argument('--start', default='1 April 2024', help="Start date, e.g. '1 April 2024'")
+    parser.add_argument('--end', default='30 June 2024', help="End date, e.g. '30 June 2024'")
+    parser.add_argument('--merge-engine', choices=list(MERGE_ENGINES), default='first-match',
+                        help="Step 2 engine")
+    parser.add_argument('--legacy', action='store_true',
+                        help="Also run the standalone S1/S2/S3 scripts' steps")
+    args = parser.parse_args()
+
+    asrq_df = pd.read_excel(args.asrq)
+    lookup_df = pd.read_excel(args.hiring)
+
+    print(f"{'step':<20}{'rows in':>9}{'input (MB)':>12}{'peak (MB)':>12}  input unchanged")
+    ok = run_steps(pipeline_steps(args.merge_engine, args.start, args.end), asrq_df, lookup_df)
+    if args.legacy:
+        ok = run_steps(legacy_steps(args.start, args.end), asrq_df, lookup_df) and ok
+    sys.exit(0 if ok else 1)
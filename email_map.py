@@ -0,0 +1,113 @@
+"""
+Persisted Email -> Empl ID mapping used as a fast path by the Step 2 merge.
+
+Once an ASRQ180 email has been matched to an Empl ID by name, later merges join
+on the email directly (pipeline.merge_data(..., email_map=...)) and only rows with
+unknown emails go through the token/catalog matching. New pairs are learned from
+confirmed matches (pipeline.confirmed_email_matches); known emails are never
+remapped automatically.
+
+The mapping is a SQLite table, by default next to the job store; set
+CLAIM_EMAIL_MAP to use another file.
+"""
+import argparse
+import contextlib
+import os
+import sqlite3
+import time
+
+EMAIL_MAP_PATH = os.environ.get('CLAIM_EMAIL_MAP', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'job_data', 'email_map.sqlite3'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS email_map (
+    email TEXT PRIMARY KEY,
+    empl_id TEXT NOT NULL,
+    learned_at REAL NOT NULL
+);
+"""
+# Empl IDs learned from float columns were stored as e.g. '10019.0'; keys are '10019'
+# (pipeline.normalise_empl_id)
+FIX_FLOAT_EMPL_IDS = """
+UPDATE email_map SET empl_id = substr(empl_id, 1, length(empl_id) - 2)
+WHERE empl_id LIKE '%.0' AND empl_id NOT LIKE '.%'
+  AND substr(empl_id, 1, length(empl_id) - 2) NOT GLOB '*[^0-9]*'
+"""
+
+
+class EmailMap:
+    """
+    Email -> Empl ID pairs stored in SQLite.
+    Args:
+        path (str): Database file (created on first use)
+    """
+
+    def __init__(self, path=EMAIL_MAP_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            conn.execute(FIX_FLOAT_EMPL_IDS)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM email_map").fetchone()[0]
+
+    def load(self):
+        """
+        Returns:
+            dict: Normalised email -> Empl ID (as text)
+        """
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT email, empl_id FROM email_map"))
+
+    def update(self, pairs):
+        """
+        Records newly confirmed pairs; emails already mapped keep their Empl ID.
+        Args:
+            pairs (dict): Normalised email -> Empl ID
+        Returns:
+            tuple: (added, conflicts) - pairs stored, and pairs ignored because the
+                email is already mapped to another Empl ID
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            known = dict(conn.execute("SELECT email, empl_id FROM email_map"))
+            new_pairs = [(email, str(empl_id), now) for email, empl_id in pairs.items()
+                         if email not in known]
+            conflicts = sum(1 for email, empl_id in pairs.items()
+                            if email in known and known[email] != str(empl_id))
+            conn.executemany(
+                "INSERT INTO email_map (email, empl_id, learned_at) VALUES (?, ?, ?)", new_pairs)
+            conn.execute("COMMIT")
+        return len(new_pairs), conflicts
+
+    def forget(self, email):
+        """Removes one email, e.g. after a lecturer's Empl ID has changed"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM email_map WHERE email = ?", (email,))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect or edit the Email -> Empl ID mapping.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help="Print all pairs")
+    forget_parser = subparsers.add_parser('forget', help="Remove one email")
+    forget_parser.add_argument('email')
+    args = parser.parse_args()
+
+    email_map = EmailMap()
+    if args.command == 'list':
+        for email, empl_id in sorted(email_map.load().items()):
+            print(f"{email}\t{empl_id}")
+    else:
+        email_map.forget(args.email.strip().lower())
@@ -0,0 +1,246 @@
+"""
+Memory budget for step DataFrames held by Streamlit sessions.
+
+Step results are stored in a process-wide FrameStore and handed back as
+StoredFrame handles. Frames larger than the spill threshold go straight to a
+spill file; the rest stay in memory until a session exceeds its budget or all
+sessions together exceed the total budget, at which point the least recently
+used frames are spilled. Spilled frames are read back (memory-mapped) on access.
+Besides DataFrames, the store takes other step results that report their size
+(an nbytes() method, or bytes); those are spilled as pickles.
+
+Streamlit does not say when a session ends, so sessions that have not been
+seen (touch()) for SESSION_TTL are swept: their frames and spill files are
+removed, and their next touch() returns False so the app can start over.
+
+Budgets can be set with CLAIM_SESSION_MEMORY_MB, CLAIM_TOTAL_MEMORY_MB and
+CLAIM_SPILL_THRESHOLD_MB, the idle time with CLAIM_SESSION_TTL_MIN.
+"""
+import atexit
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+MB = 1024 * 1024
+SESSION_BUDGET = int(os.environ.get('CLAIM_SESSION_MEMORY_MB', 256)) * MB
+TOTAL_BUDGET = int(os.environ.get('CLAIM_TOTAL_MEMORY_MB', 1024)) * MB
+SPILL_THRESHOLD = int(os.environ.get('CLAIM_SPILL_THRESHOLD_MB', 64)) * MB
+SESSION_TTL = float(os.environ.get('CLAIM_SESSION_TTL_MIN', 120)) * 60  # seconds
+SWEEP_INTERVAL = 60  # seconds between sweeps of idle sessions
+
+
+class StoredFrame:
+    """
+    Handle for a step DataFrame that is either in memory or spilled to disk.
+    Frames are treated as read-only once stored.
+    """
+
+    def __init__(self, store, session_id, key, df):
+        self._store = store
+        self.session_id = session_id
+        self.key = key
+        self.n_rows = len(df)
+        self.nbytes = _nbytes(df)
+        self.path = None
+        self.dtypes = getattr(df, 'dtypes', None)
+        self._df = df
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def in_memory(self):
+        return self._df is not None
+
+    def get(self):
+        """Returns the DataFrame, loading it from its spill file if needed"""
+        return self._store.load(self)
+
+
+class FrameStore:
+    """
+    Process-wide LRU of step DataFrames across sessions.
+    Args:
+        spill_dir (str): Directory for spill files (a temp dir removed at exit by default)
+        session_budget (int): In-memory bytes allowed per session
+        total_budget (int): In-memory bytes allowed across all sessions
+        spill_threshold (int): Frames larger than this are never kept in memory
+        session_ttl (float): Seconds after which an unseen session is swept
+    """
+
+    def __init__(self, spill_dir=None, session_budget=SESSION_BUDGET,
+                 total_budget=TOTAL_BUDGET, spill_threshold=SPILL_THRESHOLD,
+                 session_ttl=SESSION_TTL):
+        if spill_dir is None:
+            spill_dir = tempfile.mkdtemp(prefix='claim_spill_')
+            atexit.register(shutil.rmtree, spill_dir, ignore_errors=True)
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = spill_dir
+        self.session_budget = session_budget
+        self.total_budget = total_budget
+        self.spill_threshold = spill_threshold
+        self.session_ttl = session_ttl
+        self._handles = {}              # (session_id, key) -> StoredFrame
+        self._in_memory = OrderedDict()  # (session_id, key) -> StoredFrame, least recently used first
+        self._last_seen = {}            # session_id -> time of its last touch() or put()
+        self._swept = set()             # ids of swept sessions not seen since
+        self._swept_at = time.time()
+        self._lock = threading.RLock()
+
+    def put(self, session_id, key, df):
+        """
+        Stores a step result, replacing any earlier frame under the same key.
+        Returns:
+            StoredFrame: Handle to keep in st.session_state
+        """
+        with self._lock:
+            self._last_seen[session_id] = time.time()
+            self.discard(session_id, key)
+            handle = StoredFrame(self, session_id, key, df)
+            self._handles[(session_id, key)] = handle
+            if handle.nbytes > self.spill_threshold:
+                self._spill(handle)
+            else:
+                self._in_memory[(session_id, key)] = handle
+                self._enforce_budgets(session_id)
+            return handle
+
+    def load(self, handle):
+        with self._lock:
+            if handle.in_memory:
+                self._in_memory.move_to_end((handle.session_id, handle.key))
+                return handle._df
+            if not self.holds(handle):
+                raise KeyError(f"'{handle.key}' of session {handle.session_id} was discarded")
+            df = _read_spill_file(handle.path, handle.dtypes)
+            # Small frames come back into memory; large ones are re-read on every access
+            if handle.nbytes <= self.spill_threshold and self._handles.get(
+                    (handle.session_id, handle.key)) is handle:
+                handle._df = df
+                self._in_memory[(handle.session_id, handle.key)] = handle
+                self._enforce_budgets(handle.session_id)
+            return df
+
+    def discard(self, session_id, key):
+        with self._lock:
+            handle = self._handles.pop((session_id, key), None)
+            if handle is None:
+                return
+            self._in_memory.pop((session_id, key), None)
+            handle._df = None
+            if handle.path is not None and os.path.exists(handle.path):
+                os.remove(handle.path)
+
+    def holds(self, handle):
+        """True while handle is the current frame under its key (not replaced, discarded or swept)"""
+        return self._handles.get((handle.session_id, handle.key)) is handle
+
+    def touch(self, session_id):
+        """
+        Marks a session as active (call on every script run); sweeps idle sessions now and then.
+        Returns:
+            bool: False if the session's frames were swept since it was last seen
+        """
+        with self._lock:
+            now = time.time()
+            self._last_seen[session_id] = now
+            if now - self._swept_at > SWEEP_INTERVAL:
+                self.sweep(now)
+            if session_id in self._swept:
+                self._swept.discard(session_id)
+                return False
+            return True
+
+    def sweep(self, now=None):
+        """
+        Discards every frame of the sessions not seen for session_ttl seconds.
+        Returns:
+            list: Ids of the swept sessions
+        """
+        with self._lock:
+            now = time.time() if now is None else now
+            self._swept_at = now
+            idle = [session_id for session_id, seen in self._last_seen.items()
+                    if now - seen > self.session_ttl]
+            for session_id in idle:
+                for handle_session, key in [k for k in self._handles if k[0] == session_id]:
+                    self.discard(handle_session, key)
+                del self._last_seen[session_id]
+                self._swept.add(session_id)
+            return idle
+
+    def usage(self, session_id=None):
+        """
+        Returns:
+            dict: 'in_memory' and 'spilled' bytes, for one session or for all sessions
+        """
+        with self._lock:
+            handles = [h for h in self._handles.values()
+                       if session_id is None or h.session_id == session_id]
+            return {
+                'in_memory': sum(h.nbytes for h in handles if h.in_memory),
+                'spilled': sum(h.nbytes for h in handles if not h.in_memory),
+            }
+
+    def _enforce_budgets(self, session_id):
+        # Spill this session's least recently used frames until it fits its own budget ...
+        while self.usage(session_id)['in_memory'] > self.session_budget:
+            oldest = next(h for h in self._in_memory.values()
+                          if h.session_id == session_id)
+            self._spill(oldest)
+        # ... then the least recently used frames of any session until all fit together
+        while self.usage()['in_memory'] > self.total_budget:
+            self._spill(next(iter(self._in_memory.values())))
+
+    def _spill(self, handle):
+        self._in_memory.pop((handle.session_id, handle.key), None)
+        # Frames are read-only, so a spill file written earlier is still current
+        if handle.path is None:
+            handle.path = _write_spill_file(
+                handle._df, os.path.join(self.spill_dir, f"{handle.session_id}_{handle.key}"))
+        handle._df = None
+
+
+def _nbytes(obj):
+    """Memory held by a stored object: a DataFrame, bytes, or anything with an nbytes() method"""
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if hasattr(obj, 'memory_usage'):
+        return int(obj.memory_usage(deep=True).sum())
+    return int(obj.nbytes())
+
+
+def _write_spill_file(df, base_path):
+    """Writes Parquet, falling back to pickle for columns Parquet cannot hold (e.g. mixed types)
+    and for objects other than DataFrames"""
+    if hasattr(df, 'to_parquet'):
+        path = base_path + '.parquet'
+        try:
+            df.to_parquet(path)
+            return path
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+    path = base_path + '.pkl'
+    with open(path, 'wb') as f:
+        pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_spill_file(path, dtypes):
+    if not path.endswith('.parquet'):
+        # Unpickling a DataFrame imports pandas on demand
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    import pandas as pd
+
+    df = pd.read_parquet(path, memory_map=True)
+    # Parquet reads plain object columns back as strings; keep the dtypes callers saw
+    object_columns = [col for col, dtype in dtypes.items() if dtype == object]
+    if object_columns:
+        df = df.astype({col: object for col in object_columns})
+    return df
@@ -0,0 +1,91 @@
+"""
+Import-time and app start-up benchmark.
+
+Each module is imported in a fresh interpreter with `python -X importtime`, so the
+numbers are cold-start costs; the best of several runs is reported, along with
+whether the import pulled in pandas. The Streamlit app's landing page is then run
+headless (streamlit.testing) to time its first run and a rerun.
+
+Usage:
+    python import_benchmark.py
+    python import_benchmark.py --repeats 10 pipeline job_store
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MODULES = ['email_map', 'frame_store', 'job_store', 'preview', 'pipeline',
+           'S1_filter', 'S2_merge', 'S2_merge_unmatch_rows', 'S3_expand', 'batch_process']
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure_import(module, repeats=5):
+    """
+    Cold import time of one module.
+    Args:
+        module (str): Module name
+        repeats (int): Fresh interpreters to start; the fastest is kept
+    Returns:
+        tuple: (seconds, imports pandas)
+    """
+    best = None
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                              cwd=HERE, capture_output=True, text=True, check=True)
+        # Lines read "import time: self [us] | cumulative | imported package"
+        cumulative = {}
+        for line in proc.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative[fields[2].strip()] = int(fields[1])
+        seconds = cumulative[module] / 1e6
+        best = seconds if best is None else min(best, seconds)
+    return best, 'pandas' in cumulative
+
+
+def measure_app(reruns=5):
+    """
+    Times the Streamlit app's landing page.
+    Returns:
+        tuple: (first run seconds, fastest rerun seconds)
+    """
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(HERE, 'streamlit_app.py'), default_timeout=60)
+    start = time.perf_counter()
+    app.run()
+    first_run = time.perf_counter() - start
+    rerun = None
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        elapsed = time.perf_counter() - start
+        rerun = elapsed if rerun is None else min(rerun, elapsed)
+    return first_run, rerun
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure cold import and app start-up times.")
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help="Modules to import (default: all project modules)")
+    parser.add_argument('--repeats', type=int, default=5,
+                        help="Fresh interpreters per module; the fastest run is reported")
+    parser.add_argument('--no-app', action='store_true',
+                        help="Skip the Streamlit app measurement")
+    args = parser.parse_args()
+
+    print(f"{'module':<24}{'import (ms)':>12}  pandas")
+    for module in args.modules:
+        seconds, imports_pandas = measure_import(module, args.repeats)
+        print(f"{module:<24}{seconds * 1000:>12.1f}  {'yes' if imports_pandas else 'no'}")
+
+    if not args.no_app:
+        # Keep the benchmark's job and email databases out of the real ones
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.environ['CLAIM_JOB_DIR'] = tmp_dir
+            os.environ['CLAIM_EMAIL_MAP'] = os.path.join(tmp_dir, 'email_map.sqlite3')
+            first_run, rerun = measure_app()
+        print(f"streamlit_app first run: {first_run * 1000:.0f} ms, rerun: {rerun * 1000:.0f} ms")
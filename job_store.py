@@ -0,0 +1,503 @@
+"""
+Persistent local job queue and result store.
+
+Jobs are recorded in a SQLite database under JOB_DIR and executed by detached
+worker processes (`python job_store.py worker`), so a submitted merge or expansion
+keeps running when the Streamlit server restarts or the browser tab is closed.
+Inputs and results are pickled next to the database; any session can reattach
+to a job by its id and download the outputs later.
+
+Up to MAX_WORKERS workers run at once (CLAIM_JOB_WORKERS), each claiming one
+queued job at a time, so jobs from different sessions run in parallel. A worker
+takes a lease in the database before it starts; a session that submits a job
+reserves the spawn of another worker when queued jobs outnumber idle workers. A job
+whose worker dies MAX_ATTEMPTS times (e.g. killed for running out of memory) is
+marked failed instead of being retried forever, and finished jobs are removed,
+with their files, JOB_TTL seconds after they end (CLAIM_JOB_TTL_DAYS, default 7).
+
+Layout of JOB_DIR:
+    jobs.sqlite3          job table and worker heartbeats
+    <job id>/inputs.pkl   (args, kwargs) passed to the step function
+    <job id>/result.pkl   return value of the step function
+    worker.log            worker stdout/stderr
+"""
+import argparse
+import contextlib
+import importlib
+import os
+import pickle
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+JOB_DIR = os.environ.get('CLAIM_JOB_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'job_data'))
+
+# Step functions a job can run (pipeline function names, imported by the worker
+# only); each accepts a 'progress' keyword
+JOB_FUNCTIONS = {
+    'merge': 'merge_data',
+    'expand': 'expand_df_with_dates',
+    'expand_reports': 'expand_with_reports',
+    'export': 'export_data',
+    'export_zip': 'to_partitioned_zip',
+}
+
+HEARTBEAT_INTERVAL = 2      # seconds between worker heartbeats
+HEARTBEAT_TIMEOUT = 15      # a worker silent for longer is considered dead
+WORKER_IDLE_TIMEOUT = 600   # idle workers exit after this many seconds
+MAX_ATTEMPTS = 3            # runs of a job that may end with a dead worker
+MAX_WORKERS = int(os.environ.get('CLAIM_JOB_WORKERS', 4))  # workers running jobs at once
+JOB_TTL = float(os.environ.get('CLAIM_JOB_TTL_DAYS', 7)) * 24 * 3600  # seconds
+CLEANUP_INTERVAL = 3600     # seconds between a worker's cleanups of expired jobs
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    label TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    worker_pid INTEGER,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS workers (
+    pid INTEGER PRIMARY KEY,
+    heartbeat_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+# Handles of workers started from this process, kept so they can be reaped
+_spawned_workers = []
+
+
+class JobCancelled(Exception):
+    """Raised inside the worker when the user cancels the job."""
+
+
+class JobStore:
+    """
+    SQLite-backed job queue on local disk.
+    Args:
+        job_dir (str): Directory for the database, inputs and results
+    """
+
+    def __init__(self, job_dir=JOB_DIR):
+        self.job_dir = job_dir
+        os.makedirs(job_dir, exist_ok=True)
+        self.db_path = os.path.join(job_dir, 'jobs.sqlite3')
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            # Databases created before the attempt counter existed
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if 'attempts' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Autocommit connection; multi-statement updates use explicit transactions
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so check-then-update is atomic
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _job_path(self, job_id, file_name):
+        return os.path.join(self.job_dir, job_id, file_name)
+
+    # ----- Submitting and reading jobs -----
+
+    def submit(self, kind, *args, label='', **kwargs):
+        """
+        Queues a step for the worker.
+        Args:
+            kind (str): Key of JOB_FUNCTIONS
+            *args, **kwargs: Arguments for the step function
+            label (str): Free text shown in the job list
+        Returns:
+            str: Job id
+        """
+        if kind not in JOB_FUNCTIONS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex[:12]
+        os.makedirs(os.path.join(self.job_dir, job_id))
+        # Inputs are written before the row exists, so a worker never sees a job without them
+        _dump((args, kwargs), self._job_path(job_id, 'inputs.pkl'))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, label, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, kind, label, time.time()))
+        return job_id
+
+    def get(self, job_id):
+        """Returns the job row as a dict, or None for an unknown id"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def recent_jobs(self, limit=20):
+        """Returns the most recent jobs as dicts, newest first"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, kind, label, status, done, total, created_at, finished_at, error "
+                "FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_jobs(self, limit=20):
+        """Returns the most recent jobs as a DataFrame"""
+        import pandas as pd
+
+        jobs_df = pd.DataFrame(self.recent_jobs(limit), columns=[
+            'id', 'kind', 'label', 'status', 'done', 'total', 'created_at', 'finished_at', 'error'])
+        for col in ['created_at', 'finished_at']:
+            jobs_df[col] = pd.to_datetime(jobs_df[col], unit='s')
+        return jobs_df
+
+    def request_cancel(self, job_id):
+        with self._connect() as conn:
+            # Queued jobs are cancelled at once; running jobs stop at their next progress report
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id))
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+
+    def load_result(self, job_id):
+        """Returns the step function's return value for a finished job"""
+        return _load(self._job_path(job_id, 'result.pkl'))
+
+    # ----- Worker side -----
+
+    def heartbeat(self, pid):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (pid, heartbeat_at) VALUES (?, ?)", (pid, time.time()))
+
+    def live_worker_pids(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT pid FROM workers WHERE heartbeat_at > ?",
+                (time.time() - HEARTBEAT_TIMEOUT,)).fetchall()
+        return [row['pid'] for row in rows]
+
+    def acquire_worker_lease(self, pid, max_workers=MAX_WORKERS, spawn_id=None):
+        """
+        Registers pid as a worker unless max_workers other workers are alive.
+        Args:
+            pid (int): Worker process id
+            max_workers (int): Most workers alive at once
+            spawn_id (str): Reservation from reserve_spawn that started this worker
+        Returns:
+            bool: True if pid may run as a worker
+        """
+        with self._transaction() as conn:
+            if spawn_id is not None:
+                conn.execute("DELETE FROM settings WHERE name = ?", (f'spawn {spawn_id}',))
+            others = conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE heartbeat_at > ? AND pid != ?",
+                (time.time() - HEARTBEAT_TIMEOUT, pid)).fetchone()[0]
+            if others >= max_workers:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (pid, heartbeat_at) VALUES (?, ?)", (pid, time.time()))
+        return True
+
+    def reserve_spawn(self, max_workers=MAX_WORKERS):
+        """
+        Decides whether the caller should start a worker: only when queued (or orphaned)
+        jobs outnumber the idle workers (counting workers other sessions have started that may still be
+        coming up) and fewer than max_workers are alive or coming up.
+        Returns:
+            str: Spawn id to pass to the new worker, or None if no worker should be started
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            # A reservation whose worker never took its lease has expired
+            conn.execute("DELETE FROM settings WHERE name LIKE 'spawn %' AND value <= ?",
+                         (now - HEARTBEAT_TIMEOUT,))
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM settings WHERE name LIKE 'spawn %'").fetchone()[0]
+            live_pids = [row['pid'] for row in conn.execute(
+                "SELECT pid FROM workers WHERE heartbeat_at > ?", (now - HEARTBEAT_TIMEOUT,))]
+            busy = conn.execute(
+                f"SELECT COUNT(DISTINCT worker_pid) FROM jobs WHERE status = 'running' "
+                f"AND worker_pid IN ({','.join('?' * len(live_pids))})", live_pids).fetchone()[0]
+            # Jobs of dead workers are requeued by the next worker, so they count as queued
+            queued = conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status = 'queued' OR (status = 'running' "
+                f"AND worker_pid NOT IN ({','.join('?' * len(live_pids))}))", live_pids).fetchone()[0]
+            if len(live_pids) + pending >= max_workers or queued <= len(live_pids) - busy + pending:
+                return None
+            spawn_id = uuid.uuid4().hex[:12]
+            conn.execute("INSERT INTO settings (name, value) VALUES (?, ?)", (f'spawn {spawn_id}', now))
+        return spawn_id
+
+    def requeue_orphans(self):
+        """
+        Puts jobs whose worker has died back on the queue; they restart from the beginning.
+        A job that has already been started MAX_ATTEMPTS times is marked failed instead.
+        """
+        live_pids = self.live_worker_pids()
+        orphaned = "status = 'running'"
+        if live_pids:
+            orphaned += f" AND worker_pid NOT IN ({','.join('?' * len(live_pids))})"
+        with self._transaction() as conn:
+            conn.execute(
+                f"UPDATE jobs SET status = 'failed', finished_at = ?, error = ? "
+                f"WHERE {orphaned} AND attempts >= ?",
+                [time.time(), f"The worker stopped while running this job {MAX_ATTEMPTS} times "
+                              f"(e.g. out of memory); not retried"] + live_pids + [MAX_ATTEMPTS])
+            conn.execute(
+                f"UPDATE jobs SET status = 'queued', worker_pid = NULL, done = 0, total = 0 "
+                f"WHERE {orphaned}", live_pids)
+
+    def claim_next(self, pid):
+        """Atomically marks the oldest queued job as running; returns its id or None"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker_pid = ?, started_at = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (pid, time.time(), row['id']))
+        return row['id'] if row is not None else None
+
+    def cleanup(self, ttl=JOB_TTL):
+        """
+        Removes finished jobs older than ttl seconds with their inputs and results, and
+        job directories left without a job row (e.g. a submit that never completed).
+        Returns:
+            int: Number of jobs removed
+        """
+        cutoff = time.time() - ttl
+        with self._connect() as conn:
+            expired = [row['id'] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({','.join('?' * len(FINISHED_STATUSES))}) "
+                f"AND finished_at < ?", FINISHED_STATUSES + (cutoff,))]
+            for job_id in expired:
+                shutil.rmtree(os.path.join(self.job_dir, job_id), ignore_errors=True)
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            known = {row['id'] for row in conn.execute("SELECT id FROM jobs")}
+        for name in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, name)
+            if os.path.isdir(path) and name not in known and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        return len(expired)
+
+    def run_job(self, job_id):
+        """Runs a claimed job in this process and records the outcome"""
+        job = self.get(job_id)
+        args, kwargs = _load(self._job_path(job_id, 'inputs.pkl'))
+
+        with self._connect() as conn:
+            status, error = self._execute(conn, job_id, job['kind'], args, kwargs)
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id))
+        return status
+
+    def _execute(self, conn, job_id, kind, args, kwargs):
+        """Calls the step function, reporting progress through conn; returns (status, error)"""
+        def report(done, total):
+            row = conn.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row['cancel_requested']:
+                raise JobCancelled()
+            conn.execute(
+                "UPDATE jobs SET done = ?, total = ? WHERE id = ?", (done, total, job_id))
+
+        try:
+            step_function = getattr(importlib.import_module('pipeline'), JOB_FUNCTIONS[kind])
+            result = step_function(*args, progress=report, **kwargs)
+        except JobCancelled:
+            return 'cancelled', None
+        except Exception as e:
+            traceback.print_exc()
+            return 'failed', f"{type(e).__name__}: {e}"
+        _dump(result, self._job_path(job_id, 'result.pkl'))
+        return 'done', None
+
+
+def _dump(obj, path):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(path):
+    # Unpickling a DataFrame imports pandas on demand
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class PersistentJob:
+    """
+    Handle for a stored job, polled by the app for status, progress and the result.
+    Args:
+        store (JobStore): Store holding the job
+        job_id (str): Id returned by JobStore.submit
+    """
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+    def _row(self):
+        row = self.store.get(self.job_id)
+        if row is None:
+            raise KeyError(f"Unknown job id: {self.job_id}")
+        return row
+
+    def status(self):
+        return self._row()['status']
+
+    def progress(self):
+        """
+        Returns:
+            tuple: (done, total, eta_seconds) - eta_seconds is None until it can be estimated
+        """
+        row = self._row()
+        done, total, eta = row['done'], row['total'], None
+        if row['started_at'] and done and total:
+            elapsed = time.time() - row['started_at']
+            eta = elapsed * (total - done) / done
+        return done, total, eta
+
+    def cancel(self):
+        self.store.request_cancel(self.job_id)
+
+    def done(self):
+        return self.status() in ('done', 'failed', 'cancelled')
+
+    def cancelled(self):
+        return self.status() == 'cancelled'
+
+    def error(self):
+        row = self._row()
+        if row['status'] != 'failed':
+            return None
+        return RuntimeError(row['error'])
+
+    def result(self):
+        return self.store.load_result(self.job_id)
+
+
+def ensure_worker(job_dir=JOB_DIR):
+    """Starts a detached worker when queued jobs need one (see reserve_spawn); it outlives the calling process"""
+    # Reap workers started from this process that have since exited
+    for proc in list(_spawned_workers):
+        if proc.poll() is not None:
+            _spawned_workers.remove(proc)
+
+    store = JobStore(job_dir)
+    spawn_id = store.reserve_spawn()
+    if spawn_id is None:
+        return
+    log_file = open(os.path.join(job_dir, 'worker.log'), 'a')
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'worker', '--dir', job_dir,
+         '--spawn-id', spawn_id],
+        stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+    log_file.close()
+    _spawned_workers.append(proc)
+
+
+def run_worker(job_dir=JOB_DIR, idle_timeout=WORKER_IDLE_TIMEOUT, poll_interval=1.0,
+               max_workers=MAX_WORKERS, spawn_id=None):
+    """Worker loop: claims queued jobs one at a time until idle for idle_timeout seconds"""
+    store = JobStore(job_dir)
+    pid = os.getpid()
+    if not store.acquire_worker_lease(pid, max_workers, spawn_id):
+        print(f"{max_workers} workers are already running; exiting", flush=True)
+        return
+    # Exit through the finally block on SIGTERM; an interrupted job is requeued by the next worker
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    stop = threading.Event()
+
+    # Heartbeats come from a thread so long-running steps still look alive
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            store.heartbeat(pid)
+    threading.Thread(target=beat, daemon=True).start()
+
+    idle_since = time.time()
+    cleaned_at = 0
+    try:
+        while True:
+            if time.time() - cleaned_at > CLEANUP_INTERVAL:
+                store.cleanup()
+                cleaned_at = time.time()
+            store.requeue_orphans()
+            job_id = store.claim_next(pid)
+            if job_id is None:
+                if time.time() - idle_since > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+                continue
+            print(f"Running job {job_id}", flush=True)
+            status = store.run_job(job_id)
+            print(f"Job {job_id}: {status}", flush=True)
+            idle_since = time.time()
+    finally:
+        stop.set()
+        with store._connect() as conn:
+            conn.execute("DELETE FROM workers WHERE pid = ?", (pid,))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Teaching claim job queue")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help="Run queued jobs")
+    worker_parser.add_argument('--dir', default=JOB_DIR, help="Job directory")
+    worker_parser.add_argument('--idle-timeout', type=float, default=WORKER_IDLE_TIMEOUT,
+                               help="Exit after this many idle seconds")
+    worker_parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                               help="Exit at once if this many workers are already running")
+    worker_parser.add_argument('--spawn-id', default=None, help=argparse.SUPPRESS)
+    list_parser = subparsers.add_parser('list', help="Show recent jobs")
+    list_parser.add_argument('--dir', default=JOB_DIR, help="Job directory")
+    cleanup_parser = subparsers.add_parser('cleanup', help="Remove expired finished jobs")
+    cleanup_parser.add_argument('--dir', default=JOB_DIR, help="Job directory")
+    cleanup_parser.add_argument('--ttl-days', type=float, default=JOB_TTL / (24 * 3600),
+                                help="Remove jobs finished more than this many days ago")
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        run_worker(args.dir, args.idle_timeout, max_workers=args.max_workers,
+                   spawn_id=args.spawn_id)
+    elif args.command == 'cleanup':
+        print(f"Removed {JobStore(args.dir).cleanup(args.ttl_days * 24 * 3600)} jobs")
+    else:
+        print(JobStore(args.dir).list_jobs().to_string(index=False))
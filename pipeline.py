@@ -0,0 +1,2302 @@
+import datetime
+import fnmatch
+import hashlib
+import os
+import re
+import sys
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+# Steps never modify their input frames and make no defensive copies; selections
+# and assign() share data until written to. That is always the case from pandas 3;
+# pandas 2 needs copy-on-write switched on
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+
+###############################################
+#   STEP 1 FUNCTIONS  (Filter / Clean Data)   #
+#   - Filter by adjunct, clean + expand rows  #
+###############################################
+
+
+# Implementations of the filter, Day split and date expansion; 'polars' runs them as
+# lazy Polars queries and needs polars (see polars_backend.py)
+BACKENDS = ['pandas', 'polars']
+
+
+def backend_module(backend):
+    """polars_backend for 'polars', None for the pandas functions in this module"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}' (choose from {', '.join(BACKENDS)})")
+    if backend == 'pandas':
+        return None
+    import polars_backend
+    return polars_backend
+
+
+class ExclusionRules:
+    """
+    Class Section exceptions to the 2-letter rule, compiled once.
+    Each rule is an exact code ('TSP1'), a prefix ('TSP*') or a pattern with
+    * / ? wildcards ('?SP*1'); matching ignores case and surrounding spaces.
+    Exact codes and prefixes are hash lookups, so only the patterns are tried one by
+    one, and all rules are evaluated once per distinct Class Section, not per row.
+    Args:
+        rules (list): Rule strings; an ExclusionRules is passed through unchanged
+    """
+
+    def __init__(self, rules=None):
+        self.rules = []  # (rule, kind) in the order given
+        self._exact = {}  # code -> rule numbers
+        self._prefixes = {}  # prefix -> rule numbers
+        self._patterns = []  # (rule number, compiled regex)
+        for rule in dict.fromkeys(str(rule).strip().upper() for rule in rules or []):
+            if not rule:
+                continue
+            number = len(self.rules)
+            body = rule[:-1]
+            if not any(char in rule for char in '*?['):
+                kind = 'exact'
+                self._exact.setdefault(rule, []).append(number)
+            elif rule.endswith('*') and not any(char in body for char in '*?['):
+                kind = 'prefix'
+                self._prefixes.setdefault(body, []).append(number)
+            else:
+                kind = 'pattern'
+                self._patterns.append((number, re.compile(fnmatch.translate(rule))))
+            self.rules.append((rule, kind))
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._prefixes})
+
+    def __len__(self):
+        return len(self.rules)
+
+    def rules_matching(self, value):
+        """Numbers of the rules matching one Class Section"""
+        if pd.isna(value):
+            return []
+        value = str(value).strip().upper()
+        numbers = list(self._exact.get(value, []))
+        for length in self._prefix_lengths:
+            if length > len(value):
+                break
+            numbers += self._prefixes.get(value[:length], [])
+        numbers += [number for number, regex in self._patterns if regex.match(value)]
+        return numbers
+
+    def match(self, sections):
+        """
+        Args:
+            sections (pd.Series): Class Section values
+        Returns:
+            tuple: (np.ndarray bool mask of rows matched by any rule,
+                    np.ndarray of rows matched by each rule, in rule order)
+        """
+        codes, uniques = pd.factorize(sections.astype(object))
+        codes[codes < 0] = len(uniques)  # last slot: missing values
+        matched = np.zeros(len(uniques) + 1, dtype=bool)
+        hit_matrix = np.zeros((len(uniques) + 1, len(self.rules)), dtype=bool)
+        for position, value in enumerate(uniques):
+            numbers = self.rules_matching(value)
+            matched[position] = bool(numbers)
+            hit_matrix[position, numbers] = True
+        # Rows count once per distinct value instead of re-running the rules
+        value_counts = np.bincount(codes, minlength=len(uniques) + 1)
+        return matched[codes], value_counts @ hit_matrix
+
+
+def has_max_two_letters(value):
+    """Class Section with at most 2 letters (missing values do not pass)"""
+    if pd.isna(value):
+        return False  # Handle missing values
+    # Extract only alphabetic characters
+    letters = ''.join([char for char in str(value) if char.isalpha()])
+    return len(letters) <= 2
+
+
+def filter_data_with_hits(df, excluded_sections=None, backend='pandas'):
+    """
+    Step 1 filter with the hit count of each exclusion rule.
+    Args:
+        df (pd.DataFrame): Raw ASRQ180 export
+        excluded_sections (list or ExclusionRules): Class Section rules that bypass
+            the 2-letter rule (see ExclusionRules)
+        backend (str): Implementation, a key of BACKENDS
+    Returns:
+        tuple: (filtered_df, hits_df) - hits_df has one row per rule with its kind,
+            the adjunct rows it matched and the rows kept only because of it
+    """
+    if backend_module(backend) is not None:
+        return backend_module(backend).filter_data_with_hits(df, excluded_sections)
+    rules = excluded_sections if isinstance(excluded_sections, ExclusionRules) \
+        else ExclusionRules(excluded_sections)
+
+    # Filter rows containing "@adj.np.edu.sg" in Email (case insensitive)
+    email_filtered = df[df['Email'].str.contains(
+        '@adj.np.edu.sg', case=False, na=False)]
+
+    # Both rules are evaluated once per distinct Class Section
+    sections = email_filtered['Class Section']
+    codes, uniques = pd.factorize(sections.astype(object))
+    # dtype=bool keeps the mask boolean when there are no sections at all
+    two_letters = np.append(np.array([has_max_two_letters(value) for value in uniques], dtype=bool),
+                            False)[codes]
+    excluded, hits = rules.match(sections)
+    _, kept_hits = rules.match(sections[excluded & ~two_letters])
+
+    # Apply the Class Section filter, but include any sections marked for exclusion
+    filtered_df = email_filtered[two_letters | excluded]
+
+    hits_df = pd.DataFrame({
+        'Rule': [rule for rule, _ in rules.rules],
+        'Kind': [kind for _, kind in rules.rules],
+        'Rows matched': hits,
+        'Rows kept by rule': kept_hits,
+    })
+    return filtered_df, hits_df
+
+
+def filter_data(df, excluded_sections=None, backend='pandas'):
+    """Step 1: Filter data by adjunct and remove duplicates in ARSQ180"""
+    return filter_data_with_hits(df, excluded_sections, backend)[0]
+
+
+def expand_day_column(df, backend='pandas'):
+    if backend_module(backend) is not None:
+        return backend_module(backend).expand_day_column(df)
+    # Create a list to store the expanded rows
+    expanded_rows = []
+    #  Count rows with more than a single value: MON - SAT
+    multidays_count = 0
+    # Iterate over each row in the input DataFrame
+    for _, row in df.iterrows():
+        # Get the Day value and split it into individual days
+        day_value = str(row['Day'])
+        days = day_value.split()
+        # If there's only one day, just add the row as is
+        if len(days) <= 1:
+            expanded_rows.append(row.to_dict())
+        else:
+            # For each day, create a copy of the row with that single day
+            for day in days:
+                new_row = row.copy()
+                new_row['Day'] = day
+                expanded_rows.append(new_row.to_dict())
+            multidays_count += 1
+    # Create a new DataFrame from the expanded rows
+    expanded_df = compact_dtypes(pd.DataFrame(expanded_rows))
+    return multidays_count, expanded_df
+
+
+# Time formats found in ASRQ180 exports ('HH:MM' from the app, 'HH:MM:SS' from S1_filter.py)
+TIME_FORMATS = ['%H:%M', '%H:%M:%S']
+
+# Columns holding session times; carried as minutes since midnight (Int16)
+TIME_COLUMNS = ['Start Time', 'End Time']
+
+
+def parse_time(value):
+    """
+    Parses one 'Start Time' / 'End Time' value.
+    Args:
+        value: Text in one of TIME_FORMATS, or a time/datetime read from an Excel time cell
+    Returns:
+        datetime.time: Parsed time, or None if the value cannot be parsed
+    """
+    if isinstance(value, datetime.datetime):
+        return value.time()
+    if isinstance(value, datetime.time):
+        return value
+    if isinstance(value, str):
+        for time_format in TIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value.strip(), time_format).time()
+            except ValueError:
+                pass
+    return None
+
+
+def normalise_time_columns(df, columns):
+    """
+    Converts time columns to minutes since midnight, parsing each distinct value only once.
+    Args:
+        df (pd.DataFrame): Input DataFrame (not modified)
+        columns (list): Time columns to normalise
+    Returns:
+        tuple: (normalised_df, unparsable)
+            - normalised_df (pd.DataFrame): df with the columns as Int16 minutes;
+              unparsable values become missing
+            - unparsable (dict): Column -> list of distinct values that could not be parsed
+    """
+    minute_columns = {}
+    unparsable = {}
+    for col in columns:
+        # A timetable only has a few dozen distinct times, whatever the row count
+        codes, uniques = pd.factorize(df[col])
+        times = [parse_time(value) for value in uniques]
+        unparsable[col] = [value for value, time in zip(uniques, times) if time is None]
+        # The extra last entry is what missing values (code -1) map to
+        minutes = pd.array([time.hour * 60 + time.minute if time is not None else None
+                            for time in times] + [None], dtype='Int16')
+        minute_columns[col] = pd.Series(minutes[codes], index=df.index)
+    return df.assign(**minute_columns), unparsable
+
+
+def minutes_to_text(minutes):
+    """Formats a column of minutes since midnight as 'HH:MM:SS' text (missing stays missing)"""
+    codes, uniques = pd.factorize(minutes)
+    text = np.array([f"{value // 60:02d}:{value % 60:02d}:00" for value in uniques] + [np.nan],
+                    dtype=object)
+    return pd.Series(text[codes], index=minutes.index, name=minutes.name).infer_objects()
+
+
+def format_time_columns(df, columns):
+    """Formats time columns as 'HH:MM:SS' text (see normalise_time_columns); df is not modified"""
+    normalised_df = normalise_time_columns(df, columns)[0]
+    return normalised_df.assign(**{col: minutes_to_text(normalised_df[col]) for col in columns})
+
+
+###############################################
+#   STEP 2 FUNCTIONS  (Merge Data)            #
+#   - Match names/catalog between datasets    #
+###############################################
+
+
+# Hiring form columns used by the merge
+LOOKUP_REQUIRED_COLUMNS = ['Full Legal Name', 'Empl ID', 'Time entry code',
+                           'Position ID', 'Program ID', 'Requester Remarks']
+
+
+class LookupIndex:
+    """
+    Preprocessed hiring form used by merge_with_partial_match.
+    Holds only the required columns plus the upper-cased name tokens, so it can be
+    built once per hiring form and shared across merges and sessions.
+    Args:
+        lookup_df (pd.DataFrame): DataFrame from all_hiring_form.xlsx
+    """
+
+    def __init__(self, lookup_df):
+        missing = [
+            col for col in LOOKUP_REQUIRED_COLUMNS if col not in lookup_df.columns]
+        if missing:
+            raise ValueError(
+                f"Hiring form is missing required columns: {', '.join(missing)}")
+        # One dict per hiring form row, in file order (first match wins)
+        self.records = lookup_df[LOOKUP_REQUIRED_COLUMNS].to_dict('records')
+        # Uppercase name tokens; missing names never match
+        self.name_tokens = [
+            frozenset(str(record['Full Legal Name']).upper().split())
+            if not pd.isna(record['Full Legal Name']) else frozenset()
+            for record in self.records]
+
+        self._trigrams = None
+        self._rows_by_empl_id = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def nbytes(self):
+        """Approximate memory held by the index"""
+        total = sys.getsizeof(self.records) + sys.getsizeof(self.name_tokens)
+        for record, tokens in zip(self.records, self.name_tokens):
+            total += sys.getsizeof(record) + sys.getsizeof(tokens)
+            total += sum(sys.getsizeof(value) for value in record.values())
+            total += sum(sys.getsizeof(token) for token in tokens)
+        return total
+
+    def trigrams(self):
+        """
+        Trigram indexes over 'Full Legal Name' and 'Requester Remarks', built on first use
+        Returns:
+            tuple: (name TrigramIndex, remarks TrigramIndex)
+        """
+        if self._trigrams is None:
+            self._trigrams = (
+                TrigramIndex(record['Full Legal Name'] for record in self.records),
+                TrigramIndex(record['Requester Remarks'] for record in self.records))
+        return self._trigrams
+
+    def rows_by_empl_id(self):
+        """
+        Hash index of the hiring form rows of each lecturer, built on first use
+        Returns:
+            dict: Empl ID (see normalise_empl_id) -> row numbers in file order
+        """
+        if self._rows_by_empl_id is None:
+            self._rows_by_empl_id = {}
+            for row, record in enumerate(self.records):
+                empl_id = normalise_empl_id(record['Empl ID'])
+                if empl_id is not None:
+                    self._rows_by_empl_id.setdefault(empl_id, []).append(row)
+        return self._rows_by_empl_id
+
+
+def text_trigrams(value):
+    """
+    Distinct character trigrams of an upper-cased, space-padded text (none for missing values).
+    Underscores count as spaces, so "ACC_101" and "ACC 101" share their trigrams.
+    """
+    if pd.isna(value):
+        return set()
+    text = f"  {' '.join(str(value).upper().replace('_', ' ').split())} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """
+    Inverted index from character trigrams to the rows containing them.
+    A query only touches the rows sharing at least one trigram with it.
+    Args:
+        values (iterable): Text per row (missing values allowed)
+    """
+
+    def __init__(self, values):
+        gram_ids = {}
+        row_ids, row_grams = [], []
+        sizes = []
+        for row_id, value in enumerate(values):
+            grams = text_trigrams(value)
+            sizes.append(len(grams))
+            for gram in grams:
+                row_ids.append(row_id)
+                row_grams.append(gram_ids.setdefault(gram, len(gram_ids)))
+        self.gram_ids = gram_ids
+        self.sizes = np.array(sizes, dtype=np.int32)
+        # Postings of trigram g are rows[starts[g]:starts[g + 1]]
+        order = np.argsort(np.array(row_grams, dtype=np.int32), kind='stable')
+        self.rows = np.array(row_ids, dtype=np.int32)[order]
+        self.starts = np.searchsorted(
+            np.array(row_grams, dtype=np.int32)[order], np.arange(len(gram_ids) + 1))
+
+    def shared_counts(self, value):
+        """
+        Returns:
+            tuple: (rows, shared, query_size) - rows sharing trigrams with value, the
+                number of trigrams each shares, and the number of trigrams in value
+        """
+        query_grams = text_trigrams(value)
+        query_size = len(query_grams)
+        grams = [self.gram_ids[gram] for gram in query_grams if gram in self.gram_ids]
+        if not grams:
+            return np.array([], dtype=np.int32), np.array([], dtype=np.int64), query_size
+        postings = np.concatenate([self.rows[self.starts[g]:self.starts[g + 1]] for g in grams])
+        rows, shared = np.unique(postings, return_counts=True)
+        return rows, shared, query_size
+
+
+# Weight of the name similarity in suggestion scores; the rest goes to the catalog/remarks overlap
+SUGGESTION_NAME_WEIGHT = 0.75
+
+
+def suggest_matches(unmatched_df, lookup_df, top_n=3):
+    """
+    Ranks hiring form rows as candidates for rows the merge could not match.
+    Scores combine the trigram similarity (Jaccard) of 'Name' with 'Full Legal Name'
+    and the share of the 'Catalog Nbr' trigrams found in 'Requester Remarks'.
+    Args:
+        unmatched_df (pd.DataFrame): Unmatched rows from merge_with_partial_match
+        lookup_df (pd.DataFrame or LookupIndex): Hiring form, or a LookupIndex built from it
+        top_n (int): Candidates per row
+    Returns:
+        pd.DataFrame: Up to top_n rows per unmatched row ('Row' is its position in
+            unmatched_df), best first, with the candidate's hiring form fields and 'Score'
+    """
+    lookup_index = lookup_df if isinstance(lookup_df, LookupIndex) else LookupIndex(lookup_df)
+    name_index, remarks_index = lookup_index.trigrams()
+    columns = ['Row', 'Name', 'Catalog Nbr', 'Rank', 'Empl ID', 'Full Legal Name',
+               'Requester Remarks', 'Position ID', 'Program ID', 'Score']
+    if len(unmatched_df) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Rows with the same name and catalog share their candidates
+    keys = pd.MultiIndex.from_arrays(
+        [unmatched_df['Name'].astype(object), unmatched_df['Catalog Nbr'].astype(object)])
+    codes, uniques = pd.factorize(keys)
+    candidates = []
+    for name, catalog in uniques:
+        name_rows, shared, query_size = name_index.shared_counts(name)
+        union = query_size + name_index.sizes[name_rows] - shared
+        name_scores = SUGGESTION_NAME_WEIGHT * shared / np.maximum(union, 1)
+        remarks_rows, shared, query_size = remarks_index.shared_counts(catalog)
+        remarks_scores = (1 - SUGGESTION_NAME_WEIGHT) * shared / max(query_size, 1)
+        # Add up both parts per candidate row
+        rows, inverse = np.unique(np.concatenate([name_rows, remarks_rows]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([name_scores, remarks_scores]),
+                             minlength=len(rows))
+        # Best first; ties keep hiring form order
+        best = np.lexsort((rows, -scores))[:top_n]
+        candidates.append(list(zip(rows[best], scores[best])))
+
+    suggestions = []
+    for row_number, code in enumerate(codes):
+        name, catalog = uniques[code]
+        for rank, (lookup_row, score) in enumerate(candidates[code], start=1):
+            record = lookup_index.records[lookup_row]
+            suggestions.append({
+                'Row': row_number, 'Name': name, 'Catalog Nbr': catalog, 'Rank': rank,
+                'Empl ID': record['Empl ID'], 'Full Legal Name': record['Full Legal Name'],
+                'Requester Remarks': record['Requester Remarks'],
+                'Position ID': record['Position ID'], 'Program ID': record['Program ID'],
+                'Score': round(float(score), 3)})
+    return pd.DataFrame(suggestions, columns=columns)
+
+
+# Columns of the merged output
+MERGED_COLUMNS = [
+    'Empl ID',
+    'Full Legal Name',
+    'Time entry code',
+    'Date',  # Will be filled in Step 3
+    'Start Time',
+    'End Time',
+    'Position ID',
+    'Program ID',
+    'Comment',
+    'Day',
+    'Catalog Nbr',
+    'Name',
+    'Class Section'  # Added Class Section column
+]
+
+
+# Function to check if names are a partial match
+def is_partial_match(name1, name2, min_common_tokens=2):
+    # Convert to sets
+    set1 = set(name1)
+    set2 = set(name2)
+    # Handle empty sets
+    if not set1 or not set2:
+        return False
+    # Check if there are enough common tokens
+    common = set1.intersection(set2)
+    return len(common) >= min_common_tokens
+
+
+# Improved function to check if catalog number and requester remarks have a partial match
+def is_catalog_match(catalog, remarks):
+    # Handle NaN values
+    if pd.isna(catalog) or pd.isna(remarks):
+        return False
+    # Convert to strings and strip whitespace
+    catalog_str = str(catalog).strip().replace(' ', '')
+    remarks_str = str(remarks).strip()
+    # Check if one string contains the other
+    if (catalog_str in remarks_str) or (remarks_str in catalog_str):
+        return True
+    # Extract only alphabetic characters from catalog_str
+    catalog_alpha = ''.join([c for c in catalog_str if c.isalpha()])
+    if catalog_alpha and (catalog_alpha in remarks_str):
+        return True
+    # Additional check: see if any word in catalog_str is in remarks_str
+    catalog_words = catalog_str.split('_')
+    for word in catalog_words:
+        word_alpha = ''.join([c for c in word if c.isalpha()])
+        if word_alpha and word_alpha in remarks_str:
+            return True
+    return False
+
+
+def merge_with_partial_match(filtered_df, lookup_df, progress=None):
+    """
+    Merges two DataFrames based on partial name matching and catalog/remarks matching.
+    Args:
+        filtered_df (pd.DataFrame): DataFrame from filtered_results.xlsx
+        lookup_df (pd.DataFrame or LookupIndex): DataFrame from all_hiring_form.xlsx,
+            or a LookupIndex already built from it
+        progress (callable): Optional progress(done, total) callback, called as rows are processed
+    Returns:
+        tuple: (merged_df, unmatched_df, unmatched_count)
+            - merged_df (pd.DataFrame): Merged DataFrame with required columns
+            - unmatched_df (pd.DataFrame): DataFrame containing unmatched rows
+            - unmatched_count (int): Count of unmatched rows
+    """
+    if isinstance(lookup_df, LookupIndex):
+        lookup_index = lookup_df
+    else:
+        lookup_index = LookupIndex(lookup_df)
+
+    # Preprocess names for comparison - convert to uppercase and split into words
+    # (kept beside filtered_df, so the input is neither copied nor modified)
+    name_words = filtered_df['Name'].str.upper().str.split()
+
+    # Matched rows, collected as dicts and turned into a DataFrame once at the end
+    matched_rows = []
+
+    # Track unmatched rows
+    unmatched_count = 0
+    unmatched_rows = []  # Store unmatched rows here
+
+    total_rows = len(filtered_df)
+    report_every = max(1, total_rows // 100)
+
+    # Iterate through each row in filtered DataFrame
+    for row_number, ((_, filt_row), filt_name) in enumerate(
+            zip(filtered_df.iterrows(), name_words), start=1):
+        if progress is not None and row_number % report_every == 0:
+            progress(row_number, total_rows)
+        catalog_nbr = filt_row['Catalog Nbr'] if 'Catalog Nbr' in filt_row else None
+        match_found = False
+
+        # Iterate through each row of the hiring form in file order
+        for lookup_row, lookup_name in zip(lookup_index.records, lookup_index.name_tokens):
+            requester_remarks = lookup_row['Requester Remarks']
+
+            # Check for partial name match
+            name_match = is_partial_match(filt_name, lookup_name)
+            # Check for catalog/remarks match
+            catalog_match = is_catalog_match(catalog_nbr, requester_remarks)
+
+            # If both conditions are met, create a new row
+            if name_match and catalog_match:
+                # Create new row with required data including Class Section
+                new_row = {
+                    'Empl ID': lookup_row['Empl ID'],
+                    'Full Legal Name': lookup_row['Full Legal Name'],
+                    'Time entry code': lookup_row['Time entry code'],
+                    'Date': None,  # Will be filled in Step 3
+                    'Start Time': filt_row['Start Time'],
+                    'End Time': filt_row['End Time'],
+                    'Position ID': lookup_row['Position ID'],
+                    'Program ID': lookup_row['Program ID'],
+                    'Comment': lookup_row['Requester Remarks'],
+                    'Day': filt_row['Day'],
+                    'Catalog Nbr': filt_row['Catalog Nbr'],
+                    'Name': filt_row['Name'],
+                    # Added Class Section
+                    'Class Section': filt_row.get('Class Section', None)
+                }
+                matched_rows.append(new_row)
+                match_found = True
+                break  # Stop after first match
+
+        if not match_found:
+            unmatched_count += 1
+            # Store the original row; Class Section will be preserved if it exists
+            unmatched_rows.append(filt_row)
+
+    if progress is not None:
+        progress(total_rows, total_rows)
+
+    # Object columns, as appending rows to an empty frame gave; repeated text columns
+    # are carried as categoricals from here to the export
+    result_df = compact_dtypes(pd.DataFrame(matched_rows, columns=MERGED_COLUMNS).astype(object))
+
+    # Create DataFrame from unmatched rows
+    unmatched_df = compact_dtypes(pd.DataFrame(unmatched_rows))
+
+    # Return all three values: merged DataFrame, unmatched DataFrame, and unmatched count
+    return result_df, unmatched_df, unmatched_count
+
+
+def merge_with_sparse_scoring(filtered_df, lookup_df, progress=None, block_rows=5000):
+    """
+    Alternative merge engine that scores all name pairs at once instead of taking the first match.
+    Name tokens of both frames are encoded as sparse incidence matrices; one sparse product
+    gives the shared-token count of every (row, hiring form row) pair, and the catalog check
+    only runs on pairs sharing at least 2 tokens. Among the hiring form rows passing both
+    checks, the best name score wins (ties keep hiring form order).
+    Requires scipy.
+    Args:
+        filtered_df (pd.DataFrame): DataFrame from filtered_results.xlsx
+        lookup_df (pd.DataFrame or LookupIndex): Hiring form, or a LookupIndex built from it
+        progress (callable): Optional progress(done, total) callback, called per block of rows
+        block_rows (int): Rows of filtered_df scored per sparse product
+    Returns:
+        tuple: (merged_df, unmatched_df, unmatched_count) as merge_with_partial_match, with
+            two more merged_df columns: 'Match Score' (shared name tokens / all name tokens
+            of the pair) and 'Candidates' (hiring form rows passing both checks; above 1
+            the match is ambiguous)
+    """
+    try:
+        from scipy import sparse
+    except ImportError as e:
+        raise ImportError("The sparse merge engine requires scipy (pip install scipy)") from e
+
+    lookup_index = lookup_df if isinstance(lookup_df, LookupIndex) else LookupIndex(lookup_df)
+
+    # Hiring form incidence matrix; tokens found only in filtered_df can never be shared
+    vocabulary = {}
+    lookup_rows, lookup_cols = [], []
+    for row, tokens in enumerate(lookup_index.name_tokens):
+        for token in tokens:
+            lookup_rows.append(row)
+            lookup_cols.append(vocabulary.setdefault(token, len(vocabulary)))
+    lookup_matrix = sparse.csr_matrix(
+        (np.ones(len(lookup_rows), dtype=np.int32), (lookup_rows, lookup_cols)),
+        shape=(len(lookup_index), len(vocabulary))).T.tocsr()
+    lookup_sizes = np.array([len(tokens) for tokens in lookup_index.name_tokens])
+
+    names = filtered_df['Name'].astype(object)
+    name_tokens = [frozenset(str(name).upper().split()) if not pd.isna(name) else frozenset()
+                   for name in names]
+    name_sizes = np.array([len(tokens) for tokens in name_tokens])
+    filtered_rows, filtered_cols = [], []
+    for row, tokens in enumerate(name_tokens):
+        for token in tokens:
+            if token in vocabulary:
+                filtered_rows.append(row)
+                filtered_cols.append(vocabulary[token])
+    filtered_matrix = sparse.csr_matrix(
+        (np.ones(len(filtered_rows), dtype=np.int32), (filtered_rows, filtered_cols)),
+        shape=(len(name_tokens), len(vocabulary)))
+
+    # Shared-token counts, one block of rows at a time; keep pairs sharing at least 2 tokens
+    total_rows = len(name_tokens)
+    pair_rows, pair_lookup, pair_shared = [], [], []
+    for first in range(0, total_rows, block_rows):
+        shared = (filtered_matrix[first:first + block_rows] @ lookup_matrix).tocoo()
+        keep = shared.data >= 2
+        pair_rows.append(shared.row[keep] + first)
+        pair_lookup.append(shared.col[keep])
+        pair_shared.append(shared.data[keep])
+        if progress is not None:
+            progress(min(first + block_rows, total_rows), total_rows)
+    pair_rows = np.concatenate(pair_rows) if pair_rows else np.array([], dtype=np.int64)
+    pair_lookup = np.concatenate(pair_lookup) if pair_lookup else np.array([], dtype=np.int64)
+    pair_shared = np.concatenate(pair_shared) if pair_shared else np.array([], dtype=np.int64)
+
+    # Catalog check, once per distinct (Catalog Nbr, Requester Remarks) among those pairs
+    catalog_codes, catalogs = pd.factorize(
+        filtered_df['Catalog Nbr'].astype(object), use_na_sentinel=False)
+    remarks_codes, remarks = pd.factorize(
+        pd.Series([record['Requester Remarks'] for record in lookup_index.records], dtype=object),
+        use_na_sentinel=False)
+    pair_keys = catalog_codes[pair_rows].astype(np.int64) * len(remarks) + remarks_codes[pair_lookup]
+    unique_keys, key_codes = np.unique(pair_keys, return_inverse=True)
+    key_passed = np.array([
+        is_catalog_match(catalogs[key // len(remarks)], remarks[key % len(remarks)])
+        for key in unique_keys], dtype=bool)
+    passed = key_passed[key_codes] if len(pair_keys) else np.array([], dtype=bool)
+    pair_rows, pair_lookup, pair_shared = pair_rows[passed], pair_lookup[passed], pair_shared[passed]
+
+    # Best scoring hiring form row per row, first in file order on ties
+    scores = pair_shared / (name_sizes[pair_rows] + lookup_sizes[pair_lookup] - pair_shared)
+    order = np.lexsort((pair_lookup, -scores, pair_rows))
+    best = order[np.r_[True, pair_rows[order][1:] != pair_rows[order][:-1]]] if len(order) else order
+    matched_rows = pair_rows[best]
+    chosen = pair_lookup[best]
+    candidates = np.bincount(pair_rows, minlength=total_rows)
+
+    result_df = build_merged_rows(filtered_df, matched_rows, lookup_index, chosen).assign(**{
+        'Match Score': np.round(scores[best], 3),
+        'Candidates': candidates[matched_rows],
+    })
+
+    unmatched_mask = np.ones(total_rows, dtype=bool)
+    unmatched_mask[matched_rows] = False
+    unmatched_df = compact_dtypes(filtered_df[unmatched_mask])
+    return compact_dtypes(result_df), unmatched_df, int(unmatched_mask.sum())
+
+
+# Name-token join and catalog check of merge_with_partial_match as one query: pairs
+# sharing at least 2 name tokens, then is_catalog_match, then the first hiring form
+# row in file order for each row
+DUCKDB_MERGE_QUERY = """
+WITH pairs AS (
+    SELECT r.row_id, l.lookup_row
+    FROM row_tokens r JOIN lookup_tokens l ON r.token = l.token
+    GROUP BY r.row_id, l.lookup_row
+    HAVING count(*) >= 2
+)
+SELECT p.row_id, p.lookup_row
+FROM pairs p
+JOIN row_catalogs r ON r.row_id = p.row_id
+JOIN catalogs c ON c.catalog_id = r.catalog_id
+JOIN lookup_remarks m ON m.lookup_row = p.lookup_row
+WHERE contains(m.remarks, c.catalog)
+   OR contains(c.catalog, m.remarks)
+   OR (c.alpha <> '' AND contains(m.remarks, c.alpha))
+   OR EXISTS (SELECT 1 FROM catalog_words w
+              WHERE w.catalog_id = c.catalog_id AND contains(m.remarks, w.word))
+QUALIFY row_number() OVER (PARTITION BY p.row_id ORDER BY p.lookup_row) = 1
+ORDER BY p.row_id
+"""
+
+
+def merge_with_duckdb(filtered_df, lookup_df, progress=None):
+    """
+    Alternative merge engine running the matching of merge_with_partial_match as SQL
+    in an embedded (in-process) DuckDB database.
+    Name tokens of both frames are joined on the token and grouped, keeping pairs that
+    share at least 2 tokens; the catalog check is a SQL predicate over catalog texts
+    prepared as is_catalog_match prepares them, and a row number over hiring form order
+    keeps the first passing row, so the result is the same as merge_with_partial_match.
+    DuckDB runs the query on all cores and spills to disk when it runs out of memory.
+    Requires duckdb.
+    Args:
+        filtered_df (pd.DataFrame): DataFrame from filtered_results.xlsx
+        lookup_df (pd.DataFrame or LookupIndex): Hiring form, or a LookupIndex built from it
+        progress (callable): Optional progress(done, total) callback, called once at the end
+    Returns:
+        tuple: (merged_df, unmatched_df, unmatched_count) as merge_with_partial_match
+    """
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The duckdb merge engine requires duckdb (pip install duckdb)") from e
+
+    lookup_index = lookup_df if isinstance(lookup_df, LookupIndex) else LookupIndex(lookup_df)
+
+    # One row per (row, distinct name token); missing names never match
+    row_tokens = pd.DataFrame(
+        [(row, token)
+         for row, name in enumerate(filtered_df['Name'].astype(object))
+         if not pd.isna(name)
+         for token in set(str(name).upper().split())],
+        columns=['row_id', 'token'])
+    lookup_tokens = pd.DataFrame(
+        [(row, token) for row, tokens in enumerate(lookup_index.name_tokens) for token in tokens],
+        columns=['lookup_row', 'token'])
+
+    # Catalog and remarks texts as is_catalog_match compares them; missing values never match
+    catalog_codes, catalog_values = pd.factorize(filtered_df['Catalog Nbr'].astype(object))
+    catalog_texts = [str(catalog).strip().replace(' ', '') for catalog in catalog_values]
+    catalogs = pd.DataFrame({
+        'catalog_id': np.arange(len(catalog_texts)),
+        'catalog': pd.Series(catalog_texts, dtype=object),
+        'alpha': pd.Series([''.join(c for c in text if c.isalpha()) for text in catalog_texts],
+                           dtype=object),
+    })
+    catalog_words = pd.DataFrame(
+        [(catalog_id, word)
+         for catalog_id, text in enumerate(catalog_texts)
+         for word in {''.join(c for c in part if c.isalpha()) for part in text.split('_')}
+         if word],
+        columns=['catalog_id', 'word'])
+    row_catalogs = pd.DataFrame({'row_id': np.arange(len(filtered_df)), 'catalog_id': catalog_codes})
+    row_catalogs = row_catalogs[row_catalogs['catalog_id'] >= 0]
+    lookup_remarks = pd.DataFrame(
+        [(row, str(record['Requester Remarks']).strip())
+         for row, record in enumerate(lookup_index.records)
+         if not pd.isna(record['Requester Remarks'])],
+        columns=['lookup_row', 'remarks'])
+
+    with duckdb.connect() as connection:
+        for name, frame in [('row_tokens', row_tokens), ('lookup_tokens', lookup_tokens),
+                            ('catalogs', catalogs), ('catalog_words', catalog_words),
+                            ('row_catalogs', row_catalogs), ('lookup_remarks', lookup_remarks)]:
+            connection.register(name, frame)
+        matches = connection.execute(DUCKDB_MERGE_QUERY).df()
+    if progress is not None:
+        progress(len(filtered_df), len(filtered_df))
+
+    matched_rows = matches['row_id'].to_numpy(dtype=np.int64)
+    result_df = build_merged_rows(
+        filtered_df, matched_rows, lookup_index, matches['lookup_row'].to_numpy(dtype=np.int64))
+
+    unmatched_mask = np.ones(len(filtered_df), dtype=bool)
+    unmatched_mask[matched_rows] = False
+    unmatched_df = compact_dtypes(filtered_df[unmatched_mask])
+    return compact_dtypes(result_df), unmatched_df, int(unmatched_mask.sum())
+
+
+def build_merged_rows(filtered_df, positions, lookup_index, lookup_rows):
+    """
+    Builds merged rows column by column, as merge_with_partial_match does row by row.
+    Args:
+        filtered_df (pd.DataFrame): Rows being merged
+        positions (np.ndarray): Positions of the matched rows in filtered_df
+        lookup_index (LookupIndex): Hiring form
+        lookup_rows (np.ndarray): Hiring form row matched to each of those rows
+    Returns:
+        pd.DataFrame: MERGED_COLUMNS
+    """
+    matched = filtered_df.iloc[positions].reset_index(drop=True)
+    lookup_fields = {col: [lookup_index.records[row][col] for row in lookup_rows]
+                     for col in LOOKUP_REQUIRED_COLUMNS}
+    return pd.DataFrame({
+        'Empl ID': lookup_fields['Empl ID'],
+        'Full Legal Name': lookup_fields['Full Legal Name'],
+        'Time entry code': lookup_fields['Time entry code'],
+        'Date': None,  # Will be filled in Step 3
+        'Start Time': matched['Start Time'],
+        'End Time': matched['End Time'],
+        'Position ID': lookup_fields['Position ID'],
+        'Program ID': lookup_fields['Program ID'],
+        # object, as in the rows merge_with_partial_match builds (not one of CATEGORICAL_COLUMNS)
+        'Comment': pd.Series(lookup_fields['Requester Remarks'], dtype=object),
+        'Day': matched['Day'],
+        'Catalog Nbr': matched['Catalog Nbr'],
+        'Name': matched['Name'],
+        'Class Section': matched['Class Section'] if 'Class Section' in matched.columns else None,
+    }, columns=MERGED_COLUMNS)
+
+
+def normalise_email(value):
+    """Email as a mapping key: stripped and lower-cased (None when missing)"""
+    if pd.isna(value) or not str(value).strip():
+        return None
+    return str(value).strip().lower()
+
+
+def normalise_empl_id(value):
+    """
+    Empl ID as a mapping key: stripped text, with integral numbers written without
+    a fraction, so 10019, 10019.0 and '10019.0' (read from a float column) all give
+    '10019' (None when missing)
+    """
+    if pd.isna(value) or not str(value).strip():
+        return None
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return str(int(number)) if number.is_integer() and not text.isdigit() else text
+
+
+def merge_with_email_map(filtered_df, lookup_df, email_map, engine='first-match', progress=None):
+    """
+    Step 2 with a known Email -> Empl ID mapping as a fast path.
+    Rows whose email is mapped are joined to that lecturer's hiring form rows (first row
+    passing the catalog check, in file order); all other rows, and mapped rows whose
+    lecturer has no row for the catalog, go through the chosen engine.
+    Args:
+        filtered_df (pd.DataFrame): Step 1 output with an 'Email' column
+        lookup_df (pd.DataFrame or LookupIndex): Hiring form, or a LookupIndex built from it
+        email_map (dict): Normalised email -> Empl ID (see email_map.EmailMap)
+        engine (str): Key of MERGE_ENGINES for the remaining rows
+        progress (callable): Optional progress(done, total) callback, from the engine
+    Returns:
+        tuple: (merged_df, unmatched_df, unmatched_count) as the engine, in filtered_df
+            row order, with two more merged_df columns: 'Email' and 'Matched By'
+            ('email' or the engine name)
+    """
+    lookup_index = lookup_df if isinstance(lookup_df, LookupIndex) else LookupIndex(lookup_df)
+    rows_by_empl_id = lookup_index.rows_by_empl_id()
+    emails = [normalise_email(email) for email in filtered_df['Email'].astype(object)]
+    catalogs = filtered_df['Catalog Nbr'].astype(object).to_numpy()
+
+    # Hash join on the email, then the lecturer's first row for the catalog
+    joined = {}
+    fast_positions, fast_rows = [], []
+    for position, (email, catalog) in enumerate(zip(emails, catalogs)):
+        empl_id = normalise_empl_id(email_map.get(email)) if email is not None else None
+        if empl_id is None:
+            continue
+        key = (empl_id, catalog)
+        if key not in joined:
+            joined[key] = next(
+                (row for row in rows_by_empl_id.get(empl_id, [])
+                 if is_catalog_match(catalog, lookup_index.records[row]['Requester Remarks'])),
+                None)
+        if joined[key] is not None:
+            fast_positions.append(position)
+            fast_rows.append(joined[key])
+    fast_positions = np.array(fast_positions, dtype=np.int64)
+    fast_df = compact_dtypes(build_merged_rows(
+        filtered_df, fast_positions, lookup_index, fast_rows))
+
+    # Everything else goes through the engine
+    rest_positions = np.setdiff1d(np.arange(len(filtered_df)), fast_positions)
+    rest_df = filtered_df.iloc[rest_positions].reset_index(drop=True)
+    engine_df, unmatched_df, unmatched_count = merge_data(rest_df, lookup_index, engine, progress)
+    # Engines keep row order and return unmatched rows with their row labels
+    unmatched_positions = rest_positions[unmatched_df.index.to_numpy(dtype=np.int64)]
+    unmatched_df = unmatched_df.set_axis(filtered_df.index[unmatched_positions])
+    engine_positions = np.setdiff1d(rest_positions, unmatched_positions)
+
+    emails = np.array(emails, dtype=object)
+    parts = [
+        fast_df.assign(**{'Email': emails[fast_positions], 'Matched By': 'email'}),
+        engine_df.assign(**{'Email': emails[engine_positions], 'Matched By': engine}),
+    ]
+    # An empty part would turn integer columns such as 'Empl ID' into floats
+    merged_df = pd.concat([part for part in parts if len(part)] or parts[1:], ignore_index=True)
+    order = np.argsort(np.concatenate([fast_positions, engine_positions]), kind='stable')
+    merged_df = compact_dtypes(merged_df.iloc[order].reset_index(drop=True))
+    return merged_df, unmatched_df, unmatched_count
+
+
+def confirmed_email_matches(merged_df):
+    """
+    Email -> Empl ID pairs to learn from a merge done with merge_with_email_map.
+    Only name/catalog matches count, only unambiguous ones when the engine reports
+    'Candidates', and only emails that matched a single Empl ID.
+    Returns:
+        dict: Normalised email -> Empl ID (see normalise_empl_id)
+    """
+    return unique_email_pairs(confirmed_email_pairs(merged_df))
+
+
+def confirmed_email_pairs(merged_df):
+    """Distinct (email, Empl ID) pairs of the confirmed matches, before dropping ambiguous emails"""
+    if 'Matched By' not in merged_df.columns:
+        return pd.DataFrame(columns=['email', 'empl_id'])
+    confirmed = merged_df['Matched By'].astype(object) != 'email'
+    if 'Candidates' in merged_df.columns:
+        confirmed &= merged_df['Candidates'] == 1
+    return pd.DataFrame({
+        'email': merged_df['Email'].astype(object)[confirmed],
+        'empl_id': merged_df['Empl ID'].astype(object)[confirmed].map(normalise_empl_id),
+    }).dropna().drop_duplicates()
+
+
+def unique_email_pairs(pairs):
+    """Email -> Empl ID for the emails of pairs (see confirmed_email_pairs) with a single Empl ID"""
+    unique_pairs = pairs.drop_duplicates().drop_duplicates('email', keep=False)
+    return dict(zip(unique_pairs['email'], unique_pairs['empl_id']))
+
+
+# Merge engines selectable in the app and batch_process.py
+MERGE_ENGINES = {
+    'first-match': merge_with_partial_match,
+    'sparse': merge_with_sparse_scoring,
+    'duckdb': merge_with_duckdb,
+}
+# Optional module each engine needs (see requirements-optional.txt)
+MERGE_ENGINE_MODULES = {
+    'sparse': 'scipy',
+    'duckdb': 'duckdb',
+}
+
+
+def merge_data(filtered_df, lookup_df, engine='first-match', progress=None, email_map=None):
+    """
+    Step 2 with the chosen engine (a key of MERGE_ENGINES).
+    With an email_map (even an empty one) known emails take the fast path of
+    merge_with_email_map, and the output carries what confirmed_email_matches learns from.
+    Returns:
+        tuple: (merged_df, unmatched_df, unmatched_count)
+    """
+    if engine not in MERGE_ENGINES:
+        raise ValueError(
+            f"Unknown merge engine '{engine}' (choose from {', '.join(MERGE_ENGINES)})")
+    if email_map is not None and 'Email' in filtered_df.columns:
+        return merge_with_email_map(filtered_df, lookup_df, email_map, engine, progress)
+    return MERGE_ENGINES[engine](filtered_df, lookup_df, progress=progress)
+
+
+###############################################
+#   STEP 3 FUNCTIONS  (Date Expansion)        #
+#   - Map weekdays to dates & expand dataset  #
+###############################################
+
+
+def map_dates_to_weeks(schedule_dict):
+    week_mapping = {}
+    for day, dates in schedule_dict.items():
+        for index, date in enumerate(dates):
+            week_number = f"Week {index + 1}"
+            week_mapping[date] = week_number
+    return week_mapping
+
+
+def create_weekday_date_dict(start_date_str, end_date_str):
+    """
+    Creates a dictionary mapping weekdays (Mon-Sat) to dates within a specified range.
+    Args:
+        start_date_str (str): Start date in format "DD Month YYYY" (e.g., "21 April 2025")
+        end_date_str (str): End date in format "DD Month YYYY" (e.g., "23 August 2025")
+    Returns:
+        dict: Dictionary with keys 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'
+              and values as lists of dates in "YYYY-MM-DD" format
+    """
+    # Parse input dates
+    start_date = datetime.datetime.strptime(start_date_str, "%d %B %Y").date()
+    end_date = datetime.datetime.strptime(end_date_str, "%d %B %Y").date()
+
+    # Initialize weekday dictionary
+    weekday_dict = {
+        'Mon': [], 'Tue': [], 'Wed': [],
+        'Thu': [], 'Fri': [], 'Sat': []
+    }
+
+    # Iterate through each date in the range
+    current_date = start_date
+    while current_date <= end_date:
+        # Get weekday (0=Monday, 6=Sunday)
+        weekday_num = current_date.weekday()
+        # Skip Sundays (6)
+        if weekday_num < 6:
+            # Map weekday number to dictionary key
+            weekday_key = ['Mon', 'Tue', 'Wed',
+                           'Thu', 'Fri', 'Sat'][weekday_num]
+            # Add date in YYYY-MM-DD format
+            weekday_dict[weekday_key].append(current_date.strftime("%Y-%m-%d"))
+        # Move to next day
+        current_date += datetime.timedelta(days=1)
+
+    return weekday_dict
+
+
+# Weekday keys used by the 'Day' column after standardisation
+VALID_DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat']
+
+# Column order of the Step 3 output
+FINAL_COLUMN_ORDER = [
+    'Empl ID',
+    'Full Legal Name',
+    'Name',
+    'Time entry code',
+    'Date',
+    'Day',
+    'Week Number',
+    'Start Time',
+    'End Time',
+    'Position ID',
+    'Program ID',
+    'Class Section',
+    'Catalog Nbr',
+    'Comment'
+]
+
+
+def parse_day_keys(day_value):
+    """
+    Standardises a 'Day' value into weekday keys.
+    Args:
+        day_value: Value of the 'Day' column (e.g. "MON", "tue thu")
+    Returns:
+        list: Unique weekday keys in order (e.g. ['Tue', 'Thu']), or None if the row
+              must be skipped (empty value or any part that is not Mon-Sat)
+    """
+    day_str = str(day_value).strip()
+    # Skip if empty
+    if not day_str:
+        return None
+    day_keys = []
+    for part in day_str.split():
+        # Capitalize first letter only (e.g., "MON" -> "Mon", "tue" -> "Tue")
+        standardized = part.capitalize()
+        if standardized not in VALID_DAYS:
+            return None
+        # Add to day_keys if not already present (to avoid duplicates)
+        if standardized not in day_keys:
+            day_keys.append(standardized)
+    return day_keys
+
+
+# Estimated size above which expand_df_with_dates keeps the output factorised
+# instead of building it as one DataFrame (CLAIM_EXPANSION_LIMIT_MB, default 512)
+EXPANSION_MEMORY_LIMIT = int(os.environ.get('CLAIM_EXPANSION_LIMIT_MB', 512)) * 1024 * 1024
+
+
+def clean_program_ids(values):
+    """
+    Keeps the first word of each Program ID (e.g. "NPO_PR0202 (ACC)" -> "NPO_PR0202").
+    Missing values stay missing (also when all are missing) and blank ones become ''.
+    """
+    values = values.astype(object)
+    return values.where(values.isna(), values.map(
+        lambda value: str(value).split()[0] if str(value).split() else ''))
+
+
+def order_expanded_columns(columns):
+    """Orders Step 3 output columns as FINAL_COLUMN_ORDER, with 'Date' and 'Week Number' after 'Day'"""
+    cols = [col for col in FINAL_COLUMN_ORDER if col in columns]
+    if 'Day' in cols and 'Date' in cols:
+        day_index = cols.index('Day')
+        cols.remove('Date')
+        cols.insert(day_index + 1, 'Date')
+    return cols
+
+
+class LazyExpansion:
+    """
+    Step 3 expansion that is only materialised on request.
+    The exact output size and the first rows are available without building the
+    rows x dates product; the full output can be built at once, in chunks, or
+    kept in factorised form (see factorise()).
+    Args:
+        merged_df (pd.DataFrame): Step 2 output with 'Day' column (not modified)
+        start_date_str (str): Start date in format "DD Month YYYY"
+        end_date_str (str): End date in format "DD Month YYYY"
+    """
+
+    def __init__(self, merged_df, start_date_str, end_date_str):
+        weekday_date_dict = create_weekday_date_dict(
+            start_date_str, end_date_str)
+
+        # Calendar: one entry per date, grouped by weekday so each weekday is a contiguous range.
+        # The week number is the date's position among the same weekdays (see map_dates_to_weeks)
+        self.calendar = pd.DataFrame(
+            [(date, week, key) for key in VALID_DAYS
+             for week, date in enumerate(weekday_date_dict[key], start=1)],
+            columns=['Date', 'Week Number', 'Day key'])
+        self.calendar['Date'] = pd.to_datetime(self.calendar['Date'], format='%Y-%m-%d')
+        self.calendar['Week Number'] = self.calendar['Week Number'].astype(np.int16)
+        day_ranges = {}
+        start = 0
+        for key in VALID_DAYS:
+            day_ranges[key] = np.arange(
+                start, start + len(weekday_date_dict[key]), dtype=np.int16)
+            start += len(weekday_date_dict[key])
+
+        # Parse each distinct Day value once into the calendar entries one row expands to
+        day_codes, day_values = pd.factorize(
+            merged_df['Day'], use_na_sentinel=False)
+        day_keys = [parse_day_keys(value) for value in day_values]
+        self._patterns = [
+            np.concatenate([day_ranges[key] for key in keys] + [np.array([], dtype=np.int16)])
+            for keys in (keys or [] for keys in day_keys)]
+        pattern_lengths = np.array(
+            [len(pattern) for pattern in self._patterns], dtype=np.int64)
+
+        valid_codes = np.array([keys is not None for keys in day_keys], dtype=bool)
+        self._day_keys = day_keys
+        self._dates_per_day = {key: len(weekday_date_dict[key]) for key in VALID_DAYS}
+        self._row_codes = day_codes
+        self.valid_positions = np.flatnonzero(valid_codes[day_codes])
+        self.skipped_rows = len(merged_df) - len(self.valid_positions)
+        # offsets[i] is the first output row of the i-th valid merged row
+        row_lengths = pattern_lengths[day_codes[self.valid_positions]]
+        self.offsets = np.concatenate([[0], np.cumsum(row_lengths)])
+
+        # Merged rows as they appear in the output, stored once
+        # (assign returns a new frame, so merged_df is never modified)
+        self.base = compact_dtypes(merged_df).assign(**{
+            'Program ID': clean_program_ids(merged_df['Program ID']).astype('category')})
+        # Comment is "<week>_<day key>_<catalog>_<class section>_<full legal name>", upper-cased;
+        # everything after the day key depends on the merged row only
+        self.comment_suffix = np.array(
+            [f"_{str(catalog).strip()}_{section}_{name}" for catalog, section, name in zip(
+                merged_df['Catalog Nbr'], merged_df['Class Section'], merged_df['Full Legal Name'])],
+            dtype=object)
+        self.columns = order_expanded_columns(
+            list(self.base.columns) + ['Date', 'Week Number', 'Comment'])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def nbytes(self):
+        """Memory held by the plan (merged rows, calendar and row arrays), not the output"""
+        return int(self.base.memory_usage(deep=True).sum()
+                   + self.calendar.memory_usage(deep=True).sum()
+                   + self.offsets.nbytes + self.valid_positions.nbytes + self._row_codes.nbytes
+                   + sum(sys.getsizeof(suffix) for suffix in self.comment_suffix))
+
+    def rows_per_day(self):
+        """
+        Output rows per weekday: rows with the day key times the dates of that weekday.
+        Returns:
+            dict: Weekday key -> output rows; the values add up to len(self)
+        """
+        code_counts = np.bincount(self._row_codes[self.valid_positions],
+                                  minlength=len(self._day_keys))
+        rows = dict.fromkeys(VALID_DAYS, 0)
+        for keys, count in zip(self._day_keys, code_counts):
+            for key in keys or []:
+                rows[key] += int(count) * self._dates_per_day[key]
+        return rows
+
+    def estimated_nbytes(self, sample_rows=1000):
+        """
+        Estimated memory of the materialised output, from the first sample_rows rows:
+        categorical columns cost their codes per row plus their categories once,
+        other columns their average size per row.
+        """
+        if len(self) == 0:
+            return 0
+        sample = self.head(sample_rows)
+        per_row, fixed = 0.0, 0
+        for col in sample.columns:
+            values = sample[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                per_row += values.cat.codes.dtype.itemsize
+                fixed += int(values.cat.categories.memory_usage(deep=True))
+            else:
+                per_row += values.memory_usage(index=False, deep=True) / len(sample)
+        return int(fixed + per_row * len(self))
+
+    def build_rows(self, row_ids, calendar_ids):
+        """Builds output rows from (merged row position, calendar index) pairs"""
+        expanded = self.base.iloc[row_ids].reset_index(drop=True)
+        expanded['Date'] = self.calendar['Date'].to_numpy()[calendar_ids]
+        expanded['Week Number'] = self.calendar['Week Number'].to_numpy()[calendar_ids]
+        expanded['Comment'] = self.comments(row_ids, calendar_ids)
+        return expanded[self.columns]
+
+    def comments(self, row_ids, calendar_ids):
+        """'Comment' values of output rows, without building the rest of the rows"""
+        weeks = self.calendar['Week Number'].to_numpy()[calendar_ids]
+        keys = self.calendar['Day key'].to_numpy()[calendar_ids]
+        return [f"WEEK {week}_{key}{suffix}".upper() for week, key, suffix in zip(
+            weeks, keys, self.comment_suffix[row_ids])]
+
+    def _ids(self, first, last):
+        """(row ids, calendar ids) of the output rows of valid merged rows [first, last)"""
+        positions = self.valid_positions[first:last]
+        lengths = np.diff(self.offsets[first:last + 1])
+        row_ids = np.repeat(positions, lengths).astype(np.int32)
+        calendar_ids = np.concatenate(
+            [self._patterns[code] for code in self._row_codes[positions]] + [np.array([], dtype=np.int16)])
+        return row_ids, calendar_ids
+
+    def head(self, n=1000):
+        """Returns the first n output rows, building only the merged rows they come from"""
+        last = int(np.searchsorted(self.offsets, n, side='left'))
+        last = min(last, len(self.valid_positions))
+        row_ids, calendar_ids = self._ids(0, last)
+        return self.build_rows(row_ids[:n], calendar_ids[:n])
+
+    def iter_chunks(self, chunk_rows=50000):
+        """Yields the output in consecutive DataFrames of about chunk_rows rows each"""
+        first = 0
+        n_valid = len(self.valid_positions)
+        while first < n_valid:
+            target = self.offsets[first] + chunk_rows
+            last = max(first + 1, int(np.searchsorted(self.offsets, target, side='right')) - 1)
+            last = min(last, n_valid)
+            # Rows whose days fall outside the range add nothing
+            if self.offsets[last] > self.offsets[first]:
+                chunk = self.build_rows(*self._ids(first, last))
+                chunk.index = pd.RangeIndex(self.offsets[first], self.offsets[last])
+                yield chunk
+            first = last
+
+    def materialize(self, progress=None, chunk_rows=50000):
+        """
+        Builds the full output.
+        Args:
+            progress (callable): Optional progress(done, total) callback, in output rows
+            chunk_rows (int): Rows built per step between progress reports
+        Returns:
+            pd.DataFrame: Same result as expand_df_with_dates
+        """
+        if len(self) == 0:
+            return pd.DataFrame()
+        chunks = []
+        for chunk in self.iter_chunks(chunk_rows):
+            chunks.append(chunk)
+            if progress is not None:
+                progress(int(chunk.index[-1]) + 1, len(self))
+        # Chunks share the categories of self.base, so they stay categorical
+        return pd.concat(chunks, ignore_index=True)
+
+    def factorise(self):
+        """Returns the full output as a FactorisedExpansion (merged rows once + id pairs)"""
+        return FactorisedExpansion(self, *self._ids(0, len(self.valid_positions)))
+
+
+class FactorisedExpansion:
+    """
+    Compact Step 3 output: the merged rows stored once plus one
+    (int32 merged row id, int16 calendar index) pair per output row.
+    'Date', 'Week Number' and 'Comment' are derived on demand; previews and
+    exporters take rows or chunks from it instead of a full DataFrame.
+    Args:
+        expansion (LazyExpansion): Expansion holding the merged rows and calendar
+        row_ids (np.ndarray): int32 merged row position of each output row
+        calendar_ids (np.ndarray): int16 calendar index of each output row
+    """
+
+    def __init__(self, expansion, row_ids, calendar_ids):
+        self._expansion = expansion
+        self.row_ids = row_ids
+        self.calendar_ids = calendar_ids
+        self.columns = expansion.columns
+        self.skipped_rows = expansion.skipped_rows
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def nbytes(self):
+        """Memory held: merged rows, calendar and the id pairs"""
+        return int(self._expansion.base.memory_usage(deep=True).sum()
+                   + self._expansion.calendar.memory_usage(deep=True).sum()
+                   + self.row_ids.nbytes + self.calendar_ids.nbytes)
+
+    def __getitem__(self, col):
+        """Full output column as a Series, derived on demand"""
+        if col in ('Date', 'Week Number'):
+            return pd.Series(self._expansion.calendar[col].to_numpy()[self.calendar_ids], name=col)
+        if col == 'Comment':
+            return pd.Series(self._expansion.comments(self.row_ids, self.calendar_ids), name=col)
+        return self._expansion.base[col].iloc[self.row_ids].reset_index(drop=True)
+
+    def column_stats(self, col):
+        """
+        Summary of an output column, computed from the merged rows or the calendar
+        weighted by the id pairs, so the full column is never built.
+        Returns:
+            tuple: (non-empty values, distinct non-empty values, first non-empty value)
+        """
+        if len(self) == 0:
+            return 0, 0, None
+        if col == 'Comment':
+            # Never empty; one distinct comment per (upper-cased suffix, calendar entry) pair
+            suffix_codes = pd.factorize(pd.Series(self._expansion.comment_suffix).str.upper())[0]
+            pairs = (suffix_codes[self.row_ids].astype(np.int64) * len(self._expansion.calendar)
+                     + self.calendar_ids)
+            return len(self), len(np.unique(pairs)), self._expansion.comments(
+                self.row_ids[:1], self.calendar_ids[:1])[0]
+        if col in ('Date', 'Week Number'):
+            values, ids = self._expansion.calendar[col], self.calendar_ids
+        else:
+            values, ids = self._expansion.base[col], self.row_ids
+        # Output rows taken from each merged row or calendar entry
+        uses = np.bincount(ids, minlength=len(values))
+        present = values.notna().to_numpy()
+        non_empty = int(uses[present].sum())
+        if non_empty == 0:
+            return 0, 0, None
+        distinct = values[(uses > 0) & present].nunique()
+        first = ids[np.argmax(present[ids])]
+        return non_empty, distinct, values.iloc[first]
+
+    def take(self, positions):
+        """Output rows at the given positions, as a DataFrame"""
+        rows = self._expansion.build_rows(
+            self.row_ids[positions], self.calendar_ids[positions])
+        rows.index = pd.RangeIndex(len(self))[positions]
+        return rows
+
+    def iter_chunks(self, chunk_rows=50000):
+        """Yields the output in consecutive DataFrames of chunk_rows rows"""
+        for start in range(0, len(self), chunk_rows):
+            yield self.take(np.arange(start, min(start + chunk_rows, len(self))))
+
+    def to_frame(self):
+        """Materialises the full output (same as expand_df_with_dates)"""
+        return self._expansion.materialize()
+
+
+def expand_df_with_dates(merged_df, start_date_str, end_date_str, progress=None,
+                         memory_limit=EXPANSION_MEMORY_LIMIT, backend='pandas'):
+    """
+    Step 3: Expands DataFrame by duplicating rows for each date in the 'Day' column.
+    Skips rows with invalid day entries.
+    The exact output size is known before any row is built; when the estimated
+    memory of the result exceeds memory_limit, it is returned as a
+    FactorisedExpansion, which the exporters write chunk by chunk.
+    Args:
+        merged_df (pd.DataFrame): Input DataFrame with 'Day' column (not modified)
+        start_date_str (str): Start date in format "DD Month YYYY"
+        end_date_str (str): End date in format "DD Month YYYY"
+        progress (callable): Optional progress(done, total) callback, called as rows are built
+        memory_limit (int): Bytes above which the output is not materialised (None: no limit)
+        backend (str): Implementation of the materialised expansion, a key of BACKENDS
+    Returns:
+        tuple: (expanded, skipped_rows), where expanded is one of
+            - pd.DataFrame, when the estimated size is within memory_limit: text
+              columns are categoricals, 'Date' is datetime64 and 'Week Number' an
+              int16 (see format_for_export)
+            - FactorisedExpansion, above memory_limit: the same rows, not built; it
+              has len(), columns, [col], take() and iter_chunks(), and to_frame()
+              builds the DataFrame. The exporters, iter_row_chunks, hours_summary and
+              detect_clashes take either type.
+    """
+    module = backend_module(backend)
+    expansion = LazyExpansion(merged_df, start_date_str, end_date_str)
+    if memory_limit is not None and expansion.estimated_nbytes() > memory_limit:
+        if progress is not None:
+            progress(len(expansion), len(expansion))
+        return expansion.factorise(), expansion.skipped_rows
+    if module is not None:
+        return module.materialize(expansion, merged_df, progress), expansion.skipped_rows
+    return expansion.materialize(progress), expansion.skipped_rows
+
+
+def expand_with_reports(merged_df, start_date_str, end_date_str, progress=None):
+    """
+    Step 3 as the app runs it in the background: the factorised expansion and the
+    reports computed over all of it.
+    Args:
+        merged_df (pd.DataFrame): Step 2 output (not modified)
+        start_date_str (str): Start date in format "DD Month YYYY"
+        end_date_str (str): End date in format "DD Month YYYY"
+        progress (callable): Optional progress(done, total) callback, called per stage
+    Returns:
+        tuple: (FactorisedExpansion, {'Hours Summary': pd.DataFrame, 'Clashes': pd.DataFrame})
+    """
+    stages = 3
+    expansion = LazyExpansion(merged_df, start_date_str, end_date_str).factorise()
+    if progress is not None:
+        progress(1, stages)
+    summary_df = hours_summary(expansion)
+    if progress is not None:
+        progress(2, stages)
+    clashes_df = detect_clashes(expansion)
+    if progress is not None:
+        progress(stages, stages)
+    return expansion, {'Hours Summary': summary_df, 'Clashes': clashes_df}
+
+
+###############################################
+#   FULL PIPELINE                             #
+#   - Run Steps 1-3 for one ASRQ180 file      #
+###############################################
+
+
+def run_pipeline(asrq_df, lookup_df, start_date_str, end_date_str, excluded_sections=None,
+                 merge_engine='first-match', email_map=None, memory_limit=EXPANSION_MEMORY_LIMIT,
+                 backend='pandas'):
+    """
+    Runs Steps 1-3 on one ASRQ180 / hiring form pair.
+    Args:
+        asrq_df (pd.DataFrame): Raw ASRQ180 export
+        lookup_df (pd.DataFrame): Hiring form
+        start_date_str (str): Start date in format "DD Month YYYY"
+        end_date_str (str): End date in format "DD Month YYYY"
+        excluded_sections (list): Class Section rules that bypass the 2-letter rule
+            (exact codes, prefixes like 'TSP*' or patterns, see ExclusionRules)
+        merge_engine (str): Step 2 engine, a key of MERGE_ENGINES
+        email_map (dict): Known Email -> Empl ID pairs for the Step 2 fast path
+        memory_limit (int): Step 3 output size above which it stays factorised
+            (see expand_df_with_dates)
+        backend (str): Implementation of the filter and expansions, a key of BACKENDS
+    Returns:
+        dict: Step outputs ('filtered', 'merged', 'unmatched', 'expanded'), the
+              clash report ('clashes'), counters ('multiday', 'unmatched_count',
+              'skipped_rows') and the time values that could not be parsed
+              ('unparsable_times'), the pairs to learn ('learned_emails') and the
+              hit counts of the exclusion rules ('exclusion_hits'). 'expanded' is a
+              pd.DataFrame, or a FactorisedExpansion above memory_limit (see
+              expand_df_with_dates)
+    """
+    # Step 1: filter, format times and expand multi-day rows
+    filtered_df, exclusion_hits = filter_data_with_hits(asrq_df, excluded_sections, backend)
+    filtered_df, unparsable_times = normalise_time_columns(
+        filtered_df, ['Start Time', 'End Time'])
+    multiday, filtered_df = expand_day_column(filtered_df, backend)
+
+    # Step 2: merge with the hiring form
+    merged_df, unmatched_df, unmatched_count = merge_data(
+        filtered_df, lookup_df, merge_engine, email_map=email_map)
+
+    # Step 3: expand with dates
+    expanded_df, skipped_rows = expand_df_with_dates(
+        merged_df, start_date_str, end_date_str, memory_limit=memory_limit, backend=backend)
+
+    # Validation: overlapping sessions of the same lecturer
+    clashes_df = detect_clashes(expanded_df) if len(expanded_df) else pd.DataFrame()
+
+    return {
+        'filtered': filtered_df,
+        'merged': merged_df,
+        'unmatched': unmatched_df,
+        'expanded': expanded_df,
+        'clashes': clashes_df,
+        'multiday': multiday,
+        'unmatched_count': unmatched_count,
+        'skipped_rows': skipped_rows,
+        'unparsable_times': unparsable_times,
+        'learned_emails': confirmed_email_matches(merged_df),
+        'exclusion_hits': exclusion_hits,
+    }
+
+
+###############################################
+#   STREAMING PIPELINE                        #
+#   - Steps 1-3 in fixed-size batches         #
+###############################################
+
+
+class PipelineStream:
+    """
+    Steps 1-3 run batch by batch with bounded memory: each batch of ASRQ180 rows is
+    filtered, split by day, merged against the in-memory LookupIndex and expanded
+    with dates, and its output rows are handed to the writer before the next batch
+    is read. Every step treats rows independently and keeps their order, so the
+    written output equals run_pipeline's 'expanded'.
+    A stream is consumed once, by one of the exporters (e.g. write_table), which see
+    the columns / iter_chunks interface of a FactorisedExpansion; len() counts the
+    rows produced so far. Counters and small reports are available from results()
+    afterwards; the clash check needs all rows at once and is not run.
+    Args:
+        asrq_chunks (iterable): ASRQ180 DataFrames (e.g. from iter_table_chunks)
+        lookup_df (pd.DataFrame or LookupIndex): Hiring form
+        start_date_str (str): Start date in format "DD Month YYYY"
+        end_date_str (str): End date in format "DD Month YYYY"
+        excluded_sections (list): Class Section rules that bypass the 2-letter rule
+        merge_engine (str): Step 2 engine, a key of MERGE_ENGINES
+        email_map (dict): Known Email -> Empl ID pairs for the Step 2 fast path
+        chunk_rows (int): Most output rows handed to the writer at a time
+        backend (str): Implementation of the filter and Day split, a key of BACKENDS
+    """
+
+    def __init__(self, asrq_chunks, lookup_df, start_date_str, end_date_str,
+                 excluded_sections=None, merge_engine='first-match', email_map=None,
+                 chunk_rows=50000, backend='pandas'):
+        if merge_engine not in MERGE_ENGINES:
+            raise ValueError(
+                f"Unknown merge engine '{merge_engine}' (choose from {', '.join(MERGE_ENGINES)})")
+        self._asrq_chunks = asrq_chunks
+        self._lookup_index = lookup_df if isinstance(lookup_df, LookupIndex) \
+            else LookupIndex(lookup_df)
+        self._dates = (start_date_str, end_date_str)
+        self._rules = excluded_sections if isinstance(excluded_sections, ExclusionRules) \
+            else ExclusionRules(excluded_sections)
+        self._merge_engine = merge_engine
+        self._email_map = email_map
+        self._chunk_rows = chunk_rows
+        backend_module(backend)  # fail early on an unknown backend
+        self._backend = backend
+        self._batches = self._run()
+        self._first = None
+        self._done = False
+
+        self.counts = dict.fromkeys(['asrq', 'filtered', 'multiday', 'merged', 'matched_by_email',
+                                     'ambiguous', 'unmatched', 'skipped', 'expanded'], 0)
+        self._has_column = {'Matched By': False, 'Candidates': False}
+        self._exclusion_hits = np.zeros((2, len(self._rules)), dtype=np.int64)
+        self._unparsable = {col: {} for col in TIME_COLUMNS}
+        self._unmatched = []
+        self._email_pairs = []
+        self._hours = []
+
+    def _run(self):
+        for asrq_df in self._asrq_chunks:
+            self.counts['asrq'] += len(asrq_df)
+            filtered_df, hits = filter_data_with_hits(asrq_df, self._rules, self._backend)
+            self._exclusion_hits += hits[['Rows matched', 'Rows kept by rule']].to_numpy().T
+            if len(filtered_df) == 0:
+                continue
+            filtered_df, unparsable = normalise_time_columns(filtered_df, TIME_COLUMNS)
+            for col, values in unparsable.items():
+                self._unparsable[col].update(dict.fromkeys(values))
+            multiday, filtered_df = expand_day_column(filtered_df, self._backend)
+            self.counts['filtered'] += len(filtered_df)
+            self.counts['multiday'] += multiday
+
+            merged_df, unmatched_df, unmatched_count = merge_data(
+                filtered_df, self._lookup_index, self._merge_engine, email_map=self._email_map)
+            self._count_merged(merged_df)
+            if unmatched_count:
+                self._unmatched.append(unmatched_df)
+            self.counts['unmatched'] += unmatched_count
+            if len(merged_df) == 0:
+                continue
+
+            expansion = LazyExpansion(merged_df, *self._dates)
+            self.counts['skipped'] += expansion.skipped_rows
+            for chunk in expansion.iter_chunks(self._chunk_rows):
+                start = self.counts['expanded']
+                self.counts['expanded'] += len(chunk)
+                self._hours.append(hours_summary(chunk))
+                yield chunk.set_axis(pd.RangeIndex(start, start + len(chunk)))
+        self._done = True
+
+    def _count_merged(self, merged_df):
+        self.counts['merged'] += len(merged_df)
+        if 'Matched By' in merged_df.columns:
+            self._has_column['Matched By'] = True
+            self.counts['matched_by_email'] += int((merged_df['Matched By'] == 'email').sum())
+            self._email_pairs.append(confirmed_email_pairs(merged_df))
+        if 'Candidates' in merged_df.columns:
+            self._has_column['Candidates'] = True
+            self.counts['ambiguous'] += int((merged_df['Candidates'] > 1).sum())
+
+    @property
+    def columns(self):
+        """Output columns, known once the first output rows are built"""
+        if self._first is None:
+            self._first = next(self._batches, pd.DataFrame())
+        return self._first.columns
+
+    def __len__(self):
+        return self.counts['expanded']
+
+    def iter_chunks(self, chunk_rows=None):
+        """
+        Yields the output rows batch by batch, in chunks of at most chunk_rows rows
+        (the stream's chunk_rows when None); rows of different batches are not combined.
+        """
+        chunk_rows = chunk_rows or self._chunk_rows
+        first = self._first if self._first is not None else next(self._batches, pd.DataFrame())
+        self._first = pd.DataFrame(columns=first.columns)
+
+        def batches():
+            if len(first):
+                yield first
+            yield from self._batches
+
+        for batch in batches():
+            for start in range(0, len(batch), chunk_rows):
+                yield batch.iloc[start:start + chunk_rows]
+
+    def results(self):
+        """
+        Counters and reports of a consumed stream.
+        Returns:
+            dict: 'unmatched' rows, 'hours' (hours_summary of all output rows), counters
+                  ('asrq_rows', 'filtered_rows', 'multiday', 'merged_rows', 'matched_by_email'
+                  and 'ambiguous_matches' (None when the merge has no such column),
+                  'unmatched_count', 'skipped_rows', 'expanded_rows'), 'unparsable_times',
+                  'learned_emails' and 'exclusion_hits', as run_pipeline
+        """
+        if not self._done:
+            raise RuntimeError("The stream has not been written yet")
+        hours = (pd.concat(self._hours, ignore_index=True).groupby(
+            HOURS_SUMMARY_KEYS, observed=True, sort=True).sum().reset_index()
+            if self._hours else pd.DataFrame(columns=HOURS_SUMMARY_KEYS + ['Sessions', 'Hours']))
+        email_pairs = (pd.concat(self._email_pairs, ignore_index=True) if self._email_pairs
+                       else pd.DataFrame(columns=['email', 'empl_id']))
+        return {
+            'unmatched': (pd.concat(self._unmatched, ignore_index=True) if self._unmatched
+                          else pd.DataFrame()),
+            'hours': hours,
+            'asrq_rows': self.counts['asrq'],
+            'filtered_rows': self.counts['filtered'],
+            'multiday': self.counts['multiday'],
+            'merged_rows': self.counts['merged'],
+            'matched_by_email': (self.counts['matched_by_email']
+                                 if self._has_column['Matched By'] else None),
+            'ambiguous_matches': (self.counts['ambiguous']
+                                  if self._has_column['Candidates'] else None),
+            'unmatched_count': self.counts['unmatched'],
+            'skipped_rows': self.counts['skipped'],
+            'expanded_rows': self.counts['expanded'],
+            'unparsable_times': {col: list(values) for col, values in self._unparsable.items()},
+            'learned_emails': unique_email_pairs(email_pairs),
+            'exclusion_hits': pd.DataFrame({
+                'Rule': [rule for rule, _ in self._rules.rules],
+                'Kind': [kind for _, kind in self._rules.rules],
+                'Rows matched': self._exclusion_hits[0],
+                'Rows kept by rule': self._exclusion_hits[1],
+            }),
+        }
+
+
+###############################################
+#   REPORTS  (Hours, Clashes)                 #
+#   - Hours and overlap checks on Step 3 rows #
+###############################################
+
+# Rows of the hours summary: one per lecturer and week
+HOURS_SUMMARY_KEYS = ['Empl ID', 'Full Legal Name', 'Week Number']
+
+
+def duration_hours(df):
+    """
+    Session length in hours from the 'Start Time' / 'End Time' minutes.
+    Args:
+        df (pd.DataFrame): Rows with Int16 'Start Time' and 'End Time' columns
+    Returns:
+        pd.Series: Hours as floats; missing when a time is missing or End is before Start
+    """
+    minutes = (df['End Time'] - df['Start Time']).astype('float64')
+    return (minutes.where(minutes >= 0) / 60).rename('Duration (h)')
+
+
+def hours_summary(data, keys=None):
+    """
+    Claimable sessions and hours per lecturer and week.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Step 3 output with Int16
+            'Start Time' and 'End Time'; the hours are computed here (see duration_hours)
+        keys (list): Grouping columns (HOURS_SUMMARY_KEYS by default)
+    Returns:
+        pd.DataFrame: keys + 'Sessions' and 'Hours', sorted by the keys
+    """
+    keys = keys or HOURS_SUMMARY_KEYS
+    # Only the needed columns are taken, so a FactorisedExpansion is never materialised
+    frame = pd.DataFrame({col: data[col] for col in keys + ['Start Time', 'End Time']})
+    frame['Duration (h)'] = duration_hours(frame)
+    return frame.groupby(keys, observed=True, sort=True).agg(
+        **{'Sessions': ('Duration (h)', 'size'), 'Hours': ('Duration (h)', 'sum')}
+    ).reset_index()
+
+
+# Session columns shown for both sides of a clash
+CLASH_SESSION_COLUMNS = ['Start Time', 'End Time', 'Catalog Nbr', 'Class Section']
+
+
+def detect_clashes(data):
+    """
+    Finds sessions of the same lecturer that overlap on the same date (payroll rejects these).
+    Rows are sorted by (Empl ID, Date, Start Time) once; a session clashes when it starts
+    before the latest end of the earlier sessions in its (Empl ID, Date) group.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Step 3 output
+    Returns:
+        pd.DataFrame: One row per clashing session, with the earlier session it overlaps
+            ('Other ...' columns) and the overlap in minutes; empty if there are no clashes
+    """
+    report_columns = (['Empl ID', 'Full Legal Name', 'Date', 'Week Number'] + CLASH_SESSION_COLUMNS
+                      + [f"Other {col}" for col in CLASH_SESSION_COLUMNS] + ['Overlap (min)'])
+    empl_codes = pd.factorize(data['Empl ID'])[0]
+    dates = data['Date'].to_numpy()
+    starts = data['Start Time'].to_numpy(dtype='float64', na_value=np.nan)
+    ends = data['End Time'].to_numpy(dtype='float64', na_value=np.nan)
+
+    # Sessions without a lecturer or a time cannot be checked
+    positions = np.flatnonzero((empl_codes >= 0) & ~np.isnan(starts) & ~np.isnan(ends))
+    order = np.lexsort((starts[positions], dates[positions], empl_codes[positions]))
+    positions = positions[order]
+    empl_codes, dates = empl_codes[positions], dates[positions]
+    starts, ends = starts[positions], ends[positions]
+
+    # Group id per (Empl ID, Date) run of the sorted rows
+    new_group = np.ones(len(positions), dtype=bool)
+    new_group[1:] = (empl_codes[1:] != empl_codes[:-1]) | (dates[1:] != dates[:-1])
+    group_ids = np.cumsum(new_group)
+
+    # Latest end so far in each group, and the row it belongs to; each group's first row
+    # holds its own maximum, so a plain running maximum of row numbers stays in the group
+    max_ends = pd.Series(ends).groupby(group_ids).cummax().to_numpy()
+    max_rows = np.maximum.accumulate(np.where(ends == max_ends, np.arange(len(ends)), 0))
+
+    # Compare each row with the groups' earlier rows only
+    clashes = np.flatnonzero(~new_group[1:] & (starts[1:] < max_ends[:-1])) + 1
+    others = max_rows[clashes - 1]
+    if len(clashes) == 0:
+        return pd.DataFrame(columns=report_columns)
+
+    sessions = data.take(positions[clashes])
+    other_sessions = data.take(positions[others])
+    report = sessions[['Empl ID', 'Full Legal Name', 'Date', 'Week Number'] + CLASH_SESSION_COLUMNS]
+    report = report.reset_index(drop=True).assign(**{
+        f"Other {col}": other_sessions[col].array for col in CLASH_SESSION_COLUMNS})
+    report['Overlap (min)'] = (np.minimum(ends[clashes], ends[others]) - starts[clashes]).astype(int)
+    return report[report_columns]
+
+
+###############################################
+#   UTILITIES (Export, Conversion)            #
+#   - Convert DataFrame to downloadable Excel #
+###############################################
+
+# Low-cardinality text columns, repeated across the expanded rows
+CATEGORICAL_COLUMNS = [
+    'Empl ID',
+    'Full Legal Name',
+    'Name',
+    'Time entry code',
+    'Day',
+    'Position ID',
+    'Program ID',
+    'Class Section',
+    'Catalog Nbr',
+]
+
+
+def compact_dtypes(df):
+    """
+    Returns df with the CATEGORICAL_COLUMNS it has stored as categoricals and
+    TIME_COLUMNS holding minutes as Int16 (df is not modified)
+    """
+    columns = {col: 'category' for col in CATEGORICAL_COLUMNS
+               if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype)}
+    # Minutes lose their dtype when rows are rebuilt from dicts (e.g. in the merge)
+    columns.update({col: 'Int16' for col in TIME_COLUMNS if col in df.columns
+                    and df[col].dtype != 'Int16' and pd.api.types.infer_dtype(df[col]) in (
+                        'integer', 'floating', 'mixed-integer-float', 'empty')})
+    return df.astype(columns) if columns else df
+
+
+# Excel serial dates count days from 1899-12-30 (times are fractions of a day)
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+
+# Number formats of the columns written as native Excel values; they render
+# exactly as the text written by default
+EXCEL_NUMBER_FORMATS = {
+    'Date': 'yyyy-mm-dd',
+    'Start Time': 'hh:mm:ss',
+    'End Time': 'hh:mm:ss',
+    'Other Start Time': 'hh:mm:ss',
+    'Other End Time': 'hh:mm:ss',
+}
+
+
+def format_for_export(df, native_dates=False):
+    """
+    Renders compact columns the way they are written to files: times as
+    "HH:MM:SS", 'Week Number' as "Week N" and 'Date' as "YYYY-MM-DD" text.
+    With native_dates, 'Date' and the times become Excel serial numbers instead,
+    to be written with EXCEL_NUMBER_FORMATS.
+    """
+    # Time columns, including the other session's times in the clash report
+    time_columns = TIME_COLUMNS + [f"Other {col}" for col in TIME_COLUMNS]
+    time_columns = [col for col in time_columns
+                    if col in df.columns and pd.api.types.is_integer_dtype(df[col])]
+    if native_dates:
+        formatted = {col: df[col].to_numpy(dtype=float, na_value=np.nan) / (24 * 60)
+                     for col in time_columns}
+    else:
+        formatted = {col: minutes_to_text(df[col]) for col in time_columns}
+    if 'Week Number' in df.columns and pd.api.types.is_integer_dtype(df['Week Number']):
+        formatted['Week Number'] = 'Week ' + df['Week Number'].astype(str)
+    if 'Date' in df.columns and pd.api.types.is_datetime64_any_dtype(df['Date']):
+        if native_dates:
+            formatted['Date'] = (df['Date'] - EXCEL_EPOCH) / pd.Timedelta(days=1)
+        else:
+            formatted['Date'] = df['Date'].dt.strftime('%Y-%m-%d')
+    return df.assign(**formatted) if formatted else df
+
+
+def to_excel(data, progress=None, chunk_rows=50000, extra_sheets=None, native_dates=False,
+             output=None):
+    """
+    Writes a step result to an .xlsx file in memory.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Result to write; a
+            FactorisedExpansion is expanded and written one chunk at a time
+        progress (callable): Optional progress(done, total) callback, in rows
+        chunk_rows (int): Rows expanded per chunk
+        extra_sheets (dict): Optional sheet name -> small DataFrame (e.g. the
+            hours summary) written after the result
+        native_dates (bool): Write 'Date' and the times as Excel date/time values
+            (smaller, faster to write and sortable) instead of text
+        output (file-like): Optional open binary file to write to instead
+    Returns:
+        bytes: Workbook contents (None when written to output)
+    """
+    destination = output
+    output = BytesIO() if destination is None else destination
+    extra_sheets = extra_sheets or {}
+    if isinstance(data, pd.DataFrame) and not native_dates:
+        writer = pd.ExcelWriter(output, engine='xlsxwriter')
+        format_for_export(data).to_excel(writer, index=False, sheet_name='Sheet1')
+        for sheet_name, sheet_df in extra_sheets.items():
+            format_for_export(sheet_df).to_excel(writer, index=False, sheet_name=sheet_name)
+        writer.close()
+    else:
+        sheets = [('Sheet1', list(data.columns), iter_row_chunks(data, chunk_rows), len(data))]
+        sheets += [(sheet_name, list(sheet_df.columns), [sheet_df], len(sheet_df))
+                   for sheet_name, sheet_df in extra_sheets.items()]
+        write_excel_chunks(output, sheets, progress, native_dates)
+    if destination is not None:
+        return None
+    processed_data = output.getvalue()
+    return processed_data
+
+
+def write_excel_chunks(output, sheets, progress=None, native_dates=False):
+    """
+    Writes sheets from DataFrame chunks without holding a whole table.
+    Rows are flushed as they are written (xlsxwriter constant_memory mode; for an
+    in-memory output the workbook is assembled in memory); the cells look the same
+    as those written by DataFrame.to_excel.
+    Args:
+        output (str or file-like): Destination of the workbook
+        sheets (list): (sheet name, columns, chunks, total rows) per sheet, where
+            chunks is an iterable of DataFrames with those columns
+        progress (callable): Optional progress(done, total) callback, in rows of the first sheet
+        native_dates (bool): Write 'Date' and the times as Excel date/time values
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True,
+                                            'in_memory': isinstance(output, BytesIO)})
+    datetime_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    number_formats = {col: workbook.add_format({'num_format': num_format})
+                      for col, num_format in EXCEL_NUMBER_FORMATS.items()}
+    for sheet_num, (sheet_name, columns, chunks, total_rows) in enumerate(sheets):
+        worksheet = workbook.add_worksheet(sheet_name)
+        for col_num, col in enumerate(columns):
+            worksheet.write_string(0, col_num, str(col))
+        # Cell format of each column (None: written as is)
+        cell_formats = [number_formats.get(col) if native_dates else None for col in columns]
+
+        row_num = 1
+        for chunk in chunks:
+            chunk = format_for_export(chunk[columns], native_dates)
+            for values in chunk.itertuples(index=False, name=None):
+                for col_num, value in enumerate(values):
+                    # Missing values are left blank, as in DataFrame.to_excel
+                    if value is None or value is pd.NaT or value is pd.NA or (
+                            isinstance(value, float) and np.isnan(value)):
+                        continue
+                    if isinstance(value, datetime.datetime):
+                        worksheet.write_datetime(row_num, col_num, value, datetime_format)
+                    else:
+                        worksheet.write(row_num, col_num, value, cell_formats[col_num])
+                row_num += 1
+            if progress is not None and sheet_num == 0:
+                progress(row_num - 1, total_rows)
+    workbook.close()
+
+
+def iter_row_chunks(data, chunk_rows=50000):
+    """Yields a DataFrame or FactorisedExpansion as DataFrames of up to chunk_rows rows"""
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, len(data), chunk_rows):
+            yield data.iloc[start:start + chunk_rows]
+    else:
+        yield from data.iter_chunks(chunk_rows)
+
+
+def to_csv(data, progress=None, chunk_rows=50000, output=None):
+    """
+    Writes a step result as UTF-8 CSV, one chunk at a time.
+    Values are rendered as in the xlsx (see format_for_export) and columns keep
+    their order, i.e. FINAL_COLUMN_ORDER for Step 3 results.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Result to write
+        progress (callable): Optional progress(done, total) callback, in rows
+        chunk_rows (int): Rows formatted per chunk
+        output (file-like): Optional open binary file to write to instead
+    Returns:
+        bytes: CSV contents (None when written to output)
+    """
+    destination = output
+    output = BytesIO() if destination is None else destination
+    output.write(pd.DataFrame(columns=list(data.columns)).to_csv(index=False).encode('utf-8'))
+    done = 0
+    for chunk in iter_row_chunks(data, chunk_rows):
+        output.write(format_for_export(chunk).to_csv(index=False, header=False).encode('utf-8'))
+        done += len(chunk)
+        if progress is not None:
+            progress(done, len(data))
+    return output.getvalue() if destination is None else None
+
+
+def to_parquet(data, progress=None, chunk_rows=50000, output=None):
+    """
+    Writes a step result as Parquet, one row group per chunk.
+    Values are rendered as in the xlsx (see format_for_export): text columns are
+    strings and numeric columns keep their type.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Result to write
+        progress (callable): Optional progress(done, total) callback, in rows
+        chunk_rows (int): Rows per row group
+        output (file-like): Optional open binary file to write to instead
+    Returns:
+        bytes: Parquet contents (None when written to output)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def arrow_table(chunk, schema=None):
+        chunk = format_for_export(chunk)
+        columns = {}
+        for col in chunk.columns:
+            values = chunk[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype(values.cat.categories.dtype)
+            if not (pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values)):
+                values = values.astype('str')
+            columns[col] = values
+        return pa.Table.from_pandas(pd.DataFrame(columns), schema=schema, preserve_index=False)
+
+    destination = output
+    output = BytesIO() if destination is None else destination
+    writer = None
+    done = 0
+    for chunk in iter_row_chunks(data, chunk_rows):
+        if writer is None:
+            table = arrow_table(chunk)
+            # Columns empty in the first chunk are typed as text
+            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type)
+                                else field for field in table.schema])
+            writer = pq.ParquetWriter(output, schema.remove_metadata())
+        table = arrow_table(chunk, schema)
+        writer.write_table(table)
+        done += len(chunk)
+        if progress is not None:
+            progress(done, len(data))
+    if writer is None:
+        # No rows: just the column names
+        writer = pq.ParquetWriter(output, pa.schema([(str(col), pa.string()) for col in data.columns]))
+    writer.close()
+    return output.getvalue() if destination is None else None
+
+
+# Download formats: file extension -> (writer, MIME type)
+EXPORT_FORMATS = {
+    'xlsx': (to_excel, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': (to_csv, 'text/csv'),
+    'parquet': (to_parquet, 'application/vnd.apache.parquet'),
+}
+
+
+def export_data(data, file_format='xlsx', progress=None, chunk_rows=50000, extra_sheets=None,
+                native_dates=False, output=None):
+    """
+    Writes a step result in one of EXPORT_FORMATS.
+    extra_sheets and native_dates only apply to xlsx; CSV and Parquet hold the
+    result table alone.
+    Returns:
+        bytes: File contents (None when written to the open binary file output)
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown export format '{file_format}' (choose from {', '.join(EXPORT_FORMATS)})")
+    if file_format == 'xlsx':
+        return to_excel(data, progress, chunk_rows, extra_sheets, native_dates, output)
+    return EXPORT_FORMATS[file_format][0](data, progress, chunk_rows, output)
+
+
+def write_table(data, path, **xlsx_options):
+    """
+    Writes a step result to a file, in the format given by its extension (see export_data).
+    Chunked data (e.g. a FactorisedExpansion or PipelineStream) goes straight to the file.
+    """
+    file_format = os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown export format '{file_format}' (choose from {', '.join(EXPORT_FORMATS)})")
+    with open(path, 'wb') as f:
+        export_data(data, file_format, output=f, **xlsx_options)
+
+
+def read_table(path):
+    """Reads a step result written by write_table (xlsx, csv or parquet)"""
+    file_format = os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format == 'csv':
+        return pd.read_csv(path)
+    if file_format == 'parquet':
+        return pd.read_parquet(path)
+    return pd.read_excel(path)
+
+
+def iter_table_chunks(path, chunk_rows=50000):
+    """
+    Reads a table (xlsx, csv or parquet) in consecutive chunks, without holding the whole file.
+    Column types are settled over all chunks first, so each chunk has the dtypes
+    read_table would give the full file (e.g. a column of whole numbers with a
+    missing value anywhere is float in every chunk).
+    Args:
+        path (str): File to read (the first sheet of a workbook)
+        chunk_rows (int): Rows per chunk
+    Yields:
+        pd.DataFrame: Chunks whose index continues from one chunk to the next
+    """
+    file_format = os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        # The schema already fixes the types
+        start = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+        return
+
+    def read_chunks(text_columns=None):
+        if file_format == 'csv':
+            return pd.read_csv(path, chunksize=chunk_rows, dtype=text_columns)
+        return _iter_excel_chunks(path, chunk_rows)
+
+    # First pass: the dtype of each column in each chunk, ignoring chunks where it is empty
+    seen, has_missing = {}, set()
+    for chunk in read_chunks():
+        for col in chunk.columns:
+            missing = chunk[col].isna()
+            if missing.any():
+                has_missing.add(col)
+            if not missing.all():
+                seen.setdefault(col, set()).add(chunk[col].dtype)
+    dtypes = {col: _settled_dtype(chunk_dtypes, col in has_missing)
+              for col, chunk_dtypes in seen.items()}
+    # CSV holds text only: a column of text and numbers is read as text throughout
+    text_columns = None
+    if file_format == 'csv':
+        text_columns = {col: 'str' for col, dtype in dtypes.items() if dtype == object}
+        dtypes = {col: dtype for col, dtype in dtypes.items() if dtype != object}
+
+    for chunk in read_chunks(text_columns):
+        casts = {col: dtype for col, dtype in dtypes.items()
+                 if col in chunk.columns and chunk[col].dtype != dtype}
+        yield chunk.astype(casts) if casts else chunk
+
+
+def _settled_dtype(chunk_dtypes, has_missing):
+    """dtype pandas gives a column whose chunks were read with chunk_dtypes"""
+    if len(chunk_dtypes) == 1:
+        dtype = next(iter(chunk_dtypes))
+    elif all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+             for dtype in chunk_dtypes):
+        dtype = np.dtype('float64')
+    else:
+        return np.dtype(object)
+    if has_missing and pd.api.types.is_integer_dtype(dtype):
+        return np.dtype('float64')
+    if has_missing and pd.api.types.is_bool_dtype(dtype):
+        return np.dtype(object)
+    return dtype
+
+
+def _iter_excel_chunks(path, chunk_rows):
+    """First sheet of a workbook in chunks, with cells converted as pd.read_excel does"""
+    from openpyxl import load_workbook
+    from pandas.io.parsers import TextParser
+
+    def cell_value(cell):
+        if cell.value is None:
+            return ''
+        if cell.data_type == 'e':
+            return np.nan
+        if cell.data_type == 'n':
+            return int(cell.value) if int(cell.value) == cell.value else float(cell.value)
+        return cell.value
+
+    workbook = load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        rows = workbook.worksheets[0].rows
+        header = [cell_value(cell) for cell in next(rows, ())]
+        while header and header[-1] == '':
+            header.pop()
+        start = 0
+        batch = []
+        for row in rows:
+            values = [cell_value(cell) for cell in row][:len(header)]
+            # Blank rows are dropped, as by read_excel
+            if all(value == '' for value in values):
+                continue
+            batch.append(values + [''] * (len(header) - len(values)))
+            if len(batch) == chunk_rows:
+                yield TextParser(batch, names=header).read().set_axis(
+                    pd.RangeIndex(start, start + len(batch)))
+                start += len(batch)
+                batch = []
+        if batch or start == 0:
+            yield TextParser(batch, names=header).read().set_axis(
+                pd.RangeIndex(start, start + len(batch)))
+    finally:
+        workbook.close()
+
+
+# Columns the final claims can be split by (see partition_rows)
+PARTITION_COLUMNS = ['Empl ID', 'Week Number']
+
+
+def partition_rows(data, by=None, max_rows=None):
+    """
+    Splits the rows of a Step 3 result into export partitions.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Result to split
+        by (str): Column of PARTITION_COLUMNS to split by, or None
+        max_rows (int): Maximum rows per partition (larger ones are split in parts)
+    Returns:
+        list: (label, positions) pairs in label order, where positions are row
+            positions (for data.take) in file order
+    """
+    if by is None:
+        partitions = [('all', np.arange(len(data)))]
+    else:
+        codes, uniques = pd.factorize(data[by], sort=True)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(-1, len(uniques) + 1))
+        labels = ['blank'] + [format_for_export(pd.DataFrame({by: [value]}))[by].iloc[0]
+                              for value in uniques]
+        partitions = [(str(label), order[bounds[code]:bounds[code + 1]])
+                      for code, label in enumerate(labels) if bounds[code] < bounds[code + 1]]
+    if max_rows:
+        partitions = [
+            (label if len(positions) <= max_rows else f"{label}_part{part + 1}",
+             positions[start:start + max_rows])
+            for label, positions in partitions
+            for part, start in enumerate(range(0, len(positions), max_rows))]
+    return partitions
+
+
+def partition_file_labels(labels):
+    """
+    File name parts for partition labels: characters other than letters, digits,
+    '_' and '-' become '_'. A label whose name part is already taken (e.g. 'A/1'
+    after 'A 1', or one differing only in case) gets a short hash of the label.
+    Returns:
+        list: One distinct name part per label, in order
+    """
+    names, taken = [], set()
+    for label in labels:
+        name = re.sub(r'[^A-Za-z0-9_-]+', '_', label).strip('_') or 'blank'
+        if name.lower() in taken:
+            name = f"{name}_{hashlib.sha1(label.encode()).hexdigest()[:8]}"
+        base, count = name, 1
+        while name.lower() in taken:
+            count += 1
+            name = f"{base}_{count}"
+        taken.add(name.lower())
+        names.append(name)
+    return names
+
+
+# Expansion whose partitions a process pool worker writes (see share_expansion)
+_partition_expansion = None
+
+
+def share_expansion(expansion):
+    """Process pool initializer: keeps the merged rows and calendar of a FactorisedExpansion once"""
+    global _partition_expansion
+    _partition_expansion = expansion
+
+
+def write_partition(part, file_format='xlsx', chunk_rows=50000, native_dates=False):
+    """
+    Process pool worker: one partition as file bytes; workbooks are written in constant memory.
+    part is a DataFrame, or the (row ids, calendar ids) of a partition of the shared
+    expansion, whose rows are then built here one chunk at a time.
+    """
+    if isinstance(part, tuple):
+        part = FactorisedExpansion(_partition_expansion, *part)
+    if file_format != 'xlsx':
+        return export_data(part, file_format, chunk_rows=chunk_rows)
+    output = BytesIO()
+    chunks = iter_row_chunks(part, chunk_rows)
+    write_excel_chunks(output, [('Sheet1', list(part.columns), chunks, len(part))],
+                       native_dates=native_dates)
+    return output.getvalue()
+
+
+def to_partitioned_zip(data, by=None, max_rows=None, progress=None, max_workers=None,
+                       extra_sheets=None, file_prefix='expanded_with_dates', native_dates=False,
+                       file_format='xlsx'):
+    """
+    Writes a Step 3 result as one file per partition, bundled in a ZIP.
+    Workbooks are written concurrently in a process pool; only a few partitions
+    are in flight at a time, so memory does not grow with the number of partitions.
+    A FactorisedExpansion is sent to each worker once, and then only the id pairs
+    of each partition: its rows are built in the workers, never in this process.
+    Args:
+        data (pd.DataFrame or FactorisedExpansion): Result to write
+        by (str): Column of PARTITION_COLUMNS to split by, or None
+        max_rows (int): Maximum rows per workbook (e.g. the payroll upload limit)
+        progress (callable): Optional progress(done, total) callback, in rows
+        max_workers (int): Worker processes (defaults to the CPU count)
+        extra_sheets (dict): Optional sheet name -> small DataFrame, written to a
+            separate 'summary.xlsx' in the ZIP
+        file_prefix (str): Start of the workbook names
+        native_dates (bool): Write 'Date' and the times as Excel date/time values
+        file_format (str): Format of the partition files, a key of EXPORT_FORMATS
+    Returns:
+        bytes: ZIP contents
+    """
+    import zipfile
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    partitions = partition_rows(data, by, max_rows)
+    suffix = '_' + by.replace(' ', '_').lower() if by else ''
+    output = BytesIO()
+    done_rows = 0
+    # xlsx and Parquet files are already compressed
+    compression = zipfile.ZIP_DEFLATED if file_format == 'csv' else zipfile.ZIP_STORED
+    factorised = isinstance(data, FactorisedExpansion)
+    with zipfile.ZipFile(output, 'w', compression) as archive, \
+            ProcessPoolExecutor(max_workers=max_workers,
+                                initializer=share_expansion if factorised else None,
+                                initargs=(data._expansion,) if factorised else ()) as executor:
+
+        def collect(file_name, rows, future):
+            nonlocal done_rows
+            archive.writestr(file_name, future.result())
+            done_rows += rows
+            if progress is not None:
+                progress(done_rows, len(data))
+
+        window = 2 * (max_workers or os.cpu_count() or 1)
+        pending = deque()
+        try:
+            file_labels = partition_file_labels([label for label, _ in partitions])
+            for file_label, (label, positions) in zip(file_labels, partitions):
+                part = ((data.row_ids[positions], data.calendar_ids[positions]) if factorised
+                        else data.take(positions))
+                pending.append((f"{file_prefix}{suffix}_{file_label}.{file_format}", len(positions),
+                                executor.submit(write_partition, part,
+                                                file_format, native_dates=native_dates)))
+                # Collected in submission order, so the ZIP lists partitions in label order
+                if len(pending) >= window:
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+        except BaseException:
+            # e.g. JobCancelled from progress: drop the partitions not started yet
+            executor.shutdown(cancel_futures=True)
+            raise
+
+        if extra_sheets:
+            summary = BytesIO()
+            write_excel_chunks(summary, [
+                (sheet_name, list(sheet_df.columns), [sheet_df], len(sheet_df))
+                for sheet_name, sheet_df in extra_sheets.items()], native_dates=native_dates)
+            archive.writestr('summary.xlsx', summary.getvalue())
+    return output.getvalue()
@@ -0,0 +1,164 @@
+"""
+Polars implementations of the Step 1 filter, the Day split and the Step 3 date expansion.
+
+Each stage is one lazy Polars query, collected with Polars' multithreaded engine;
+pandas frames go in and come out, so callers see the same results as the pandas
+functions in pipeline.py. Selected with backend='polars' on filter_data_with_hits,
+expand_day_column and expand_df_with_dates (see pipeline.BACKENDS); requires
+polars (pip install polars).
+"""
+import numpy as np
+import pandas as pd
+
+try:
+    import polars as pl
+except ImportError as e:
+    raise ImportError("The polars backend requires polars (pip install polars)") from e
+
+from pipeline import VALID_DAYS, ExclusionRules, compact_dtypes
+
+
+def _text_column(values):
+    """pandas column as a Polars string Series, missing values as nulls"""
+    return pl.from_pandas(values.astype('str')).cast(pl.String)
+
+
+def _pattern_regex(rule):
+    """Anchored regex for a * / ? / [...] pattern, in the syntax Polars understands"""
+    parts = []
+    position = 0
+    while position < len(rule):
+        char = rule[position]
+        end = rule.find(']', position + 2)
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        elif char == '[' and end > 0:
+            body = rule[position + 1:end]
+            negate = body.startswith('!')
+            body = body[1:] if negate else body
+            parts.append('[' + ('^' if negate else '') + body.replace('\\', '\\\\') + ']')
+            position = end
+        else:
+            parts.append('\\' + char if not char.isalnum() else char)
+        position += 1
+    return '(?s)^' + ''.join(parts) + '$'
+
+
+def _rule_expression(rule, kind, section):
+    if kind == 'exact':
+        return section == rule
+    if kind == 'prefix':
+        return section.str.starts_with(rule[:-1])
+    return section.str.contains(_pattern_regex(rule))
+
+
+def filter_data_with_hits(df, excluded_sections=None):
+    """Polars version of pipeline.filter_data_with_hits (same result)"""
+    rules = excluded_sections if isinstance(excluded_sections, ExclusionRules) \
+        else ExclusionRules(excluded_sections)
+
+    section = pl.col('Class Section').str.strip_chars().str.to_uppercase()
+    rule_columns = [_rule_expression(rule, kind, section).fill_null(False).alias(f"rule_{number}")
+                    for number, (rule, kind) in enumerate(rules.rules)]
+    frame = pl.LazyFrame({
+        'Email': _text_column(df['Email']),
+        'Class Section': _text_column(df['Class Section']),
+    }).with_row_index('position').filter(
+        # Same pattern as str.contains in pandas: a case-insensitive regex
+        pl.col('Email').str.contains('(?i)@adj.np.edu.sg').fill_null(False)
+    ).with_columns(
+        # At most 2 letters (str.isalpha) in the Class Section; missing values do not pass
+        pl.col('Class Section').str.count_matches(r'\p{Alphabetic}').le(2).fill_null(False)
+        .alias('two_letters'),
+        *rule_columns,
+    )
+    rule_names = [f"rule_{number}" for number in range(len(rules))]
+    excluded = pl.any_horizontal(rule_names) if rule_names else pl.lit(False)
+    frame = frame.with_columns(excluded.alias('excluded')).collect()
+
+    kept_only_by_rule = frame['excluded'] & ~frame['two_letters']
+    hits_df = pd.DataFrame({
+        'Rule': [rule for rule, _ in rules.rules],
+        'Kind': [kind for _, kind in rules.rules],
+        'Rows matched': [int(frame[name].sum()) for name in rule_names],
+        'Rows kept by rule': [int((frame[name] & kept_only_by_rule).sum()) for name in rule_names],
+    }, columns=['Rule', 'Kind', 'Rows matched', 'Rows kept by rule'])
+    if len(hits_df) == 0:
+        hits_df = hits_df.astype({'Rows matched': np.int64, 'Rows kept by rule': np.int64})
+    positions = frame.filter(pl.col('two_letters') | pl.col('excluded'))['position'].to_numpy()
+    return df.iloc[positions], hits_df
+
+
+def expand_day_column(df):
+    """Polars version of pipeline.expand_day_column (same result)"""
+    frame = pl.LazyFrame({'Day': _text_column(df['Day'])}).with_row_index('position').with_columns(
+        pl.col('Day').str.extract_all(r'\S+').alias('days'))
+    # Rows with more than one day become one row per day; the rest are kept as they are
+    multiday = pl.col('days').list.len() > 1
+    frame = frame.with_columns(
+        pl.when(multiday).then(pl.col('days')).otherwise(pl.lit(None)).alias('days'),
+        multiday.fill_null(False).alias('multiday'),
+    ).explode('days').collect()
+
+    days = df['Day'].astype(object).to_numpy()[frame['position'].to_numpy()]
+    split = frame['multiday'].to_numpy()
+    days[split] = frame['days'].to_numpy()[split]
+    expanded_df = df.iloc[frame['position'].to_numpy()].reset_index(drop=True)
+    expanded_df = pd.DataFrame(
+        {col: expanded_df[col].astype(object).to_numpy() for col in expanded_df.columns})
+    expanded_df['Day'] = days
+    multidays_count = int(frame.filter('multiday')['position'].n_unique())
+    return multidays_count, compact_dtypes(expanded_df.infer_objects())
+
+
+def materialize(expansion, merged_df, progress=None):
+    """
+    Polars version of LazyExpansion.materialize (same result): the rows x dates
+    product, ordering and comments are computed by one query; the merged rows of
+    the output are then taken from expansion.base.
+    Args:
+        expansion (LazyExpansion): Expansion of merged_df
+        merged_df (pd.DataFrame): Step 2 output the expansion was built from
+        progress (callable): Optional progress(done, total) callback, called once at the end
+    """
+    calendar = pl.LazyFrame({
+        'key': pl.Series(expansion.calendar['Day key'].tolist(), dtype=pl.String),
+        'Week Number': expansion.calendar['Week Number'].to_numpy(),
+    }).with_row_index('calendar_id')
+
+    # Each row's weekday keys, in order and without repeats; rows with an empty Day or
+    # a part that is not Mon-Sat are skipped
+    part = pl.element()
+    capitalised = part.str.slice(0, 1).str.to_uppercase() + part.str.slice(1).str.to_lowercase()
+    rows = pl.LazyFrame({
+        'Day': _text_column(merged_df['Day']),
+        'suffix': pl.Series(expansion.comment_suffix.tolist(), dtype=pl.String),
+    }).with_row_index('row_id').with_columns(
+        pl.col('Day').str.strip_chars().str.extract_all(r'\S+')
+        .list.eval(capitalised).alias('keys'))
+    rows = rows.filter(
+        (pl.col('keys').list.len() > 0)
+        & pl.col('keys').list.eval(part.is_in(VALID_DAYS)).list.all()
+    ).with_columns(pl.col('keys').list.unique(maintain_order=True))
+
+    plan = rows.explode('keys').rename({'keys': 'key'}).with_columns(
+        pl.int_range(pl.len()).over('row_id').alias('key_order')
+    ).join(calendar, on='key').sort(['row_id', 'key_order', 'calendar_id']).select(
+        'row_id', 'calendar_id',
+        pl.concat_str([pl.lit('WEEK '), pl.col('Week Number').cast(pl.String), pl.lit('_'),
+                       pl.col('key'), pl.col('suffix')]).str.to_uppercase().alias('Comment'))
+    output = plan.collect()
+    if progress is not None:
+        progress(len(output), len(output))
+    if len(output) == 0:
+        return pd.DataFrame()
+
+    row_ids = output['row_id'].to_numpy().astype(np.int32)
+    calendar_ids = output['calendar_id'].to_numpy()
+    expanded = expansion.base.iloc[row_ids].reset_index(drop=True)
+    expanded['Date'] = expansion.calendar['Date'].to_numpy()[calendar_ids]
+    expanded['Week Number'] = expansion.calendar['Week Number'].to_numpy()[calendar_ids]
+    expanded['Comment'] = output['Comment'].to_list()
+    return expanded[expansion.columns]
@@ -0,0 +1,82 @@
+"""
+Server-side search, sort and paging for result previews.
+
+Only the rows of the current page are ever taken out of the result frame,
+so the browser receives one page instead of the full DataFrame. The result may
+also be a pipeline.FactorisedExpansion, which builds just the rows asked for.
+"""
+import numpy as np
+import pandas as pd
+
+from pipeline import format_for_export
+
+# Columns searched by default when present
+DEFAULT_SEARCH_COLUMNS = ['Name', 'Full Legal Name', 'Empl ID',
+                          'Catalog Nbr', 'Class Section']
+
+
+def select_rows(df, search='', search_columns=None, sort_by=None, ascending=True):
+    """
+    Finds the row positions to preview, after an optional search and sort.
+    Args:
+        df (pd.DataFrame or FactorisedExpansion): Result (not modified or copied)
+        search (str): Case-insensitive substring to look for, in the text shown
+            (times as "HH:MM:SS", dates as "YYYY-MM-DD")
+        search_columns (list): Columns searched for the substring
+        sort_by (str): Column to sort by, or None to keep file order
+        ascending (bool): Sort direction
+    Returns:
+        np.ndarray: Positions (for df.take) of the matching rows, in display order
+    """
+    positions = np.arange(len(df))
+
+    if search and search_columns:
+        mask = np.zeros(len(df), dtype=bool)
+        for col in search_columns:
+            mask |= display_text(df[col]).str.contains(
+                search, case=False, regex=False, na=False).to_numpy()
+        positions = np.flatnonzero(mask)
+
+    if sort_by:
+        keys = df[sort_by].iloc[positions].reset_index(drop=True)
+        try:
+            order = keys.sort_values(
+                ascending=ascending, kind='stable', na_position='last').index
+        except TypeError:
+            # Mixed types (e.g. numbers and text) sort by their text
+            order = keys.astype(str).sort_values(
+                ascending=ascending, kind='stable').index
+        positions = positions[order.to_numpy()]
+
+    return positions
+
+
+def display_text(column):
+    """Column as the text the preview shows (see pipeline.format_for_export)"""
+    return format_for_export(column.to_frame())[column.name].astype(str)
+
+
+def get_page(df, positions, page, page_size):
+    """Returns page number `page` (1-based) of the selected rows"""
+    start = (page - 1) * page_size
+    return df.take(positions[start:start + page_size])
+
+
+def column_stats(column):
+    """(non-empty values, distinct non-empty values, first non-empty value) of a column"""
+    if not column.notna().any():
+        return 0, 0, None
+    return column.notna().sum(), column.nunique(dropna=True), column.dropna().iloc[0]
+
+
+def column_summary(df):
+    """
+    Per-column summary statistics for the full result, one column at a time;
+    a FactorisedExpansion computes them without building its columns.
+    """
+    if isinstance(df, pd.DataFrame):
+        stats = [column_stats(df[col]) for col in df.columns]
+    else:
+        stats = [df.column_stats(col) for col in df.columns]
+    return pd.DataFrame(stats, columns=['Non-empty', 'Distinct values', 'Example'],
+                        index=list(df.columns)).astype({'Example': str})
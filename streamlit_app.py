@@ -1,9 +1,18 @@
 import streamlit as st
-import pandas as pd
 import datetime
-import numpy as np
+import functools
+import hashlib
+import importlib.util
+import uuid
+import zipfile
 from io import BytesIO
 
+# Only light modules here: pandas, numpy and the pipeline are imported where a
+# step first needs them, so the first page renders without loading them
+from email_map import EmailMap
+from frame_store import MB, FrameStore
+from job_store import JobStore, PersistentJob, ensure_worker
+
 # Set page configuration
 st.set_page_config(
     page_title="Teaching Claim Process",
@@ -17,6 +26,10 @@ STEP_NAMES = ['Clean Data', 'Merge Headers',
               'Date Transform']
 
 # Initialize session state variables
+# Step results (upload_data, step1_data, step2_data, step3_plan, step3_data, step3_reports,
+# step3_download) are frame_store.StoredFrame handles, so they count against the memory budget
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 if 'step1_data' not in st.session_state:
     st.session_state.step1_data = None
 if 'step2_data' not in st.session_state:
@@ -25,14 +38,39 @@ if 'step3_data' not in st.session_state:
     st.session_state.step3_data = None
 if 'current_step' not in st.session_state:
     st.session_state.current_step = 0  # Using 0-based index for step names
+# Background jobs for the heavy steps, keyed by the inputs they were started with
+if 'step2_job' not in st.session_state:
+    st.session_state.step2_job = None
+    st.session_state.step2_job_key = None
+    st.session_state.step2_unmatched = None
+    st.session_state.step2_suggestions = None
+    st.session_state.step2_unmatched_count = 0
+    st.session_state.step2_learned = (0, 0)
+if 'step3_expand_job' not in st.session_state:
+    st.session_state.step3_expand_job = None
+    st.session_state.step3_expand_key = None
+if 'step3_job' not in st.session_state:
+    st.session_state.step3_job = None
+    st.session_state.step3_job_key = None
+    st.session_state.step3_download = None
+    st.session_state.step3_download_name = None
 
 
 def safe_read_excel(uploaded_file, required_columns=None):
-    try:
-        df = pd.read_excel(uploaded_file)
-    except Exception as e:
-        st.error(f"Failed to read file: {e}")
-        st.stop()
+    """Reads an uploaded workbook once per distinct file (keyed by its SHA-256); never modified"""
+    import pandas as pd
+
+    file_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    if st.session_state.get('upload_hash') != file_hash:
+        try:
+            df = pd.read_excel(BytesIO(file_bytes))
+        except Exception as e:
+            st.error(f"Failed to read file: {e}")
+            st.stop()
+        st.session_state.upload_data = store_frame('upload', df)
+        st.session_state.upload_hash = file_hash
+    df = st.session_state.upload_data.get()
 
     if required_columns:
         missing = [c for c in required_columns if c not in df.columns]
@@ -42,367 +80,184 @@ def safe_read_excel(uploaded_file, required_columns=None):
     return df
 
 
-# Define processing functions
-def filter_data(df):
-    """Step 1: Filter data by adjunct and remove duplicates in ARSQ180"""
-    # Filter rows containing "@adj.np.edu.sg" in Email (case insensitive)
-    email_filtered = df[df['Email'].str.contains(
-        '@adj.np.edu.sg', case=False, na=False)]
+@st.cache_resource
+def get_frame_store():
+    """
+    Memory-budgeted store for step results, shared by all sessions.
+    The shared hiring form indexes (load_lookup_index) and reattached job results
+    (load_job_result) are not in it: both are bounded caches shared across sessions.
+    """
+    return FrameStore()
 
-    # Define function to check if Class Section has ≤2 letters
-    def has_max_two_letters(value):
-        if pd.isna(value):
-            return False  # Handle missing values
-        # Extract only alphabetic characters
-        letters = ''.join([char for char in str(value) if char.isalpha()])
-        return len(letters) <= 2
 
-    # Apply the Class Section filter
-    filtered_df = email_filtered[email_filtered['Class Section'].apply(
-        has_max_two_letters)]
+def store_frame(key, df):
+    """Puts a step result in the frame store under this session; returns its handle"""
+    return get_frame_store().put(st.session_state.session_id, key, df)
 
-    return filtered_df
 
+@st.cache_resource(max_entries=8)
+def load_lookup_index(file_hash, _file_bytes):
+    """
+    Reads a hiring form and builds its LookupIndex, shared by every session
+    that uploads the same file (keyed by its SHA-256).
+    Returns:
+        tuple: (column names, LookupIndex or None if required columns are missing)
+    """
+    import pandas as pd
+    from pipeline import LOOKUP_REQUIRED_COLUMNS, LookupIndex
 
-def expand_day_column(df):
-    # Create a list to store the expanded rows
-    expanded_rows = []
-    #  Count rows with more than a single value: MON - SAT
-    multidays_count = 0
+    lookup_df = pd.read_excel(BytesIO(_file_bytes))
+    lookup_columns = lookup_df.columns.tolist()
+    if any(col not in lookup_columns for col in LOOKUP_REQUIRED_COLUMNS):
+        return lookup_columns, None
+    return lookup_columns, LookupIndex(lookup_df)
 
-    # Iterate over each row in the input DataFrame
-    for _, row in df.iterrows():
-        # Get the Day value and split it into individual days
-        day_value = str(row['Day'])
-        days = day_value.split()
 
-        # If there's only one day, just add the row as is
-        if len(days) <= 1:
-            expanded_rows.append(row.to_dict())
-        else:
-            # For each day, create a copy of the row with that single day
-            for day in days:
-                new_row = row.copy()
-                new_row['Day'] = day
-                expanded_rows.append(new_row.to_dict())
-            multidays_count += 1
+@st.cache_resource
+def get_job_store():
+    """On-disk job queue shared by all sessions for the heavy steps"""
+    return JobStore()
 
-    # Create a new DataFrame from the expanded rows
-    expanded_df = pd.DataFrame(expanded_rows)
-    return multidays_count, expanded_df
 
-# New function to format time columns
+def run_step1(df, rules, backend='pandas'):
+    """
+    Step 1 for one upload, set of exclusion rules and backend.
+    Returns:
+        tuple: (filtered_df, exclusion_hits, unparsable_times, multiday)
+    """
+    from pipeline import (ExclusionRules, expand_day_column, filter_data_with_hits,
+                          normalise_time_columns)
 
+    filtered_df, exclusion_hits = filter_data_with_hits(df, ExclusionRules(rules), backend)
+    # Format 'Start Time' and 'End Time' columns
+    filtered_df, unparsable_times = normalise_time_columns(
+        filtered_df, ['Start Time', 'End Time'])
+    # Apply the expansion function to the filtered DataFrame
+    multiday, filtered_df = expand_day_column(filtered_df, backend)
+    return filtered_df, exclusion_hits, unparsable_times, multiday
 
-def format_time_columns(df, columns):
-    for col in columns:
-        # Convert to datetime, then format as HH:MM:SS string
-        df[col] = pd.to_datetime(
-            df[col], format='%H:%M', errors='coerce').dt.strftime('%H:%M:%S')
 
-    return df
+@st.cache_resource(max_entries=4)
+def load_job_result(job_id):
+    """Result of a finished job, read from the job store once"""
+    return get_job_store().load_result(job_id)
 
 
-def merge_with_partial_match(filtered_df, lookup_df):
+@st.cache_resource
+def get_email_map():
+    """Email -> Empl ID pairs learned from earlier merges, shared by all sessions"""
+    return EmailMap()
+
+
+def submit_job(job_state_key, kind, *args, label='', **kwargs):
+    """Queues a step in the job store and remembers its id in the session and the URL"""
+    store = get_job_store()
+    job_id = store.submit(kind, *args, label=label, **kwargs)
+    ensure_worker(store.job_dir)
+    st.session_state[job_state_key] = PersistentJob(store, job_id)
+    # Keeping the id in the URL lets a refreshed tab reattach to the job
+    st.query_params['job'] = job_id
+
+
+def download_result(label, data, file_stem, key, **xlsx_options):
     """
-    Merges two DataFrames based on partial name matching and catalog/remarks matching.
+    Format picker and download button for a step result.
     Args:
-        filtered_df (pd.DataFrame): DataFrame from filtered_results.xlsx
-        lookup_df (pd.DataFrame): DataFrame from position_program_id_lookup.xlsx
-    Returns:
-        tuple: (merged_df, unmatched_df, unmatched_count)
-            - merged_df (pd.DataFrame): Merged DataFrame with required columns
-            - unmatched_df (pd.DataFrame): DataFrame containing unmatched rows
-            - unmatched_count (int): Count of unmatched rows
+        label (str): Button label
+        data (pd.DataFrame): Result to download
+        file_stem (str): File name without extension
+        key (str): Widget key prefix
+        **xlsx_options: Passed to to_excel (e.g. extra_sheets), ignored by CSV / Parquet
     """
-    # Create a copy to avoid modifying original DataFrames
-    filtered = filtered_df.copy()
-    lookup = lookup_df.copy()
-
-    # Preprocess names for comparison - convert to uppercase and split into words
-    filtered['name_words'] = filtered['Name'].str.upper().str.split()
-    lookup['lookup_words'] = lookup['Full Legal Name'].str.upper().str.split()
-
-    # Function to check if names are a partial match
-    def is_partial_match(name1, name2, min_common_tokens=2):
-        # Convert to sets
-        set1 = set(name1)
-        set2 = set(name2)
-        # Handle empty sets
-        if not set1 or not set2:
-            return False
-        # Check if there are enough common tokens
-        common = set1.intersection(set2)
-        return len(common) >= min_common_tokens
-
-    # Improved function to check if catalog number and requester remarks have a partial match
-    def is_catalog_match(catalog, remarks):
-        # Handle NaN values
-        if pd.isna(catalog) or pd.isna(remarks):
-            return False
-        # Convert to strings and strip whitespace
-        catalog_str = str(catalog).strip().replace(' ', '')
-        remarks_str = str(remarks).strip()
-        # Check if one string contains the other
-        if (catalog_str in remarks_str) or (remarks_str in catalog_str):
-            return True
-        # Extract only alphabetic characters from catalog_str
-        catalog_alpha = ''.join([c for c in catalog_str if c.isalpha()])
-        if catalog_alpha and (catalog_alpha in remarks_str):
-            return True
-        # Additional check: see if any word in catalog_str is in remarks_str
-        catalog_words = catalog_str.split('_')
-        for word in catalog_words:
-            word_alpha = ''.join([c for c in word if c.isalpha()])
-            if word_alpha and word_alpha in remarks_str:
-                return True
-        return False
-
-    # Create empty result DataFrame with Class Section
-    result_columns = [
-        'Empl ID',
-        'Full Legal Name',
-        'Time entry code',
-        'Date',  # Will be filled in Step 3
-        'Start Time',
-        'End Time',
-        'Position ID',
-        'Program ID',
-        'Comment',
-        'Day',
-        'Catalog Nbr',
-        'Name',
-        'Class Section'  # Added Class Section column
-    ]
-    result_df = pd.DataFrame(columns=result_columns)
-
-    # Track unmatched rows
-    unmatched_count = 0
-    unmatched_rows = []  # Store unmatched rows here
-
-    # Iterate through each row in filtered DataFrame
-    for _, filt_row in filtered.iterrows():
-        filt_name = filt_row['name_words']
-        catalog_nbr = filt_row['Catalog Nbr'] if 'Catalog Nbr' in filt_row else None
-        match_found = False
-
-        # Iterate through each row in lookup DataFrame
-        for _, lookup_row in lookup.iterrows():
-            lookup_name = lookup_row['lookup_words']
-            requester_remarks = lookup_row['Requester Remarks'] if 'Requester Remarks' in lookup_row else None
-
-            # Check for partial name match
-            name_match = is_partial_match(filt_name, lookup_name)
-            # Check for catalog/remarks match
-            catalog_match = is_catalog_match(catalog_nbr, requester_remarks)
-
-            # If both conditions are met, create a new row
-            if name_match and catalog_match:
-                # Create new row with required data including Class Section
-                new_row = {
-                    'Empl ID': lookup_row['Empl ID'],
-                    'Full Legal Name': lookup_row['Full Legal Name'],
-                    'Time entry code': lookup_row['Time entry code'],
-                    'Date': None,  # Will be filled in Step 3
-                    'Start Time': filt_row['Start Time'],
-                    'End Time': filt_row['End Time'],
-                    'Position ID': lookup_row['Position ID'],
-                    'Program ID': lookup_row['Program ID'],
-                    'Comment': lookup_row['Requester Remarks'],
-                    'Day': filt_row['Day'],
-                    'Catalog Nbr': filt_row['Catalog Nbr'],
-                    'Name': filt_row['Name'],
-                    # Added Class Section
-                    'Class Section': filt_row.get('Class Section', None)
-                }
-                # Append to result
-                result_df = pd.concat(
-                    [result_df, pd.DataFrame([new_row])], ignore_index=True)
-                match_found = True
-                break  # Stop after first match
-
-        if not match_found:
-            unmatched_count += 1
-            # Store the original row without the added 'name_words' column
-            # Class Section will be preserved if it exists
-            unmatched_rows.append(filt_row.drop('name_words'))
-
-    # Create DataFrame from unmatched rows
-    unmatched_df = pd.DataFrame(unmatched_rows)
-
-    # Return all three values: merged DataFrame, unmatched DataFrame, and unmatched count
-    return result_df, unmatched_df, unmatched_count
-
-
-def map_dates_to_weeks(schedule_dict):
-    week_mapping = {}
-    for day, dates in schedule_dict.items():
-        for index, date in enumerate(dates):
-            week_number = f"Week {index + 1}"
-            week_mapping[date] = week_number
-    return week_mapping
-
-
-def create_weekday_date_dict(start_date_str, end_date_str):
-    """Creates a dictionary mapping weekdays to dates within a specified range"""
-    # Parse input dates
-    start_date = datetime.datetime.strptime(start_date_str, "%d %B %Y").date()
-    end_date = datetime.datetime.strptime(end_date_str, "%d %B %Y").date()
-
-    # Initialize weekday dictionary
-    weekday_dict = {
-        'Mon': [], 'Tue': [], 'Wed': [],
-        'Thu': [], 'Fri': [], 'Sat': []
-    }
-
-    # Iterate through each date in the range
-    current_date = start_date
-    while current_date <= end_date:
-        # Get weekday (0=Monday, 6=Sunday)
-        weekday_num = current_date.weekday()
-
-        # Skip Sundays (6)
-        if weekday_num < 6:
-            # Map weekday number to dictionary key
-            weekday_key = ['Mon', 'Tue', 'Wed',
-                           'Thu', 'Fri', 'Sat'][weekday_num]
-            # Add date in YYYY-MM-DD format
-            weekday_dict[weekday_key].append(current_date.strftime("%Y-%m-%d"))
-
-        # Move to next day
-        current_date += datetime.timedelta(days=1)
-
-    return weekday_dict
-
-
-def expand_df_with_dates(merged_df, start_date_str, end_date_str):
-    """Step 3: Expand DataFrame with dates"""
-
-    # Clean 'Program ID' column
-    merged_df['Program ID'] = merged_df['Program ID'].astype(
-        str).str.split().str[0].str.strip()
-
-    # Get weekday-date mapping
-    weekday_date_dict = create_weekday_date_dict(start_date_str, end_date_str)
-
-    # Create a schedule_dict for map_dates_to_weeks
-    schedule_dict = weekday_date_dict
-
-    # Get week mapping
-    week_mapping = map_dates_to_weeks(schedule_dict)
-
-    # Define valid weekdays
-    valid_days = {'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'}
-
-    # Create a list to store expanded rows
-    expanded_rows = []
-    skipped_rows = 0
-
-    # Process each row in the merged DataFrame
-    for _, row in merged_df.iterrows():
-        # Get the Day value and split into individual days
-        day_str = str(row['Day']).strip()
-
-        # Skip if empty
-        if not day_str:
-            skipped_rows += 1
-            continue
-
-        # Split the day string and clean each part
-        day_parts = [part.strip() for part in day_str.split() if part.strip()]
-
-        # Check each part to see if it's a valid weekday
-        day_keys = []
-        skip_row = False
-        for part in day_parts:
-            # Capitalize first letter only (e.g., "MON" -> "Mon", "tue" -> "Tue")
-            standardized = part.capitalize()
-            # Check if it's a valid weekday
-            if standardized in valid_days:
-                # Add to day_keys if not already present (to avoid duplicates)
-                if standardized not in day_keys:
-                    day_keys.append(standardized)
-            else:
-                # Skip this row if any part is invalid
-                skip_row = True
-                break
-
-        if skip_row:
-            skipped_rows += 1
-            continue
-
-        # For each valid day key, create a row for each date
-        for day_key in day_keys:
-            for date in weekday_date_dict[day_key]:
-                # Create a copy of the row
-                new_row = row.copy()
-                # Add the Date column
-                new_row['Date'] = date
-                # Add the Week Number column
-                new_row['Week Number'] = week_mapping[date]
-                # 👇 Update Comment with concatenated values
-                new_row['Comment'] = f"{new_row['Week Number']}_{day_key}_{str(new_row['Catalog Nbr']).strip()}_{new_row['Class Section']}_{new_row['Full Legal Name']}".upper(
-                )
-                # Add to expanded rows
-                expanded_rows.append(new_row)
-
-    # Create the expanded DataFrame
-    expanded_df = pd.DataFrame(expanded_rows)
-
-    # Reset index
-    expanded_df.reset_index(drop=True, inplace=True)
-
-    # Reorder final DataFrame columns as specified
-    final_column_order = [
-        'Empl ID',
-        'Full Legal Name',
-        'Name',
-        'Time entry code',
-        'Date',
-        'Day',
-        'Week Number',
-        'Start Time',
-        'End Time',
-        'Position ID',
-        'Program ID',
-        'Class Section',
-        'Catalog Nbr',
-        'Comment'
-    ]
-
-    existing_columns = [
-        col for col in final_column_order if col in expanded_df.columns]
-    expanded_df = expanded_df[existing_columns]
-
-    # Reorder columns to put 'Date' immediately after 'Day'
-    if 'Day' in expanded_df.columns and 'Date' in expanded_df.columns:
-        # Get list of columns
-        cols = list(expanded_df.columns)
-        # Find the index of 'Day' column
-        day_index = cols.index('Day')
-        # Remove 'Date' from its current position
-        cols.remove('Date')
-        # Insert 'Date' right after 'Day'
-        cols.insert(day_index + 1, 'Date')
-        # Reorder the DataFrame columns
-        expanded_df = expanded_df[cols]
-
-    # Reset index to avoid duplicate indices
-    expanded_df.reset_index(drop=True, inplace=True)
-
-    return expanded_df, skipped_rows
-
-# Helper function to convert DataFrame to Excel for download
-
-
-def to_excel(df):
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    df.to_excel(writer, index=False, sheet_name='Sheet1')
-    writer.close()
-    processed_data = output.getvalue()
-    return processed_data
-
+    from pipeline import EXPORT_FORMATS, export_data
+
+    file_format = st.radio("Format", list(EXPORT_FORMATS), horizontal=True,
+                           key=f"{key}_format", help="CSV and Parquet hold the main table only.")
+    # Written only when the button is clicked, not on every rerun
+    st.download_button(
+        label=label,
+        data=functools.partial(export_data, data, file_format, **xlsx_options),
+        file_name=f"{file_stem}.{file_format}",
+        mime=EXPORT_FORMATS[file_format][1]
+    )
+
+
+def export_format_of(data):
+    """Extension and MIME type of finished export bytes (xlsx and ZIP share the PK header)"""
+    from pipeline import EXPORT_FORMATS
+
+    if data[:4] == b'PAR1':
+        return 'parquet', EXPORT_FORMATS['parquet'][1]
+    if data[:2] != b'PK':
+        return 'csv', EXPORT_FORMATS['csv'][1]
+    if '[Content_Types].xml' in zipfile.ZipFile(BytesIO(data)).namelist():
+        return 'xlsx', EXPORT_FORMATS['xlsx'][1]
+    return 'zip', 'application/zip'
+
+
+@st.fragment(run_every=1)
+def show_job_progress(job_state_key, label):
+    """Polls a background job, showing engine-fed progress and a cancel button"""
+    job = st.session_state[job_state_key]
+    if job.done():
+        # Rerun the whole page so the finished result is picked up
+        st.rerun()
+
+    # Restart the worker if it died (e.g. the host rebooted); its job is requeued
+    ensure_worker(job.store.job_dir)
+
+    done, total, eta = job.progress()
+    text = f"{label}: {done}/{total} rows"
+    if eta is not None:
+        text += f" (about {eta:.0f}s left)"
+    st.progress(done / total if total else 0.0, text=text)
+
+    if st.button("Cancel", key=f"cancel_{job_state_key}"):
+        job.cancel()
+        st.rerun()
+    st.caption(f"Job id: {job.job_id} (use it to reattach after a restart)")
+
+
+def show_preview(df, key, page_size=100):
+    """Paginated preview with server-side search and sort; only one page goes to the browser"""
+    from pipeline import format_for_export
+    from preview import DEFAULT_SEARCH_COLUMNS, column_summary, get_page, select_rows
+
+    columns = list(df.columns)
+    col1, col2, col3, col4 = st.columns([2, 3, 2, 1])
+    search = col1.text_input("Search", key=f"{key}_search")
+    search_columns = col2.multiselect(
+        "Search in", columns, key=f"{key}_search_columns",
+        default=[col for col in DEFAULT_SEARCH_COLUMNS if col in columns])
+    sort_by = col3.selectbox(
+        "Sort by", [None] + columns, key=f"{key}_sort_by",
+        format_func=lambda col: "File order" if col is None else col)
+    ascending = col4.selectbox(
+        "Order", ["Ascending", "Descending"], key=f"{key}_order") == "Ascending"
+
+    positions = select_rows(df, search, search_columns, sort_by, ascending)
+    n_pages = max(1, -(-len(positions) // page_size))
+    # Keep the page number valid when a search shrinks the result
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = st.number_input(
+        f"Page (of {n_pages})", min_value=1, max_value=n_pages, key=f"{key}_page")
+
+    # Times, 'Week Number' and 'Date' are stored compactly; show them as in the files
+    st.dataframe(format_for_export(get_page(df, positions, page, page_size)))
+    st.caption(f"{len(positions)} of {len(df)} rows match; showing {page_size} per page")
+
+    if st.checkbox("Show column summary", key=f"{key}_summary"):
+        st.dataframe(column_summary(df))
+
+
+# Sessions idle past the frame store's TTL are swept; a swept session starts over
+if not get_frame_store().touch(st.session_state.session_id):
+    for state_key in ['upload_data', 'step1_data', 'step2_data', 'step3_plan', 'step3_data',
+                      'step3_reports', 'step3_download', 'upload_hash', 'step1_key',
+                      'step2_job_key', 'step3_plan_key', 'step3_expand_key', 'step3_job_key']:
+        st.session_state[state_key] = None
+    st.session_state.current_step = 0
 
 # Sidebar for navigation
 st.sidebar.markdown("**Workflow Steps**")
@@ -433,8 +288,9 @@ if st.session_state.current_step == 0:  # Filter ASRQ180
     
     **Instructions**: 
     1. Upload a ASRQ180 file.
-    2. The app will filter, remove and expand rows and display results.
-    3. Download the filtered data and proceed to Step 2.
+    2. Optionally choose Class Sections that bypass the 2-letter rule.
+    3. The app will filter, remove and expand rows and display results.
+    4. Download the filtered data and proceed to Step 2.
     """)
 
     # File upload
@@ -442,37 +298,54 @@ if st.session_state.current_step == 0:  # Filter ASRQ180
         "**Upload ASRQ180 file (xlsx)**", type=["xlsx"])
 
     if uploaded_file is not None:
-        # Read the Excel file
-        # df = pd.read_excel(uploaded_file)
-
+        # Read the Excel file (once per distinct upload)
         df = safe_read_excel(uploaded_file, [
                              "Email", "Class Section", "Day", "Start Time", "End Time", "Name", "Catalog Nbr"])
 
-        # Process the data
-        with st.spinner("Processing your data..."):
-            filtered_df = filter_data(df)
-            # Format 'Start Time' and 'End Time' columns
-            filtered_df = format_time_columns(filtered_df,
-                                              ['Start Time',
-                                               'End Time'])
-            # Apply the expansion function to the filtered DataFrame
-            multiday, filtered_df = expand_day_column(filtered_df)
-            st.session_state.step1_data = filtered_df
+        # Class Section exceptions: picked sections plus typed prefixes / patterns
+        excluded_sections = st.multiselect(
+            "**Class sections to keep despite the 2-letter rule**",
+            options=sorted(df['Class Section'].dropna().astype(str).unique().tolist()))
+        exclusion_patterns = st.text_input(
+            "Prefixes or patterns to keep (comma separated)", placeholder="e.g. TSP*, WSP*",
+            help="A trailing * keeps every section starting with the text; * and ? match "
+                 "any characters / one character anywhere. Case is ignored.")
+        rules = tuple(rule.strip() for rule in excluded_sections + exclusion_patterns.split(',')
+                      if rule.strip())
+        # The Polars backend is offered when polars is installed; both give the same result
+        backend = st.selectbox(
+            "Processing backend",
+            ['pandas'] + (['polars'] if importlib.util.find_spec('polars') else []),
+            help="polars runs the filter and Day split as multithreaded lazy queries.")
+
+        # Process the data; reruns with the same file and rules reuse the result
+        step1_key = (st.session_state.upload_hash, rules, backend)
+        if st.session_state.get('step1_key') != step1_key:
+            with st.spinner("Processing your data..."):
+                filtered_df, exclusion_hits, unparsable_times, multiday = run_step1(
+                    df, rules, backend)
+            st.session_state.step1_data = store_frame('step1', filtered_df)
+            st.session_state.step1_report = (exclusion_hits, unparsable_times, multiday)
+            st.session_state.step1_key = step1_key
+        filtered_df = st.session_state.step1_data.get()
+        exclusion_hits, unparsable_times, multiday = st.session_state.step1_report
 
         # Display results
         st.subheader("Filtered Data Results")
         st.write(f"Original rows: {len(df)}")
         st.write(f"Filtered rows: {len(filtered_df)}")
         st.write(f"Expanded rows with multiple DAY: {multiday}")
-        st.dataframe(filtered_df)
+        if len(rules):
+            with st.expander(f"Exclusion rules ({len(rules)})"):
+                st.dataframe(exclusion_hits, hide_index=True)
+        for col, values in unparsable_times.items():
+            if values:
+                st.warning(f"{col}: could not read {', '.join(map(str, values))} "
+                           f"(left empty; expected HH:MM or HH:MM:SS)")
+        show_preview(filtered_df, 'step1_preview')
 
         # Download button
-        st.download_button(
-            label="Download Filtered Data",
-            data=to_excel(filtered_df),
-            file_name="filtered_results.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        download_result("Download Filtered Data", filtered_df, "filtered_results", 'step1_download')
 
         # Proceed to next step
         if st.button("Proceed to Step 2"):
@@ -505,19 +378,22 @@ elif st.session_state.current_step == 1:  # Merge ASRQ180 headers with Hiring Fo
             "**Upload hiring form (xlsx)**", type=["xlsx"])
 
         if uploaded_file is not None:
-            # Read the Excel file
-            lookup_df = pd.read_excel(uploaded_file)
+            # Read and index the hiring form once per distinct file, across all sessions
+            file_bytes = uploaded_file.getvalue()
+            file_hash = hashlib.sha256(file_bytes).hexdigest()
+            lookup_columns, lookup_index = load_lookup_index(
+                file_hash, file_bytes)
 
             # Display column names for debugging
             st.subheader("Lookup File Columns")
             st.write("Column names in the uploaded lookup file:")
-            st.code(", ".join(lookup_df.columns.tolist()))
+            st.code(", ".join(lookup_columns))
 
             # Check for required columns
-            required_columns = ['Full Legal Name', 'Empl ID', 'Time entry code',
-                                'Position ID', 'Program ID', 'Requester Remarks']
+            from pipeline import LOOKUP_REQUIRED_COLUMNS
+
             missing_columns = [
-                col for col in required_columns if col not in lookup_df.columns]
+                col for col in LOOKUP_REQUIRED_COLUMNS if col not in lookup_columns]
 
             if missing_columns:
                 st.error(
@@ -525,37 +401,102 @@ elif st.session_state.current_step == 1:  # Merge ASRQ180 headers with Hiring Fo
                 st.info(
                     "Please check your file and ensure it contains all required columns.")
             else:
-                # Process the data
-                with st.spinner("Merging data..."):
-                    merged_df, unmatched_df, unmatched_count = merge_with_partial_match(
-                        st.session_state.step1_data, lookup_df)
-                    st.session_state.step2_data = merged_df
-
-                st.subheader("Merge Results Summary")
-                st.write(f"Filtered rows: {len(st.session_state.step1_data)}")
-                st.write(f"Merged rows: {len(merged_df)}")
-                st.dataframe(merged_df)
-
-                # Display unmatched rows instead of merged data
-                st.subheader("Unmatched Rows")
-                if unmatched_count > 0:
-                    # st.write(f"Unmatched rows: {unmatched_count}")
-                    st.write(
-                        f"Displaying {unmatched_count} unmatched rows:")
-                    st.dataframe(unmatched_df)
-
-                # Download button
-                st.download_button(
-                    label="Download Merged Data",
-                    data=to_excel(merged_df),
-                    file_name="merged_output.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-
-                # Proceed to next step
-                if st.button("Proceed to Step 3"):
-                    st.session_state.current_step = 2
-                    st.rerun()
+                from pipeline import (MERGE_ENGINE_MODULES, MERGE_ENGINES, confirmed_email_matches,
+                                      suggest_matches)
+
+                # Run the merge in the background; restart only when the inputs change
+                st.caption(
+                    f"Shared hiring form index {file_hash[:8]}: {len(lookup_index)} rows, "
+                    f"{lookup_index.nbytes() / MB:.1f} MB")
+                # Engines whose optional module is not installed are not offered
+                merge_engine = st.selectbox(
+                    "Matching engine",
+                    [engine for engine in MERGE_ENGINES if engine not in MERGE_ENGINE_MODULES
+                     or importlib.util.find_spec(MERGE_ENGINE_MODULES[engine])],
+                    help="first-match: first hiring form row that matches (original rules). "
+                         "sparse: best scoring row, with the number of competing candidates. "
+                         "duckdb: same result as first-match, as one SQL query (needs duckdb).")
+                use_email_map = st.checkbox(
+                    f"Match known emails first ({len(get_email_map())} learned)", value=True,
+                    help="Rows whose email was matched to an Empl ID before are joined on the "
+                         "email; only unknown emails go through name/catalog matching.")
+                job_key = (file_hash, id(st.session_state.step1_data), merge_engine, use_email_map)
+                if st.session_state.step2_job_key != job_key:
+                    submit_job('step2_job', 'merge', st.session_state.step1_data.get(), lookup_index,
+                               engine=merge_engine,
+                               email_map=get_email_map().load() if use_email_map else None,
+                               label=uploaded_file.name)
+                    st.session_state.step2_job_key = job_key
+                    st.session_state.step2_data = None
+
+                job = st.session_state.step2_job
+                if not job.done():
+                    show_job_progress('step2_job', "Merging data")
+                elif job.cancelled():
+                    st.warning("Merge cancelled.")
+                    if st.button("Restart merge"):
+                        st.session_state.step2_job_key = None
+                        st.rerun()
+                elif job.error() is not None:
+                    st.error(f"Merge failed: {job.error()}")
+                else:
+                    # Move the finished result into the frame store once
+                    if st.session_state.step2_data is None:
+                        merged_df, unmatched_df, unmatched_count = job.result()
+                        st.session_state.step2_data = store_frame('step2', merged_df)
+                        st.session_state.step2_unmatched = store_frame(
+                            'step2_unmatched', unmatched_df)
+                        st.session_state.step2_unmatched_count = unmatched_count
+                        # Learn the emails of unambiguous name/catalog matches
+                        st.session_state.step2_learned = get_email_map().update(
+                            confirmed_email_matches(merged_df))
+                        # Ranked hiring form candidates, so rows need not be looked up by hand
+                        st.session_state.step2_suggestions = store_frame(
+                            'step2_suggestions', suggest_matches(unmatched_df, lookup_index)
+                        ) if unmatched_count > 0 else None
+                    merged_df = st.session_state.step2_data.get()
+                    unmatched_df = st.session_state.step2_unmatched.get()
+                    unmatched_count = st.session_state.step2_unmatched_count
+
+                    st.subheader("Merge Results Summary")
+                    st.write(f"Filtered rows: {len(st.session_state.step1_data)}")
+                    st.write(f"Merged rows: {len(merged_df)}")
+                    if 'Matched By' in merged_df.columns:
+                        added, conflicts = st.session_state.step2_learned
+                        st.caption(
+                            f"Matched by known email: {int((merged_df['Matched By'] == 'email').sum())} rows; "
+                            f"learned {added} new emails"
+                            + (f", {conflicts} disagreed with the stored Empl ID (kept)" if conflicts else ""))
+                    if 'Candidates' in merged_df.columns:
+                        ambiguous = int((merged_df['Candidates'] > 1).sum())
+                        if ambiguous:
+                            st.warning(f"{ambiguous} rows matched more than one hiring form row; "
+                                       f"sort by 'Candidates' to review them.")
+                    show_preview(merged_df, 'step2_preview')
+
+                    # Display unmatched rows instead of merged data
+                    st.subheader("Unmatched Rows")
+                    if unmatched_count > 0:
+                        # st.write(f"Unmatched rows: {unmatched_count}")
+                        st.write(
+                            f"Displaying {unmatched_count} unmatched rows:")
+                        show_preview(unmatched_df, 'step2_unmatched_preview')
+
+                        suggestions_df = st.session_state.step2_suggestions.get()
+                        with st.expander("Suggested matches (top 3 per unmatched row)"):
+                            show_preview(suggestions_df, 'step2_suggestions_preview')
+                        download_result("Download Unmatched Rows", unmatched_df, "unmatched_rows",
+                                        'step2_unmatched_download',
+                                        extra_sheets={'Suggestions': suggestions_df})
+
+                    # Download button
+                    download_result("Download Merged Data", merged_df, "merged_output",
+                                    'step2_download')
+
+                    # Proceed to next step
+                    if st.button("Proceed to Step 3"):
+                        st.session_state.current_step = 2
+                        st.rerun()
         else:
             st.info("Please upload your lookup data file.")
 
@@ -601,32 +542,206 @@ elif st.session_state.current_step == 2:  # Expand rows with date range
             )
             end_date = end_date_obj.strftime("%d %B %Y")
 
-        # Process the data
+        # The expansion is kept factorised (merged rows once + a row id/calendar index
+        # pair per output row); rows are only built for the preview page and, chunk
+        # by chunk, when the download is written in the background
+        expansion_key = (start_date, end_date, id(st.session_state.step2_data))
+        from pipeline import EXPANSION_MEMORY_LIMIT, LazyExpansion
+
+        # Exact output size (and estimated memory as a table) before any row is built
+        if st.session_state.get('step3_plan_key') != expansion_key:
+            plan = LazyExpansion(st.session_state.step2_data.get(), start_date, end_date)
+            st.session_state.step3_plan = store_frame('step3_plan', plan)
+            st.session_state.step3_plan_info = (plan.estimated_nbytes(), plan.rows_per_day())
+            st.session_state.step3_plan_key = expansion_key
+        plan = st.session_state.step3_plan.get()
+        plan_nbytes, rows_per_day = st.session_state.step3_plan_info
+        st.caption(f"Expands to {len(plan):,} rows ("
+                   + ", ".join(f"{day} {rows:,}" for day, rows in rows_per_day.items())
+                   + f"), about {plan_nbytes / MB:,.1f} MB as a table.")
+        if plan_nbytes > EXPANSION_MEMORY_LIMIT:
+            st.warning(f"This is above the {EXPANSION_MEMORY_LIMIT // MB} MB limit: check the "
+                       f"date range. Rows are only built one chunk at a time for the preview "
+                       f"and downloads.")
+
         if st.button("Expand Data"):
-            with st.spinner("Expanding data with dates..."):
-                expanded_df, skipped_rows = expand_df_with_dates(
-                    st.session_state.step2_data, start_date, end_date
-                )
-                st.session_state.step3_data = expanded_df
+            # The expansion and the reports over all of it run in the background
+            submit_job('step3_expand_job', 'expand_reports', st.session_state.step2_data.get(),
+                       start_date, end_date, label=f"{start_date} - {end_date}")
+            st.session_state.step3_expand_key = expansion_key
+            st.session_state.step3_job_key = None
+            st.session_state.step3_job = None
+            st.session_state.step3_download = None
+
+        expand_job = st.session_state.step3_expand_job
+        expanding = expand_job is not None and st.session_state.step3_expand_key == expansion_key
+        if expanding and st.session_state.step3_job_key != expansion_key:
+            if not expand_job.done():
+                show_job_progress('step3_expand_job', "Expanding data")
+            elif expand_job.cancelled():
+                st.warning("Expansion cancelled.")
+            elif expand_job.error() is not None:
+                st.error(f"Expansion failed: {expand_job.error()}")
+            else:
+                # Picked up once; the reports are not recomputed on reruns
+                expansion, reports = expand_job.result()
+                st.session_state.step3_data = store_frame('step3', expansion)
+                st.session_state.step3_reports = {
+                    name: store_frame(f'step3 {name}', report) for name, report in reports.items()}
+                st.session_state.step3_job_key = expansion_key
+
+        if st.session_state.step3_job_key != expansion_key:
+            if not expanding:
+                st.info("Click 'Expand Data' to process with the selected date range.")
+        else:
+            from pipeline import EXPORT_FORMATS, PARTITION_COLUMNS, format_for_export
+
+            expansion = st.session_state.step3_data.get()
 
             # Display results
             st.subheader("Expanded Data")
             st.write(f"Merged rows: {len(st.session_state.step2_data)}")
-            st.write(f"Expanded rows: {len(expanded_df)}")
-            st.write(f"Skipped rows: {skipped_rows}")
-            st.dataframe(expanded_df)
-
-            # Download button
-            st.download_button(
-                label="Download Expanded Data",
-                data=to_excel(expanded_df),
-                file_name="expanded_with_dates.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            st.write(f"Expanded rows: {len(expansion)}")
+            st.write(f"Skipped rows: {expansion.skipped_rows}")
+            st.caption(f"Expanded data held in {expansion.nbytes() / MB:.1f} MB")
+            show_preview(expansion, 'step3_preview')
+
+            # Claimable hours per lecturer and week (also written to the download)
+            hours_df = st.session_state.step3_reports['Hours Summary'].get()
+            with st.expander("Hours per lecturer and week"):
+                st.dataframe(format_for_export(hours_df), hide_index=True)
+
+            # Overlapping sessions of the same lecturer are rejected by payroll
+            report_sheets = {'Hours Summary': hours_df}
+            clashes_df = st.session_state.step3_reports['Clashes'].get()
+            if len(clashes_df):
+                st.warning(f"{len(clashes_df)} sessions overlap another session of the same "
+                           f"lecturer on the same date (see the 'Clashes' sheet).")
+                with st.expander("Clashing sessions"):
+                    st.dataframe(format_for_export(clashes_df), hide_index=True)
+                report_sheets['Clashes'] = clashes_df
+
+            # Payroll uploads are limited in size: optionally split into a ZIP of workbooks
+            split_by = st.selectbox("Split download by", ['No split'] + PARTITION_COLUMNS)
+            max_rows = st.number_input("Max rows per file (0 = no limit)",
+                                       min_value=0, value=0, step=1000)
+            split_download = split_by != 'No split' or max_rows > 0
+            file_format = st.radio("Format", list(EXPORT_FORMATS), horizontal=True,
+                                   key='step3_download_format',
+                                   help="CSV and Parquet hold the claims only (no report sheets) "
+                                        "and are much faster to write.")
+            native_dates = st.checkbox(
+                "Write dates and times as Excel values", disabled=file_format != 'xlsx',
+                help="Date / Start Time / End Time become real Excel dates and times "
+                     "(sortable, same display) instead of text.")
+
+            job = st.session_state.step3_job
+            if job is None:
+                if st.button("Prepare Download"):
+                    st.session_state.step3_download_name = "expanded_with_dates." + (
+                        'zip' if split_download else file_format)
+                    if split_download:
+                        submit_job('step3_job', 'export_zip', expansion,
+                                   by=None if split_by == 'No split' else split_by,
+                                   max_rows=max_rows or None, extra_sheets=report_sheets,
+                                   native_dates=native_dates, file_format=file_format,
+                                   label=f"{start_date} - {end_date}")
+                    else:
+                        submit_job('step3_job', 'export', expansion, file_format,
+                                   extra_sheets=report_sheets, native_dates=native_dates,
+                                   label=f"{start_date} - {end_date}")
+                    st.rerun()
+            elif not job.done():
+                show_job_progress('step3_job', "Writing expanded data")
+            elif job.cancelled():
+                st.warning("Download cancelled.")
+                if st.button("Prepare Download"):
+                    st.session_state.step3_job = None
+                    st.rerun()
+            elif job.error() is not None:
+                st.error(f"Export failed: {job.error()}")
+            else:
+                # Read the written workbook from the job store once
+                if st.session_state.step3_download is None:
+                    st.session_state.step3_download = store_frame('step3_download', job.result())
+                download_data = st.session_state.step3_download.get()
+
+                # Download button
+                st.download_button(
+                    label="Download Expanded Data",
+                    data=download_data,
+                    file_name=st.session_state.step3_download_name,
+                    mime=export_format_of(download_data)[1]
+                )
+                if st.button("Prepare Another Download"):
+                    st.session_state.step3_job = None
+                    st.session_state.step3_download = None
+                    st.rerun()
+                # Success message
+                st.success("Processing complete! You can download your final data.")
+
+# Jobs: reattach to a merge or expansion by id, e.g. after a refresh or restart
+st.sidebar.markdown("---")
+st.sidebar.markdown("### Jobs")
+reattach_id = st.sidebar.text_input(
+    "Job id", value=st.query_params.get('job', '')).strip()
+if reattach_id:
+    store = get_job_store()
+    job_row = store.get(reattach_id)
+    if job_row is None:
+        st.sidebar.error("Unknown job id.")
+    else:
+        st.session_state.reattached_job = PersistentJob(store, reattach_id)
+        job = st.session_state.reattached_job
+        st.sidebar.write(f"{job_row['kind'].capitalize()} job: {job_row['status']}")
+        if not job.done():
+            with st.sidebar:
+                show_job_progress('reattached_job', "Progress")
+        elif job.error() is not None:
+            st.sidebar.error(f"Job failed: {job.error()}")
+        elif not job.cancelled():
+            from pipeline import to_excel
+
+            mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            if job_row['kind'] == 'merge':
+                merged_df, unmatched_df, unmatched_count = load_job_result(reattach_id)
+                job_output, file_name = functools.partial(to_excel, merged_df), "merged_output.xlsx"
+            elif job_row['kind'] in ('export', 'export_zip'):
+                # Export jobs return the finished file
+                job_output = load_job_result(reattach_id)
+                extension, mime = export_format_of(job_output)
+                file_name = f"expanded_with_dates.{extension}"
+            elif job_row['kind'] == 'expand_reports':
+                expansion, reports = load_job_result(reattach_id)
+                job_output = functools.partial(to_excel, expansion, extra_sheets=reports)
+                file_name = "expanded_with_dates.xlsx"
+            else:
+                expanded_df, skipped_rows = load_job_result(reattach_id)
+                job_output = functools.partial(to_excel, expanded_df)
+                file_name = "expanded_with_dates.xlsx"
+            st.sidebar.download_button(
+                label="Download Job Output",
+                data=job_output,
+                file_name=file_name,
+                mime=mime
             )
-            # Success message
-            st.success("Processing complete! You can download your final data.")
-        else:
-            st.info("Click 'Expand Data' to process with the selected date range.")
+            # A finished merge can be picked up by Step 3 without redoing Steps 1-2
+            if job_row['kind'] == 'merge' and st.sidebar.button("Continue to Step 3"):
+                st.session_state.step2_data = store_frame('step2', merged_df)
+                st.session_state.current_step = 2
+                st.rerun()
+
+with st.sidebar.expander("Recent jobs"):
+    # A plain table: no DataFrame (and no pandas) needed on every page
+    st.markdown("| id | kind | label | status | done / total |\n|---|---|---|---|---|\n" + "\n".join(
+        f"| {job['id']} | {job['kind']} | {job['label']} | {job['status']} | "
+        f"{job['done'] or 0} / {job['total'] or 0} |"
+        for job in get_job_store().recent_jobs(10)))
+
+# Memory held by this session's step results
+usage = get_frame_store().usage(st.session_state.session_id)
+st.sidebar.caption(
+    f"Session data: {usage['in_memory'] / MB:.1f} MB in memory, {usage['spilled'] / MB:.1f} MB on disk")
 
 # Footer
 st.sidebar.markdown("---")
@@ -0,0 +1,14 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# The project is a set of top-level modules, imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Jobs and learned emails of the app tests go to a temporary directory (read at import)
+_state_dir = tempfile.mkdtemp(prefix='claim_tests_')
+atexit.register(shutil.rmtree, _state_dir, ignore_errors=True)
+os.environ['CLAIM_JOB_DIR'] = os.path.join(_state_dir, 'job_data')
+os.environ['CLAIM_EMAIL_MAP'] = os.path.join(_state_dir, 'email_map.sqlite3')
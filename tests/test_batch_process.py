@@ -0,0 +1,59 @@
+import os
+
+import pandas as pd
+
+from batch_process import run_batch
+from pipeline import read_table
+
+START_DATE, END_DATE = '1 April 2024', '30 April 2024'
+
+
+def write_school(input_dir, school, lecturers, first_empl_id):
+    """Writes '<school>_asrq180.xlsx' and '<school>_hiring_form.xlsx', one session per lecturer"""
+    n_rows = len(lecturers)
+    pd.DataFrame({
+        'Email': [f"{name.split()[0].lower()}@adj.np.edu.sg" for name in lecturers],
+        'Name': [name.upper() for name in lecturers],
+        'Catalog Nbr': ['AB101'] * n_rows, 'Class Section': ['T01'] * n_rows,
+        'Day': ['MON'] * n_rows, 'Start Time': ['09:00'] * n_rows, 'End Time': ['11:00'] * n_rows,
+    }).to_excel(os.path.join(input_dir, f'{school}_asrq180.xlsx'), index=False)
+    pd.DataFrame({
+        'Full Legal Name': lecturers, 'Empl ID': range(first_empl_id, first_empl_id + n_rows),
+        'Time entry code': ['X'] * n_rows, 'Position ID': range(n_rows),
+        'Program ID': [f'{school.upper()}_PR01 (ACC)'] * n_rows,
+        'Requester Remarks': ['AB101'] * n_rows,
+    }).to_excel(os.path.join(input_dir, f'{school}_hiring_form.xlsx'), index=False)
+
+
+def test_two_schools_give_per_school_and_combined_outputs(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_dir.mkdir()
+    write_school(str(input_dir), 'bus', ['Tan Ah Kow', 'Lim Bee'], 10001)
+    write_school(str(input_dir), 'eng', ['Ong Choo'], 20001)
+
+    summary_df = run_batch(str(input_dir), str(output_dir), START_DATE, END_DATE,
+                           max_workers=2, use_email_map=False)
+
+    # 5 Mondays in April 2024
+    assert summary_df['School'].tolist() == ['bus', 'eng']
+    assert summary_df['Merged rows'].tolist() == [2, 1]
+    assert summary_df['Unmatched rows'].tolist() == [0, 0]
+    assert summary_df['Expanded rows'].tolist() == [10, 5]
+    for school, expanded_rows in [('bus', 10), ('eng', 5)]:
+        school_dir = output_dir / school
+        assert sorted(os.listdir(school_dir)) == [
+            'expanded_with_dates.xlsx', 'filtered_results.xlsx', 'merged_output.xlsx']
+        expanded_df = read_table(str(school_dir / 'expanded_with_dates.xlsx'))
+        assert len(expanded_df) == expanded_rows
+        assert set(expanded_df['Program ID']) == {f'{school.upper()}_PR01'}
+
+    combined_path = output_dir / 'all_schools_expanded_with_dates.xlsx'
+    sheets = pd.read_excel(combined_path, sheet_name=None)
+    # Different lecturers, so no Clashes sheet
+    assert list(sheets) == ['Sheet1', 'Hours Summary']
+    combined_df = sheets['Sheet1']
+    assert combined_df['School'].value_counts().to_dict() == {'bus': 10, 'eng': 5}
+    # Schools are combined in alphabetical order
+    assert combined_df['School'].tolist() == ['bus'] * 10 + ['eng'] * 5
+    assert sheets['Hours Summary']['Hours'].sum() == 15 * 2
+    assert len(pd.read_excel(output_dir / 'batch_summary.xlsx')) == 2
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from copy_benchmark import legacy_steps, measure_step, pipeline_steps
+
+START_DATE, END_DATE = '1 April 2024', '30 April 2024'
+
+# Highest tracemalloc peak of each step, as a multiple of its input plus output size:
+# about 1.3x what the steps allocate now. tracemalloc sees Python and NumPy memory,
+# not the Arrow buffers of str columns; the day split and merge build rows in Python.
+PEAK_BOUNDS = {
+    'filter': 0.8,
+    'time columns': 0.3,
+    'day split': 13,
+    'merge': 15,
+    'date expansion': 3.5,
+    'export format': 0.6,
+}
+
+
+def synthetic_inputs(n_rows, n_lecturers=50, seed=0):
+    """ASRQ180 export of n_rows rows (a quarter not adjunct) and the matching hiring form"""
+    rng = np.random.default_rng(seed)
+    names = [f"LECTURER {i}" for i in range(n_lecturers)]
+    lecturer = rng.integers(0, n_lecturers, n_rows)
+    asrq_df = pd.DataFrame({
+        'Email': [f"l{i}@np.edu.sg" if row % 4 == 0 else f"l{i}@adj.np.edu.sg"
+                  for row, i in enumerate(lecturer)],
+        'Name': [names[i] for i in lecturer],
+        'Catalog Nbr': [f"AB{100 + i % 10}" for i in lecturer],
+        'Class Section': rng.choice(['T01', 'T02', 'TSP1', 'P03'], n_rows),
+        'Day': rng.choice(['MON', 'TUE WED', 'THU', 'FRI'], n_rows),
+        'Start Time': rng.choice(['09:00', '10:00:00', '14:00'], n_rows),
+        'End Time': rng.choice(['11:00', '12:00:00', '16:00'], n_rows)})
+    lookup_df = pd.DataFrame({
+        'Full Legal Name': [name.title() for name in names],
+        'Empl ID': range(10000, 10000 + n_lecturers), 'Time entry code': 'X',
+        'Position ID': range(n_lecturers), 'Program ID': 'NPO_PR0202 (ACC)',
+        'Requester Remarks': [f"AB{100 + i % 10}" for i in range(n_lecturers)]})
+    return asrq_df, lookup_df
+
+
+def run_measured(steps, asrq_df, lookup_df):
+    """(name, input bytes, output bytes, peak bytes, input unchanged) of each chained step"""
+    measurements = []
+    data = asrq_df
+    for name, function in steps:
+        inputs = (data, lookup_df) if name.endswith('merge') else (data,)
+        input_size = data.memory_usage(deep=True).sum()
+        data, peak, unchanged = measure_step(function, *inputs)
+        measurements.append((name, input_size, data.memory_usage(deep=True).sum(), peak, unchanged))
+    return measurements
+
+
+def test_pipeline_steps_leave_inputs_unchanged_within_peak_bounds():
+    asrq_df, lookup_df = synthetic_inputs(2000)
+    measurements = run_measured(
+        pipeline_steps('first-match', START_DATE, END_DATE), asrq_df, lookup_df)
+    assert [name for name, *_ in measurements] == list(PEAK_BOUNDS)
+    for name, input_size, output_size, peak, unchanged in measurements:
+        assert unchanged, f"{name} modified its input"
+        assert output_size > 0
+        assert peak <= PEAK_BOUNDS[name] * (input_size + output_size), \
+            f"{name}: peak {peak} bytes for {input_size} + {output_size} bytes"
+
+
+def test_legacy_scripts_leave_inputs_unchanged():
+    # The S-scripts merge and expand row by row; a small frame keeps this quick
+    asrq_df, lookup_df = synthetic_inputs(100)
+    measurements = run_measured(legacy_steps(START_DATE, END_DATE), asrq_df, lookup_df)
+    for name, _, output_size, _, unchanged in measurements:
+        assert unchanged, f"{name} modified its input"
+        assert output_size > 0
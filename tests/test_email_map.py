@@ -0,0 +1,62 @@
+import sqlite3
+
+import pandas as pd
+
+from email_map import EmailMap
+from pipeline import confirmed_email_matches, merge_data, normalise_empl_id
+
+
+def step1_rows():
+    return pd.DataFrame({
+        'Email': ['Tan.AK@adj.np.edu.sg', 'lim.b@adj.np.edu.sg', 'tan.ak@adj.np.edu.sg'],
+        'Name': ['TAN AH KOW', 'LIM BEE', 'TAN AH KOW'],
+        'Catalog Nbr': ['AB101', 'CD202', 'AB101'],
+        'Class Section': ['T01', 'T02', 'T03'], 'Day': ['MON', 'TUE', 'WED'],
+        'Start Time': ['09:00', '10:00', '14:00'], 'End Time': ['11:00', '12:00', '16:00']})
+
+
+def hiring_form():
+    return pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow', 'Lim Bee'], 'Empl ID': [10019, 10020],
+        'Time entry code': ['X', 'Y'], 'Position ID': [1, 2],
+        'Program ID': ['NPO_PR0202 (ACC)', 'NPO_PR0303'], 'Requester Remarks': ['AB101', 'CD202']})
+
+
+def test_normalise_empl_id():
+    assert normalise_empl_id(10019) == normalise_empl_id(10019.0) == '10019'
+    assert normalise_empl_id('10019.0') == normalise_empl_id(' 10019 ') == '10019'
+    assert normalise_empl_id('00123') == '00123'
+    assert normalise_empl_id('E123') == 'E123'
+    assert normalise_empl_id(None) is None and normalise_empl_id(float('nan')) is None
+
+
+def test_learned_emails_are_used_by_the_next_merge(tmp_path):
+    email_map = EmailMap(str(tmp_path / 'email_map.sqlite3'))
+    first_df, _, unmatched_count = merge_data(
+        step1_rows(), hiring_form(), email_map=email_map.load())
+    assert unmatched_count == 0
+    assert set(first_df['Matched By']) == {'first-match'}
+    # Nothing matched by email, so the Empl IDs must not have become floats
+    assert first_df['Empl ID'].tolist() == [10019, 10020, 10019]
+
+    learned = confirmed_email_matches(first_df)
+    assert learned == {'tan.ak@adj.np.edu.sg': '10019', 'lim.b@adj.np.edu.sg': '10020'}
+    assert email_map.update(learned) == (2, 0)
+
+    second_df, _, unmatched_count = merge_data(
+        step1_rows(), hiring_form(), email_map=email_map.load())
+    assert unmatched_count == 0
+    assert second_df['Matched By'].tolist() == ['email', 'email', 'email']
+    assert second_df['Empl ID'].tolist() == [10019, 10020, 10019]
+    pd.testing.assert_frame_equal(
+        second_df.drop(columns='Matched By').astype(object),
+        first_df.drop(columns='Matched By').astype(object))
+
+
+def test_float_empl_ids_stored_earlier_are_fixed(tmp_path):
+    path = str(tmp_path / 'email_map.sqlite3')
+    EmailMap(path)
+    with sqlite3.connect(path) as conn:
+        conn.executemany("INSERT INTO email_map VALUES (?, ?, 0)",
+                         [('tan.ak@adj.np.edu.sg', '10019.0'), ('x@adj.np.edu.sg', 'E1.0')])
+    assert EmailMap(path).load() == {'tan.ak@adj.np.edu.sg': '10019', 'x@adj.np.edu.sg': 'E1.0'}
@@ -0,0 +1,59 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from frame_store import FrameStore
+from pipeline import LazyExpansion
+
+
+def sample_merged(n_rows=20):
+    return pd.DataFrame({
+        'Empl ID': np.arange(n_rows), 'Full Legal Name': [f"Name {i}" for i in range(n_rows)],
+        'Day': ['MON', 'TUE WED'] * (n_rows // 2), 'Program ID': ['NPO_PR0202 (ACC)'] * n_rows,
+        'Catalog Nbr': ['AB101'] * n_rows, 'Class Section': ['T01'] * n_rows})
+
+
+def test_step3_objects_count_against_the_budget(tmp_path):
+    store = FrameStore(str(tmp_path))
+    plan = LazyExpansion(sample_merged(), '1 April 2024', '30 June 2024')
+    plan_handle = store.put('s', 'step3_plan', plan)
+    expansion_handle = store.put('s', 'step3', plan.factorise())
+    download_handle = store.put('s', 'step3_download', b'x' * 1000)
+    assert plan_handle.nbytes == plan.nbytes() > 0
+    assert expansion_handle.nbytes == plan.factorise().nbytes()
+    assert download_handle.nbytes == 1000
+    assert store.usage('s')['in_memory'] == (
+        plan_handle.nbytes + expansion_handle.nbytes + download_handle.nbytes)
+
+
+def test_objects_other_than_frames_are_spilled_and_read_back(tmp_path):
+    store = FrameStore(str(tmp_path), spill_threshold=100)
+    plan = LazyExpansion(sample_merged(), '1 April 2024', '30 June 2024')
+    handle = store.put('s', 'step3', plan.factorise())
+    download = store.put('s', 'step3_download', b'x' * 1000)
+    assert not handle.in_memory and handle.path.endswith('.pkl')
+    assert len(handle.get()) == len(plan)
+    assert download.get() == b'x' * 1000
+
+
+def test_idle_sessions_are_swept(tmp_path):
+    store = FrameStore(str(tmp_path), spill_threshold=0, session_ttl=60)
+    idle = store.put('idle', 'step1', sample_merged())
+    active = store.put('active', 'step1', sample_merged())
+    assert os.path.exists(idle.path)
+    # 'idle' was last seen 90 s ago, 'active' just now
+    store._last_seen['idle'] = time.time() - 90
+    assert store.sweep(now=time.time() - 40) == []
+    assert store.sweep() == ['idle']
+    assert not os.path.exists(idle.path)
+    assert not store.holds(idle) and store.holds(active)
+    with pytest.raises(KeyError):
+        idle.get()
+    assert store.usage('idle') == {'in_memory': 0, 'spilled': 0}
+    # The swept session learns it has to start over, once
+    assert store.touch('idle') is False
+    assert store.touch('idle') is True
+    assert store.touch('active') is True
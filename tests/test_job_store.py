@@ -0,0 +1,122 @@
+import os
+import time
+
+import job_store
+from job_store import MAX_ATTEMPTS, JobStore
+
+
+def test_job_whose_worker_keeps_dying_is_failed(tmp_path):
+    store = JobStore(str(tmp_path))
+    job_id = store.submit('merge', 1, label='crashes')
+    # A pid that never heartbeats looks like a worker that died mid-job
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        assert store.claim_next(pid=999999) == job_id
+        assert store.get(job_id)['attempts'] == attempt
+        store.requeue_orphans()
+    job = store.get(job_id)
+    assert job['status'] == 'failed'
+    assert 'not retried' in job['error']
+    assert store.claim_next(pid=999999) is None
+
+
+def test_orphaned_job_is_requeued_before_the_limit(tmp_path):
+    store = JobStore(str(tmp_path))
+    job_id = store.submit('merge', 1)
+    store.claim_next(pid=999999)
+    store.requeue_orphans()
+    assert store.get(job_id)['status'] == 'queued'
+
+
+def test_cleanup_removes_expired_jobs_and_files(tmp_path):
+    store = JobStore(str(tmp_path))
+    old_id = store.submit('merge', 1)
+    new_id = store.submit('merge', 2)
+    queued_id = store.submit('merge', 3)
+    with store._connect() as conn:
+        conn.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ?",
+                     (time.time() - 10 * 24 * 3600, old_id))
+        conn.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ?",
+                     (time.time(), new_id))
+    # A directory without a job row, as left by a submit that never completed
+    stray = tmp_path / 'stray'
+    stray.mkdir()
+    os.utime(stray, (0, 0))
+
+    assert store.cleanup(ttl=7 * 24 * 3600) == 1
+    assert store.get(old_id) is None
+    assert not (tmp_path / old_id).exists()
+    assert not stray.exists()
+    for job_id in (new_id, queued_id):
+        assert store.get(job_id) is not None
+        assert (tmp_path / job_id).exists()
+
+
+def test_at_most_max_workers_hold_a_lease(tmp_path):
+    store = JobStore(str(tmp_path))
+    assert store.acquire_worker_lease(1001, max_workers=2)
+    assert store.acquire_worker_lease(1002, max_workers=2)
+    assert not store.acquire_worker_lease(1003, max_workers=2)
+    # A lease is lost when its worker stops heartbeating
+    with store._connect() as conn:
+        conn.execute("UPDATE workers SET heartbeat_at = 0 WHERE pid = 1001")
+    assert store.acquire_worker_lease(1003, max_workers=2)
+
+
+def test_workers_claim_different_jobs(tmp_path):
+    store = JobStore(str(tmp_path))
+    first_id = store.submit('merge', 1)
+    second_id = store.submit('merge', 2)
+    assert store.claim_next(pid=1001) == first_id
+    assert store.claim_next(pid=1002) == second_id
+    assert store.claim_next(pid=1003) is None
+
+
+def test_a_worker_is_spawned_per_waiting_job_up_to_the_limit(tmp_path):
+    store = JobStore(str(tmp_path))
+    # No jobs, no worker
+    assert store.reserve_spawn(max_workers=2) is None
+    first_id = store.submit('merge', 1)
+    spawn_id = store.reserve_spawn(max_workers=2)
+    assert spawn_id is not None
+    # The worker already on its way covers the queued job, also for other sessions
+    assert JobStore(str(tmp_path)).reserve_spawn(max_workers=2) is None
+
+    # That worker starts and takes the first job; a second session's job needs another worker
+    assert store.acquire_worker_lease(1001, max_workers=2, spawn_id=spawn_id)
+    assert store.claim_next(pid=1001) == first_id
+    store.submit('merge', 2)
+    second_spawn = store.reserve_spawn(max_workers=2)
+    assert second_spawn is not None
+    assert store.acquire_worker_lease(1002, max_workers=2, spawn_id=second_spawn)
+    # Both slots are taken: a third job waits
+    store.submit('merge', 3)
+    assert store.reserve_spawn(max_workers=2) is None
+
+
+def test_a_worker_is_spawned_for_the_job_of_a_dead_worker(tmp_path):
+    store = JobStore(str(tmp_path))
+    job_id = store.submit('merge', 1)
+    store.claim_next(pid=999999)
+    assert store.get(job_id)['status'] == 'running'
+    assert store.reserve_spawn(max_workers=1) is not None
+
+
+def test_worker_beyond_the_limit_exits_at_once(tmp_path):
+    store = JobStore(str(tmp_path))
+    store.acquire_worker_lease(os.getpid() + 1, max_workers=1)
+    start = time.time()
+    job_store.run_worker(str(tmp_path), idle_timeout=30, max_workers=1)
+    assert time.time() - start < 5
+
+
+def test_old_databases_get_the_attempt_counter(tmp_path):
+    import sqlite3
+
+    old_schema = job_store.SCHEMA.replace(",\n    attempts INTEGER NOT NULL DEFAULT 0", "")
+    assert 'attempts' not in old_schema
+    conn = sqlite3.connect(str(tmp_path / 'jobs.sqlite3'))
+    conn.executescript(old_schema)
+    conn.close()
+    store = JobStore(str(tmp_path))
+    job_id = store.submit('merge', 1)
+    assert store.get(job_id)['attempts'] == 0
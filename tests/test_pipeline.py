@@ -0,0 +1,387 @@
+import datetime
+import importlib.util
+import zipfile
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+from pipeline import (FINAL_COLUMN_ORDER, FactorisedExpansion, LazyExpansion, PipelineStream,
+                      SUGGESTION_NAME_WEIGHT, TIME_COLUMNS, TrigramIndex, detect_clashes,
+                      expand_day_column, expand_df_with_dates, export_data, filter_data_with_hits,
+                      format_for_export, hours_summary, merge_data, normalise_time_columns,
+                      order_expanded_columns, partition_file_labels, run_pipeline, suggest_matches,
+                      to_csv, to_excel, to_parquet, to_partitioned_zip, write_excel_chunks)
+
+
+def merged_rows(days=('MON', 'TUE WED')):
+    """Step 2 output with one row per Day value"""
+    n_rows = len(days)
+    merged_df = pd.DataFrame({
+        'Empl ID': range(10001, 10001 + n_rows),
+        'Full Legal Name': [f"Lecturer {i}" for i in range(n_rows)],
+        'Name': [f"LECTURER {i}" for i in range(n_rows)],
+        'Day': list(days),
+        'Start Time': ['09:00:00'] * n_rows, 'End Time': ['11:00:00'] * n_rows,
+        'Program ID': ['NPO_PR0202 (ACC)'] * n_rows,
+        'Catalog Nbr': ['AB101'] * n_rows, 'Class Section': ['T01'] * n_rows})
+    return normalise_time_columns(merged_df, ['Start Time', 'End Time'])[0]
+
+
+@pytest.mark.parametrize('backend', [
+    'pandas',
+    pytest.param('polars', marks=pytest.mark.skipif(
+        importlib.util.find_spec('polars') is None, reason="polars not installed"))])
+def test_week_numbers_past_127_do_not_wrap(backend):
+    expanded_df, skipped_rows = expand_df_with_dates(
+        merged_rows(['MON']), '1 January 2020', '31 December 2022', memory_limit=None,
+        backend=backend)
+    # 156 Mondays: int8 week numbers would wrap to -128 after week 127
+    n_mondays = len(pd.date_range('2020-01-01', '2022-12-31', freq='W-MON'))
+    assert skipped_rows == 0
+    assert list(expanded_df['Week Number']) == list(range(1, n_mondays + 1))
+    assert expanded_df['Comment'].iloc[-1].startswith(f'WEEK {n_mondays}_MON_')
+    assert format_for_export(expanded_df)['Week Number'].iloc[-1] == f'Week {n_mondays}'
+
+
+def test_s1_script_reads_times_like_the_app():
+    import S1_filter
+
+    df = pd.DataFrame({'Start Time': ['09:00', '09:00:00', datetime.time(13, 30), 'noon', None]})
+    formatted_df, unparsable = S1_filter.format_time_columns(df, ['Start Time'])
+    minutes, app_unparsable = normalise_time_columns(df, ['Start Time'])
+    assert formatted_df['Start Time'].tolist()[:3] == ['09:00:00', '09:00:00', '13:30:00']
+    assert formatted_df['Start Time'].isna().tolist() == minutes['Start Time'].isna().tolist()
+    assert unparsable == app_unparsable == {'Start Time': ['noon']}
+
+
+def asrq_rows(emails):
+    """ASRQ180 export rows, one per email"""
+    n_rows = len(emails)
+    return pd.DataFrame({
+        'Email': list(emails), 'Name': ['TAN AH KOW'] * n_rows,
+        'Class Section': ['T01'] * n_rows, 'Day': ['MON'] * n_rows,
+        'Start Time': ['09:00'] * n_rows, 'End Time': ['11:00'] * n_rows,
+        'Catalog Nbr': ['AB101'] * n_rows})
+
+
+@pytest.mark.parametrize('backend', [
+    'pandas',
+    pytest.param('polars', marks=pytest.mark.skipif(
+        importlib.util.find_spec('polars') is None, reason="polars not installed"))])
+def test_filter_without_adjunct_rows_is_empty(backend):
+    filtered_df, hits_df = filter_data_with_hits(
+        asrq_rows(['staff@np.edu.sg', 'other@np.edu.sg']), ['TSP*'], backend)
+    assert len(filtered_df) == 0
+    assert list(filtered_df.columns) == list(asrq_rows([]).columns)
+    assert hits_df['Rows matched'].tolist() == [0]
+
+
+def test_partition_file_labels_are_distinct():
+    labels = ['A 1', 'A/1', 'a_1', 'B', '', '///']
+    names = partition_file_labels(labels)
+    assert names[0] == 'A_1' and names[3] == 'B' and names[4] == 'blank'
+    assert names[1].startswith('A_1_') and names[2].startswith('a_1_')
+    assert names[5].startswith('blank_')
+    assert len({name.lower() for name in names}) == len(labels)
+    assert partition_file_labels(labels) == names
+
+
+def test_zip_has_one_file_per_partition():
+    expanded_df = expand_df_with_dates(
+        merged_rows(['MON', 'TUE']), '1 April 2024', '30 April 2024', memory_limit=None)[0]
+    expanded_df['Empl ID'] = ['A 1'] * 5 + ['A/1'] * (len(expanded_df) - 5)
+    archive = zipfile.ZipFile(BytesIO(to_partitioned_zip(
+        expanded_df, by='Empl ID', max_workers=1, file_format='csv')))
+    names = archive.namelist()
+    assert len(names) == len(set(names)) == 2
+    assert sum(len(archive.read(name).splitlines()) - 1 for name in names) == len(expanded_df)
+
+
+def test_stream_continues_past_a_batch_without_adjunct_rows():
+    lookup_df = pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow'], 'Empl ID': [10019], 'Time entry code': ['X'],
+        'Position ID': [1], 'Program ID': ['NPO_PR0202 (ACC)'], 'Requester Remarks': ['AB101']})
+    batches = [asrq_rows(['a@adj.np.edu.sg']), asrq_rows(['staff@np.edu.sg'] * 2),
+               asrq_rows(['a@adj.np.edu.sg', 'b@adj.np.edu.sg'])]
+    stream = PipelineStream(iter(batches), lookup_df, '1 April 2024', '30 April 2024')
+    chunks = list(stream.iter_chunks(4))
+    assert [len(chunk) for chunk in chunks] == [4, 1, 4, 4, 2]
+    streamed_df = pd.concat(chunks)
+    expected_df = run_pipeline(pd.concat(batches, ignore_index=True), lookup_df,
+                               '1 April 2024', '30 April 2024')['expanded']
+    results = stream.results()
+    assert results['asrq_rows'] == 5 and results['filtered_rows'] == 3
+    assert len(streamed_df) == len(expected_df) == results['expanded_rows'] > 0
+    pd.testing.assert_frame_equal(streamed_df.astype(object), expected_df.astype(object))
+
+
+def test_export_columns_leave_duration_to_the_hours_summary():
+    result = run_pipeline(asrq_rows(['a@adj.np.edu.sg', 'b@adj.np.edu.sg']), pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow'], 'Empl ID': [10019], 'Time entry code': ['X'],
+        'Position ID': [1], 'Program ID': ['NPO_PR0202 (ACC)'], 'Requester Remarks': ['AB101']}),
+        '1 April 2024', '30 April 2024')
+    assert 'Duration (h)' not in result['expanded'].columns
+    assert list(result['expanded'].columns) == [
+        'Empl ID', 'Full Legal Name', 'Name', 'Time entry code', 'Day', 'Week Number', 'Date',
+        'Start Time', 'End Time', 'Position ID', 'Program ID', 'Class Section', 'Catalog Nbr',
+        'Comment']
+    # 2 sessions of 2 hours on each of the 5 Mondays
+    summary_df = hours_summary(result['expanded'])
+    assert summary_df['Sessions'].tolist() == [2] * 5
+    assert summary_df['Hours'].tolist() == [4.0] * 5
+
+
+def sessions(rows):
+    """Step 3 rows from (Empl ID, date, start, end, Program ID) tuples, times as 'HH:MM'"""
+    df = pd.DataFrame(rows, columns=['Empl ID', 'Date', 'Start Time', 'End Time', 'Program ID'])
+    df = normalise_time_columns(df, ['Start Time', 'End Time'])[0]
+    return df.assign(**{
+        'Full Legal Name': [f"Lecturer {empl_id}" for empl_id in df['Empl ID']],
+        'Date': pd.to_datetime(df['Date']), 'Week Number': 1,
+        'Catalog Nbr': [f"AB{100 + i}" for i in range(len(df))], 'Class Section': 'T01'})
+
+
+def test_clashes_are_overlaps_of_one_lecturer_on_one_date():
+    report = detect_clashes(sessions([
+        # Overlapping slots: 10:00-12:00 starts before 09:00-11:00 ends
+        (1, '2024-04-01', '09:00', '11:00', 'NPO_PR01'),
+        (1, '2024-04-01', '10:00', '12:00', 'NPO_PR01'),
+        # Adjacent slots: ending as the next one starts is not a clash
+        (2, '2024-04-01', '09:00', '11:00', 'NPO_PR01'),
+        (2, '2024-04-01', '11:00', '13:00', 'NPO_PR01'),
+        # Same times on different dates
+        (3, '2024-04-01', '09:00', '11:00', 'NPO_PR01'),
+        (3, '2024-04-02', '09:00', '11:00', 'NPO_PR01'),
+        # Different lecturers at the same time
+        (4, '2024-04-01', '09:00', '11:00', 'NPO_PR01'),
+        # The same lecturer in two programs
+        (5, '2024-04-03', '14:00', '16:00', 'NPO_PR01'),
+        (5, '2024-04-03', '15:30', '17:00', 'NPO_PR02'),
+    ]))
+    assert report['Empl ID'].tolist() == [1, 5]
+    assert report['Catalog Nbr'].tolist() == ['AB101', 'AB108']
+    assert report['Other Catalog Nbr'].tolist() == ['AB100', 'AB107']
+    assert report['Overlap (min)'].tolist() == [60, 30]
+
+
+def test_no_clashes_give_an_empty_report():
+    report = detect_clashes(sessions([(1, '2024-04-01', '09:00', '11:00', 'NPO_PR01'),
+                                      (1, '2024-04-01', '11:00', '12:00', 'NPO_PR01')]))
+    assert len(report) == 0
+    assert 'Overlap (min)' in report.columns
+
+
+def test_suggestions_weigh_the_name_three_quarters():
+    lookup_df = pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow', 'Lim Bee', 'Tan Ah Kow'], 'Empl ID': [1, 2, 3],
+        'Time entry code': ['X'] * 3, 'Position ID': [1, 2, 3], 'Program ID': ['NPO_PR01'] * 3,
+        'Requester Remarks': ['XY999', 'AB101', 'AB101']})
+    unmatched_df = pd.DataFrame({'Name': ['TAN AH KOW', None, 'ZZZZ'],
+                                 'Catalog Nbr': ['AB101', 'AB101', 'QQ000']})
+    suggestions = suggest_matches(unmatched_df, lookup_df)
+    # Name and catalog, name only, catalog only
+    full = suggestions[suggestions['Row'] == 0]
+    assert full['Empl ID'].tolist() == [3, 1, 2]
+    assert full['Score'].tolist() == [1.0, SUGGESTION_NAME_WEIGHT, 1 - SUGGESTION_NAME_WEIGHT]
+    assert full['Rank'].tolist() == [1, 2, 3]
+    # Without a name only the catalog scores; ties keep hiring form order
+    no_name = suggestions[suggestions['Row'] == 1]
+    assert no_name['Empl ID'].tolist() == [2, 3]
+    assert no_name['Score'].tolist() == [0.25, 0.25]
+    # Nothing shares a trigram with the last row
+    assert 2 not in set(suggestions['Row'])
+    assert SUGGESTION_NAME_WEIGHT == 0.75
+
+
+def test_trigram_index_counts_shared_trigrams():
+    index = TrigramIndex(['ACC_101', 'ACC 102', None])
+    rows, shared, query_size = index.shared_counts('acc 101')
+    assert query_size == 8
+    assert rows.tolist() == [0, 1] and shared.tolist() == [8, 6]
+    assert index.sizes.tolist() == [8, 8, 0]
+    assert index.shared_counts('zzz')[0].tolist() == []
+
+
+def test_sparse_engine_takes_the_best_name_score_first_in_file_order():
+    pytest.importorskip('scipy')
+    lookup_df = pd.DataFrame({
+        'Full Legal Name': ['Tan Ah', 'Tan Ah Kow', 'Tan Ah Kow', 'Lim Bee'],
+        'Empl ID': [1, 2, 3, 4], 'Time entry code': ['X'] * 4, 'Position ID': [1, 2, 3, 4],
+        'Program ID': ['NPO_PR01'] * 4, 'Requester Remarks': ['AB101', 'AB101', 'AB101', 'AB101']})
+    filtered_df = pd.DataFrame({
+        'Name': ['TAN AH KOW', 'LIM BEE', 'ONG', 'LIM BEE'],
+        'Catalog Nbr': ['AB101', 'CD202', 'AB101', 'AB101'],
+        'Class Section': ['T01'] * 4, 'Day': ['MON'] * 4,
+        'Start Time': ['09:00'] * 4, 'End Time': ['11:00'] * 4})
+    merged_df, unmatched_df, unmatched_count = merge_data(filtered_df, lookup_df, 'sparse')
+    # 'Tan Ah Kow' twice scores 1.0 and beats 'Tan Ah' (2/3); the tie goes to the first
+    assert merged_df['Empl ID'].tolist() == [2, 4]
+    assert merged_df['Name'].tolist() == ['TAN AH KOW', 'LIM BEE']
+    assert merged_df['Match Score'].tolist() == [1.0, 1.0]
+    assert merged_df['Candidates'].tolist() == [3, 1]
+    # A catalog not in the remarks, and a single shared token, do not match
+    assert unmatched_count == 2
+    assert unmatched_df['Name'].tolist() == ['LIM BEE', 'ONG']
+    assert unmatched_df['Catalog Nbr'].tolist() == ['CD202', 'AB101']
+
+
+def test_factorised_zip_partitions_are_built_in_the_workers(monkeypatch):
+    expansion = LazyExpansion(merged_rows(['MON', 'TUE WED']), '1 April 2024',
+                              '30 April 2024').factorise()
+    expected = zipfile.ZipFile(BytesIO(to_partitioned_zip(
+        expansion.to_frame(), by='Empl ID', max_workers=1, file_format='csv')))
+
+    def take(positions):
+        raise AssertionError("partition rows built in the parent process")
+    monkeypatch.setattr(expansion, 'take', take)
+    archive = zipfile.ZipFile(BytesIO(to_partitioned_zip(
+        expansion, by='Empl ID', max_workers=1, file_format='csv')))
+    assert archive.namelist() == expected.namelist() and len(archive.namelist()) == 2
+    for name in archive.namelist():
+        assert archive.read(name) == expected.read(name)
+
+
+def first_row_cells(workbook_bytes, sheet_name=None):
+    """Header -> first data cell of a sheet, read back with openpyxl"""
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(BytesIO(workbook_bytes))
+    sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+    header = [cell.value for cell in sheet[1]]
+    return dict(zip(header, sheet[2]))
+
+
+def test_native_dates_round_trip_as_excel_dates_and_times():
+    expansion = LazyExpansion(merged_rows(['MON']), '1 April 2024', '30 April 2024').factorise()
+    clashes = detect_clashes(sessions([(1, '2024-04-01', '09:00', '11:00', 'NPO_PR01'),
+                                       (1, '2024-04-01', '10:30', '12:00', 'NPO_PR01')]))
+    chunks_output = BytesIO()
+    write_excel_chunks(chunks_output, [
+        ('Sheet1', expansion.columns, expansion.iter_chunks(2), len(expansion)),
+        ('Clashes', list(clashes.columns), [clashes], len(clashes))], native_dates=True)
+    for workbook_bytes in [to_excel(expansion.to_frame(), native_dates=True),
+                           to_excel(expansion, chunk_rows=2, native_dates=True),
+                           chunks_output.getvalue()]:
+        cells = first_row_cells(workbook_bytes)
+        assert cells['Date'].value == datetime.datetime(2024, 4, 1)
+        assert cells['Date'].number_format == 'yyyy-mm-dd'
+        for col in ['Start Time', 'End Time']:
+            assert isinstance(cells[col].value, datetime.time)
+            assert cells[col].number_format == 'hh:mm:ss'
+        assert (cells['Start Time'].value, cells['End Time'].value) == (
+            datetime.time(9, 0), datetime.time(11, 0))
+        assert cells['Week Number'].value == 'Week 1'
+    clash_cells = first_row_cells(chunks_output.getvalue(), 'Clashes')
+    assert clash_cells['Other Start Time'].value == datetime.time(9, 0)
+    assert clash_cells['Other End Time'].number_format == 'hh:mm:ss'
+    # Text by default
+    cells = first_row_cells(to_excel(expansion))
+    assert (cells['Date'].value, cells['Start Time'].value) == ('2024-04-01', '09:00:00')
+
+
+@pytest.mark.parametrize('factorised', [False, True])
+def test_csv_and_parquet_hold_the_xlsx_values(factorised):
+    pytest.importorskip('pyarrow')
+    merged_df = merged_rows(['MON', 'TUE WED']).assign(**{'Time entry code': 'X', 'Position ID': 1})
+    expansion = LazyExpansion(merged_df, '1 April 2024', '30 April 2024').factorise()
+    data = expansion if factorised else expansion.to_frame()
+    xlsx_df = pd.read_excel(BytesIO(export_data(data, 'xlsx')), dtype=str)
+    csv_df = pd.read_csv(BytesIO(to_csv(data, chunk_rows=3)), dtype=str)
+    parquet_df = pd.read_parquet(BytesIO(to_parquet(data, chunk_rows=3)))
+    # FINAL_COLUMN_ORDER, with 'Date' moved after 'Day'
+    assert list(xlsx_df.columns) == order_expanded_columns(FINAL_COLUMN_ORDER)
+    for exported_df in [csv_df, pd.read_csv(BytesIO(export_data(data, 'csv')), dtype=str),
+                        parquet_df, pd.read_parquet(BytesIO(export_data(data, 'parquet')))]:
+        assert list(exported_df.columns) == list(xlsx_df.columns)
+        pd.testing.assert_frame_equal(exported_df.astype(str), xlsx_df.astype(str))
+    assert parquet_df['Empl ID'].dtype.kind == 'i'
+
+
+def test_rows_per_day_and_size_estimate_decide_the_result_type():
+    merged_df = merged_rows(['MON', 'TUE WED', 'FUNDAY'])
+    expansion = LazyExpansion(merged_df, '1 April 2024', '30 April 2024')
+    # April 2024: 5 Mondays and Tuesdays, 4 Wednesdays; 'FUNDAY' is skipped
+    assert expansion.rows_per_day() == {'Mon': 5, 'Tue': 5, 'Wed': 4, 'Thu': 0, 'Fri': 0, 'Sat': 0}
+    assert sum(expansion.rows_per_day().values()) == len(expansion) == 14
+    assert expansion.skipped_rows == 1
+    estimate = expansion.estimated_nbytes()
+    actual = expansion.materialize().memory_usage(index=False, deep=True).sum()
+    assert 0.5 * actual <= estimate <= 2 * actual
+    assert LazyExpansion(merged_df.iloc[:0], '1 April 2024', '30 April 2024').estimated_nbytes() == 0
+
+    expanded_df, skipped_rows = expand_df_with_dates(
+        merged_df, '1 April 2024', '30 April 2024', memory_limit=estimate)
+    assert isinstance(expanded_df, pd.DataFrame) and skipped_rows == 1
+    factorised, skipped_rows = expand_df_with_dates(
+        merged_df, '1 April 2024', '30 April 2024', memory_limit=0)
+    assert isinstance(factorised, FactorisedExpansion) and skipped_rows == 1
+    assert len(factorised) == len(expanded_df) and factorised.columns == list(expanded_df.columns)
+    pd.testing.assert_frame_equal(factorised.to_frame(), expanded_df)
+    pd.testing.assert_frame_equal(factorised.take([0, 13]), expanded_df.take([0, 13]))
+
+
+def test_stream_handles_a_batch_without_program_ids():
+    lookup_df = pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow', 'Lim Bee'], 'Empl ID': [10019, 10020],
+        'Time entry code': ['X', 'X'], 'Position ID': [1, 2],
+        'Program ID': [None, 'NPO_PR0202 (ACC)'], 'Requester Remarks': ['AB101', 'AB101']})
+    # Only Tan Ah Kow, whose Program ID is empty, in the first batch
+    batches = [asrq_rows(['a@adj.np.edu.sg']),
+               asrq_rows(['a@adj.np.edu.sg', 'b@adj.np.edu.sg']).assign(Name=['TAN AH KOW', 'LIM BEE'])]
+    stream = PipelineStream(iter(batches), lookup_df, '1 April 2024', '30 April 2024')
+    streamed_df = pd.concat(list(stream.iter_chunks()), ignore_index=True)
+    expected_df = run_pipeline(pd.concat(batches, ignore_index=True), lookup_df,
+                               '1 April 2024', '30 April 2024')['expanded']
+    assert len(streamed_df) == len(expected_df) == 15
+    assert expected_df['Program ID'].isna().sum() == 10
+    assert set(expected_df['Program ID'].dropna()) == {'NPO_PR0202'}
+    pd.testing.assert_frame_equal(streamed_df.astype(object), expected_df.astype(object))
+
+
+def test_polars_day_split_matches_pandas():
+    pytest.importorskip('polars')
+    filtered_df = normalise_time_columns(asrq_rows(['a@adj.np.edu.sg'] * 5).assign(
+        Day=['MON', 'TUE WED', 'thu  fri sat', 'FUNDAY', None]), TIME_COLUMNS)[0]
+    pandas_count, pandas_df = expand_day_column(filtered_df)
+    polars_count, polars_df = expand_day_column(filtered_df, 'polars')
+    assert pandas_count == polars_count == 2
+    assert len(pandas_df) == 8
+    pd.testing.assert_frame_equal(polars_df.astype(object), pandas_df.astype(object))
+
+
+def test_polars_date_expansion_matches_pandas():
+    pytest.importorskip('polars')
+    merged_df = merged_rows(['MON', 'TUE WED', 'FUNDAY', 'sat']).assign(**{
+        'Time entry code': 'X', 'Position ID': [1, 2, 3, 4],
+        'Program ID': ['NPO_PR0202 (ACC)', None, 'NPO_PR0303', '']})
+    expected_df, expected_skipped = expand_df_with_dates(
+        merged_df, '1 April 2024', '30 April 2024', memory_limit=None)
+    expanded_df, skipped_rows = expand_df_with_dates(
+        merged_df, '1 April 2024', '30 April 2024', memory_limit=None, backend='polars')
+    assert skipped_rows == expected_skipped == 1
+    assert len(expected_df) == 5 + 5 + 4 + 4
+    pd.testing.assert_frame_equal(expanded_df, expected_df)
+
+
+def test_duckdb_engine_matches_first_match():
+    pytest.importorskip('duckdb')
+    lookup_df = pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow', 'Tan Ah Kow Boon', 'Lim Bee', 'Kow Tan'],
+        'Empl ID': [1, 2, 3, 4], 'Time entry code': ['X'] * 4, 'Position ID': [1, 2, 3, 4],
+        'Program ID': ['NPO_PR01'] * 4,
+        'Requester Remarks': ['AB101', 'AB101', 'AB101, CD202', 'EF303']})
+    filtered_df = normalise_time_columns(pd.DataFrame({
+        # Several candidates; partial names; a remarks list; one token only; catalog mismatch
+        'Name': ['TAN AH KOW', 'TAN KOW', 'KOW TAN', 'LIM BEE', 'ONG', 'LIM BEE'],
+        'Catalog Nbr': ['AB101', 'AB101', 'EF303', 'CD202', 'AB101', 'XY999'],
+        'Class Section': ['T01'] * 6, 'Day': ['MON'] * 6,
+        'Start Time': ['09:00'] * 6, 'End Time': ['11:00'] * 6},
+        index=range(10, 16)), TIME_COLUMNS)[0]
+    expected_df, expected_unmatched, expected_count = merge_data(filtered_df, lookup_df)
+    merged_df, unmatched_df, unmatched_count = merge_data(filtered_df, lookup_df, 'duckdb')
+    assert expected_df['Empl ID'].tolist() == [1, 1, 4, 3]
+    assert unmatched_count == expected_count == 2
+    for result, expected in [(merged_df, expected_df), (unmatched_df, expected_unmatched)]:
+        assert list(result.columns) == list(expected.columns)
+        pd.testing.assert_frame_equal(result, expected)
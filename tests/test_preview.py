@@ -0,0 +1,44 @@
+import pandas as pd
+
+from pipeline import LazyExpansion, expand_df_with_dates, normalise_time_columns
+from preview import column_summary, select_rows
+
+
+def merged_rows():
+    """Step 2 output: a morning and an afternoon session on Mondays"""
+    merged_df = pd.DataFrame({
+        'Empl ID': [10001, 10002], 'Full Legal Name': ['Tan Ah Kow', 'Lim Bee'],
+        'Name': ['TAN AH KOW', 'LIM BEE'], 'Day': ['MON', 'MON'],
+        'Start Time': ['09:00', '14:00'], 'End Time': ['11:00', '16:00'],
+        'Program ID': ['NPO_PR0202 (ACC)'] * 2, 'Catalog Nbr': ['AB101', 'CD202'],
+        'Class Section': ['T01', 'T02']})
+    return normalise_time_columns(merged_df, ['Start Time', 'End Time'])[0]
+
+
+def expanded_rows():
+    """Step 3 output: both sessions on each Monday of April 2024"""
+    return expand_df_with_dates(merged_rows(), '1 April 2024', '30 April 2024', memory_limit=None)[0]
+
+
+def test_times_and_dates_are_searched_as_shown():
+    expanded_df = expanded_rows()
+    morning = select_rows(expanded_df, '09:00', ['Start Time'])
+    assert len(morning) == 5
+    assert set(expanded_df['Name'].iloc[morning]) == {'TAN AH KOW'}
+    assert len(select_rows(expanded_df, '16:00:00', ['Start Time', 'End Time'])) == 5
+    assert len(select_rows(expanded_df, '2024-04-08', ['Date'])) == 2
+    assert len(select_rows(expanded_df, 'week 2', ['Week Number'])) == 2
+
+
+def test_factorised_summary_and_comments_do_not_build_rows(monkeypatch):
+    merged_df = merged_rows()
+    merged_df.loc[1, 'Class Section'] = None
+    expansion = LazyExpansion(merged_df, '1 April 2024', '30 April 2024').factorise()
+    expanded_df = expansion.to_frame()
+
+    def take(positions):
+        raise AssertionError("built full rows")
+    monkeypatch.setattr(expansion, 'take', take)
+    pd.testing.assert_frame_equal(column_summary(expansion), column_summary(expanded_df))
+    pd.testing.assert_series_equal(expansion['Comment'], expanded_df['Comment'])
+    assert len(select_rows(expansion, 'week 2_mon_ab101', ['Comment'])) == 1
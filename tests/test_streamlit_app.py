@@ -0,0 +1,72 @@
+import os
+import time
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+import job_store
+
+AppTest = pytest.importorskip('streamlit.testing.v1').AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'streamlit_app.py')
+
+
+def xlsx_bytes(df):
+    output = BytesIO()
+    df.to_excel(output, index=False)
+    return output.getvalue()
+
+
+def asrq_file():
+    return xlsx_bytes(pd.DataFrame({
+        'Email': ['tan.ak@adj.np.edu.sg', 'lim.b@adj.np.edu.sg', 'staff@np.edu.sg'],
+        'Name': ['TAN AH KOW', 'LIM BEE', 'ONG CHOO'],
+        'Catalog Nbr': ['AB101', 'CD202', 'AB101'],
+        'Class Section': ['T01', 'T02', 'T03'], 'Day': ['MON WED', 'TUE', 'MON'],
+        'Start Time': ['09:00', '10:00:00', '14:00'], 'End Time': ['11:00', '12:00:00', '16:00']}))
+
+
+def hiring_form_file():
+    return xlsx_bytes(pd.DataFrame({
+        'Full Legal Name': ['Tan Ah Kow', 'Lim Bee'], 'Empl ID': [10019, 10020],
+        'Time entry code': ['X', 'Y'], 'Position ID': [1, 2],
+        'Program ID': ['NPO_PR0202 (ACC)', 'NPO_PR0303'], 'Requester Remarks': ['AB101', 'CD202']}))
+
+
+@pytest.fixture
+def app():
+    yield AppTest.from_file(APP_PATH, default_timeout=60)
+    # Workers spawned for the app's jobs would otherwise wait out their idle timeout
+    for proc in job_store._spawned_workers:
+        proc.terminate()
+        proc.wait()
+
+
+def run_until(app, condition, timeout=60):
+    deadline = time.time() + timeout
+    while not condition() and not app.exception and time.time() < deadline:
+        time.sleep(0.2)
+        app.run()
+    assert not app.exception
+    assert condition()
+
+
+def test_upload_both_files_and_merge(app):
+    app.run()
+    app.file_uploader[0].upload('asrq180.xlsx', asrq_file())
+    app.run()
+    assert not app.exception and not app.error
+    assert app.session_state.current_step == 0
+    assert len(app.session_state.step1_data) == 3  # MON WED is split into two rows
+
+    [button for button in app.button if button.label == "Proceed to Step 2"][0].click()
+    app.run()
+    app.file_uploader[0].upload('hiring_form.xlsx', hiring_form_file())
+    app.run()
+    run_until(app, lambda: app.session_state.step2_data is not None)
+    assert not app.exception and not app.error
+    assert "Merge Results Summary" in [header.value for header in app.subheader]
+    merged_df = app.session_state.step2_data.get()
+    assert sorted(merged_df['Empl ID'].tolist()) == [10019, 10019, 10020]